@@ -51,13 +51,15 @@ class DativaDashboardTemplate:
     def _random_generator(size=3, chars=string.ascii_lowercase):
         return ''.join(random.choice(chars) for x in range(size)).title()
 
-    def __init__(self, project_name, stage_name, source_path="./dashboards", template_path="./templates"):
+    def __init__(self, project_name, stage_name, source_path="./dashboards", template_path="./templates",
+                 broker="SQS"):
         """
         class to read in and generate the
         :param project_name: labels the resulting dashboard
         :param stage_name: stage type being deployed, e.g. PROD, DEV, etc.
         :param source_path: location where json is stored
         :param template_path: path to write the templates to -
+        :param broker: Celery broker of the stack, SQS or Redis, whose queue metrics the dashboard shows
         """
         # Note: Module names should use '_' not '-' but some names cannot contain '_' so replace with dashes
         self._project = project_name
@@ -69,6 +71,7 @@ class DativaDashboardTemplate:
         self._stage_name = stage_name
         self._stage_name_alphanum = stage_name.title().replace("_", "").replace("-", "")
         self._template_path = template_path
+        self._broker = broker
         source_file_unique = "{}/dashboard-{}.{}".format(source_path, self._stage_name, self._file_ext)
         source_file_template = "{}/dashboard-template.{}".format(source_path, self._file_ext)
         self._random_ascii = self._random_generator()
@@ -160,6 +163,8 @@ class DativaDashboardTemplate:
             Type=constants.STRING,
         ))
         dashboard_source = self.dashboard_source
+        if self._broker == "Redis":
+            self._use_redis_queue_metrics(dashboard_source)
 
         # Check if warning widget is already part of the dashboard, if not append it
         if 'This dashboard is automatically deployed by CloudFormation' not in json.dumps(dashboard_source):
@@ -187,6 +192,33 @@ class DativaDashboardTemplate:
 
         return self._save_template(template_name, t.to_yaml())
 
+    @staticmethod
+    def _use_redis_queue_metrics(dashboard_source):
+        """
+        Points the SQS queue widgets at the queue depth the scheduler publishes for a Redis broker
+        :param dashboard_source: dashboard definition, updated in place
+        :return: None
+        """
+        metric_names = {
+            "ApproximateNumberOfMessagesVisible": "QueueMessagesVisible",
+            "ApproximateNumberOfMessagesNotVisible": "QueueMessagesInFlight",
+        }
+        for widget in dashboard_source["widgets"]:
+            properties = widget.get("properties", {})
+            metrics = properties.get("metrics", [])
+            namespace = None
+            for metric in metrics:
+                # "." repeats the value of the previous metric
+                if metric[0] != ".":
+                    namespace = metric[0]
+                if namespace != "AWS/SQS" or metric[1] not in metric_names:
+                    continue
+                if metric[0] == "AWS/SQS":
+                    metric[0] = "Turbine"
+                metric[1] = metric_names[metric[1]]
+            if properties.get("title") == "SQS Queues" and namespace == "AWS/SQS":
+                properties["title"] = "Redis Queues"
+
     def add_instance_count_alarms(self, t):
         """ adds alarms in place to template and an sns topic for the alarm"""
 
@@ -0,0 +1,88 @@
+"""
+Publishes a DAG folder as a content-addressed bundle to the deployments bucket,
+for the instances of a stack with DagDistribution set to Bundle to sync it.
+
+Every file is uploaded once as bundles/blobs/<sha256>, only the blobs missing
+from the bucket are uploaded, in parallel. The manifest listing the path, hash
+and mode of every file is uploaded as bundles/manifests/<version>.json, the
+version being the hash of the manifest, and bundles/current is written last, so
+that the instances never see a version with missing blobs.
+"""
+import argparse
+import concurrent.futures
+import hashlib
+import json
+import os
+import stat
+
+import boto3
+
+S3 = boto3.client("s3")
+
+PREFIX = "bundles/"
+UPLOAD_WORKERS = 16
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("bucket", help="the deployments bucket of the stack")
+    parser.add_argument("folder", help="the DAG folder to publish")
+    args = parser.parse_args()
+    version = publish(args.bucket, args.folder)
+    print("published version {}".format(version))
+
+
+def publish(bucket, folder):
+    """Publishes the folder and returns its version"""
+    files, paths = manifest_files(folder)
+    manifest = json.dumps({"files": files}, sort_keys=True).encode()
+    version = hashlib.sha256(manifest).hexdigest()
+
+    published = published_blobs(bucket)
+    with concurrent.futures.ThreadPoolExecutor(UPLOAD_WORKERS) as executor:
+        for future in [
+            executor.submit(S3.upload_file, path, bucket, PREFIX + "blobs/" + sha256)
+            for sha256, path in paths.items()
+            if sha256 not in published
+        ]:
+            future.result()
+    S3.put_object(
+        Bucket=bucket, Key=PREFIX + "manifests/" + version + ".json", Body=manifest
+    )
+    S3.put_object(Bucket=bucket, Key=PREFIX + "current", Body=version.encode())
+    return version
+
+
+def manifest_files(folder):
+    """The manifest entry of every file by relative path, and a path by hash"""
+    files = {}
+    paths = {}
+    for directory, dirs, names in os.walk(folder):
+        dirs[:] = [name for name in dirs if name != "__pycache__"]
+        for name in names:
+            path = os.path.join(directory, name)
+            digest = hashlib.sha256()
+            with open(path, "rb") as source:
+                for chunk in iter(lambda: source.read(1 << 20), b""):
+                    digest.update(chunk)
+            executable = os.stat(path).st_mode & stat.S_IXUSR
+            relative = os.path.relpath(path, folder).replace(os.sep, "/")
+            files[relative] = {
+                "sha256": digest.hexdigest(),
+                "mode": 0o755 if executable else 0o644,
+            }
+            paths[digest.hexdigest()] = path
+    return files, paths
+
+
+def published_blobs(bucket):
+    published = set()
+    paginator = S3.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket, Prefix=PREFIX + "blobs/"):
+        for item in page.get("Contents", []):
+            published.add(item["Key"].rsplit("/", 1)[-1])
+    return published
+
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,44 @@
 import datetime
+import json
 import logging
+import math
 import os
+import time
 
 import boto3
 
 CW = boto3.client("cloudwatch")
+AS = boto3.client("autoscaling")
+SSM = boto3.client("ssm")
+SQS = boto3.client("sqs")
 logging.getLogger().setLevel(os.environ.get("LOGLEVEL", logging.INFO))
 
+# PutMetricData accepts at most this many datums in a single request
+MAX_METRIC_DATA = 1000
+# Empty receives per minute of an idle worker until a baseline has been learned
+DEFAULT_POLLING_FREQ = 5.5
+# Weight of the latest idle sample in the moving average of the baseline
+BASELINE_WEIGHT = 0.1
+# Worker sets with fast scaling are sampled this many times, this many seconds apart
+FAST_SAMPLES = 6
+FAST_PERIOD = 10
+# Minutes of inputs fetched per invocation, in which missing ClusterLoad points are
+# backfilled and gaps of up to MAX_GAP minutes are filled with the previous value
+WINDOW_MINUTES = 10
+MAX_GAP = 3
+# Inputs read from the queue metrics, which SQS does not publish for inactive queues
+QUEUE_INPUTS = ("maxANOMV", "maxANOMNV", "sumNOER")
+INPUTS = QUEUE_INPUTS + ("avgGISI",)
+# Metric names of the inputs, only published in the embedded metric format
+INPUT_METRICS = {
+    "maxANOMV": "ANOMV",
+    "maxANOMNV": "ANOMNV",
+    "sumNOER": "NOER",
+    "avgGISI": "GISI",
+}
 
-def handler(_event, _context):
+
+def handler(event, context):
     """
     https://github.com/villasv/aws-airflow-stack/wiki/Cluster-Load-Metric-Rationale
     """
@@ -22,98 +52,571 @@ def handler(_event, _context):
     )
     # We jump 2 minutes back because that's how far behind the aws metrics we're accessing are
 
-    logging.info("evaluating at [%s]", timestamp)
+    worker_sets = get_worker_sets(event)
+    logging.info("evaluating %s worker sets at [%s]", len(worker_sets), timestamp)
 
-    metrics = get_metrics(timestamp)
+    minutes = [
+        timestamp - datetime.timedelta(minutes=offset)
+        for offset in reversed(range(WINDOW_MINUTES))
+    ]
+    metrics = get_metrics(minutes, worker_sets)
     logging.debug("available metrics: %s", metrics)
 
-    messages = metrics["maxANOMV"]
-    requests = metrics["sumNOER"]
-    machines = metrics["avgGISI"]
-    logging.info("ANOMV=%s NOER=%s GISI=%s", messages, requests, machines)
-    average_polling_freq_per_minute = 5.5
-    """ average_polling_freq_per_minute is determined by observing the aws sqs metric of empty receives it is currently
-    5 or 6 per minute so we take an average of 5.5
+    baselines = get_baselines()
+    learned = dict(baselines)
+
+    metric_data = []
+    capacities = {}
+    for worker_set, series in zip(worker_sets, metrics):
+        stack = worker_set["StackName"]
+        window = fill_window(series, minutes, idle_inputs(worker_set))
+        inputs = window[-1]
+        if None in inputs.values():
+            logging.warning("[%s] missing datapoints: %s", stack, inputs)
+            continue
+
+        messages = inputs["maxANOMV"]
+        in_flight = inputs["maxANOMNV"]
+        requests = inputs["sumNOER"]
+        machines = inputs["avgGISI"]
+        logging.info(
+            "[%s] ANOMV=%s ANOMNV=%s NOER=%s GISI=%s",
+            stack,
+            messages,
+            in_flight,
+            requests,
+            machines,
+        )
+        # Filled inputs may be minutes old, which only the ClusterLoad points and
+        # their alarms tolerate
+        current = {name for name in INPUTS if timestamp in series.get(name, {})}
+        if emits_emf():
+            for name, metric in INPUT_METRICS.items():
+                if name in current:
+                    datum = metric_datum(
+                        metric, stack, timestamp, inputs[name], "Count"
+                    )
+                    metric_data.append(datum)
+
+        baseline = baselines.get(stack)
+        if counts_empty_receives(worker_set) and {"sumNOER", "avgGISI"} <= current:
+            baseline = learn_baseline(baseline, messages, in_flight, requests, machines)
+            learned[stack] = baseline
+            logging.info("[%s] B=%s", stack, baseline)
+            metric_data.append(
+                metric_datum("EmptyReceiveBaseline", stack, timestamp, baseline)
+            )
+
+        if scales_capacity(worker_set):
+            if "avgGISI" not in current:
+                logging.warning("[%s] no current GISI, capacity unchanged", stack)
+                continue
+            slots = int(worker_set.get("WorkerSlots", 16))
+            capacity = desired_capacity(messages, in_flight, slots, machines)
+            logging.info("[%s] DC=%s", stack, capacity)
+            metric_data.append(
+                metric_datum("DesiredCapacity", stack, timestamp, capacity, "Count")
+            )
+            capacities[worker_set["GroupName"]] = capacity
+            continue
+
+        if scales_fast(worker_set):
+            continue
+
+        for minute, earlier in zip(minutes[:-1], window[:-1]):
+            if minute in series["avgCL"] or None in earlier.values():
+                continue
+            load = worker_set_load(worker_set, earlier, baseline)
+            if load is not None:
+                logging.info("[%s] backfilling L=%s at [%s]", stack, load, minute)
+                metric_data.append(metric_datum("ClusterLoad", stack, minute, load))
+
+        load = worker_set_load(worker_set, inputs, baseline)
+        if load is None:
+            continue
+
+        logging.info("[%s] L=%s", stack, load)
+        metric_data.append(metric_datum("ClusterLoad", stack, timestamp, load))
+
+    publish_metrics(metric_data)
+    set_desired_capacities(capacities)
+    if learned != baselines:
+        put_baselines(learned)
+
+    fast_worker_sets = [
+        ws for ws in worker_sets if scales_fast(ws) and not scales_capacity(ws)
+    ]
+    if fast_worker_sets:
+        sample_fast_load(fast_worker_sets, account_id(context))
+
+
+def cluster_load(
+    messages, requests, machines, average_polling_freq_per_minute=DEFAULT_POLLING_FREQ
+):
+    """average_polling_freq_per_minute is the empty receives per minute of an idle
+    machine, learned by learn_baseline. It used to be fixed at 5.5 by observing the
+    aws sqs metric of empty receives at 5 or 6 per minute
     """
 
     if machines > 0:
-        load = 1.0 - requests / (machines * average_polling_freq_per_minute)
-    elif messages > 0:
-        load = 1.0
-    else:
+        return 1.0 - requests / (machines * average_polling_freq_per_minute)
+    if messages > 0:
+        return 1.0
+    return None
+
+
+def worker_set_load(worker_set, inputs, baseline):
+    """
+    The cluster load from the empty receives of the SQS queue, or the occupancy
+    load where idle workers wait on the broker instead of polling it: with the
+    Occupancy load formula of long polling queues, and for a Redis broker.
+    """
+    if not counts_empty_receives(worker_set):
+        slots = int(worker_set.get("WorkerSlots", 16))
+        return occupancy_load(
+            inputs["maxANOMV"], inputs["maxANOMNV"], slots, inputs["avgGISI"]
+        )
+    if baseline is None:
+        baseline = DEFAULT_POLLING_FREQ
+    return cluster_load(
+        inputs["maxANOMV"], inputs["sumNOER"], inputs["avgGISI"], baseline
+    )
+
+
+def occupancy_load(messages, in_flight, slots, machines):
+    """
+    Share of the worker slots in service taken by visible and in-flight messages,
+    the load of worker sets with fast scaling as empty receives are only
+    available as a per minute metric.
+    """
+    if machines > 0:
+        return min(1.0, (messages + in_flight) / (machines * slots))
+    if messages > 0:
+        return 1.0
+    return None
+
+
+def learn_baseline(baseline, messages, in_flight, requests, machines):
+    """
+    Moving average of the empty receives per minute of a single machine. It is
+    only updated from minutes in which the queue was empty and no message was
+    in flight, so every machine in service spent the whole minute polling.
+    """
+    if baseline is None:
+        baseline = DEFAULT_POLLING_FREQ
+    if messages > 0 or in_flight > 0 or machines <= 0 or requests <= 0:
+        return baseline
+    sample = requests / machines
+    return baseline + BASELINE_WEIGHT * (sample - baseline)
+
+
+def get_baselines():
+    """
+    Learned baselines keyed by workerset stack name, persisted as JSON in the
+    parameter named by the BaselineParameter variable. Without it, every worker
+    set starts from the default on each invocation.
+    """
+    if "BaselineParameter" not in os.environ:
+        return {}
+    response = SSM.get_parameter(Name=os.environ["BaselineParameter"])
+    return json.loads(response["Parameter"]["Value"])
+
+
+def put_baselines(baselines):
+    if "BaselineParameter" not in os.environ:
         return
+    SSM.put_parameter(
+        Name=os.environ["BaselineParameter"],
+        Value=json.dumps(baselines, sort_keys=True),
+        Overwrite=True,
+    )
 
-    logging.info("L=%s", load)
-    put_metric(timestamp, load)
 
+def desired_capacity(messages, in_flight, slots, machines):
+    """
+    Number of instances whose task slots fit every visible and in-flight message.
+    Scaling out reaches that number in one step, while scaling in gives up at
+    most one of the machines currently in service per evaluation.
+    """
+    capacity = math.ceil((messages + in_flight) / slots)
+    if capacity < machines:
+        capacity = max(capacity, math.ceil(machines) - 1)
+    return capacity
 
-def get_metrics(timestamp):
-    queue = os.environ["QueueName"]
-    group = os.environ["GroupName"]
-    response = CW.get_metric_data(
-        StartTime=timestamp,
-        EndTime=timestamp + datetime.timedelta(minutes=1),
-        ScanBy="TimestampAscending",
-        MetricDataQueries=[
-            {
-                "Id": "maxANOMV",
-                "MetricStat": {
-                    "Metric": {
-                        "Namespace": "AWS/SQS",
-                        "MetricName": "ApproximateNumberOfMessagesVisible",
-                        "Dimensions": [{"Name": "QueueName", "Value": f"{queue}"}],
-                    },
-                    "Period": 60,
-                    "Stat": "Maximum",
-                    "Unit": "Count",
+
+def get_worker_sets(event):
+    """
+    Worker sets are listed in the WorkerSets key of the scheduled event, the
+    constant input of the rule, as an array of objects with the QueueName,
+    GroupName and StackName keys, plus the optional ScalingMode, WorkerSlots,
+    FastScaling, Broker and LoadFormula keys. Lambda caps the environment at 4 KB,
+    which a dozen worker sets outgrow. Without it, a single worker set is read
+    from the variables of the same names.
+    """
+    if event and "WorkerSets" in event:
+        return event["WorkerSets"]
+    keys = (
+        "QueueName",
+        "GroupName",
+        "StackName",
+        "ScalingMode",
+        "WorkerSlots",
+        "Broker",
+        "LoadFormula",
+    )
+    return [{key: os.environ[key] for key in keys if key in os.environ}]
+
+
+def scales_capacity(worker_set):
+    return worker_set.get("ScalingMode", "ClusterLoad") == "DesiredCapacity"
+
+
+def scales_fast(worker_set):
+    # The queues of a Redis broker are only read by the scheduler
+    return worker_set.get("FastScaling", "False") == "True" and not redis_broker(
+        worker_set
+    )
+
+
+def redis_broker(worker_set):
+    return worker_set.get("Broker", "SQS") == "Redis"
+
+
+def counts_empty_receives(worker_set):
+    """
+    Whether the load of the worker set is measured by the empty receives of its
+    idle workers, which only short or briefly polling workers make in numbers.
+    """
+    formula = worker_set.get("LoadFormula", "EmptyReceives")
+    return formula == "EmptyReceives" and not redis_broker(worker_set)
+
+
+def metric_queries(worker_set):
+    queue = worker_set["QueueName"]
+    group = worker_set["GroupName"]
+    stack = worker_set["StackName"]
+    if redis_broker(worker_set):
+        return redis_metric_queries(queue, group, stack)
+    return {
+        "maxANOMV": {
+            "MetricStat": {
+                "Metric": {
+                    "Namespace": "AWS/SQS",
+                    "MetricName": "ApproximateNumberOfMessagesVisible",
+                    "Dimensions": [{"Name": "QueueName", "Value": f"{queue}"}],
                 },
+                "Period": 60,
+                "Stat": "Maximum",
+                "Unit": "Count",
             },
-            {
-                "Id": "sumNOER",
-                "MetricStat": {
-                    "Metric": {
-                        "Namespace": "AWS/SQS",
-                        "MetricName": "NumberOfEmptyReceives",
-                        "Dimensions": [{"Name": "QueueName", "Value": f"{queue}"}],
-                    },
-                    "Period": 60,
-                    "Stat": "Sum",
-                    "Unit": "Count",
+        },
+        "sumNOER": {
+            "MetricStat": {
+                "Metric": {
+                    "Namespace": "AWS/SQS",
+                    "MetricName": "NumberOfEmptyReceives",
+                    "Dimensions": [{"Name": "QueueName", "Value": f"{queue}"}],
                 },
+                "Period": 60,
+                "Stat": "Sum",
+                "Unit": "Count",
             },
-            {
-                "Id": "avgGISI",
-                "MetricStat": {
-                    "Metric": {
-                        "Namespace": "AWS/AutoScaling",
-                        "MetricName": "GroupInServiceInstances",
-                        "Dimensions": [
-                            {"Name": "AutoScalingGroupName", "Value": f"{group}"}
-                        ],
-                    },
-                    "Period": 60,
-                    "Stat": "Average",
-                    "Unit": "None",
+        },
+        "maxANOMNV": {
+            "MetricStat": {
+                "Metric": {
+                    "Namespace": "AWS/SQS",
+                    "MetricName": "ApproximateNumberOfMessagesNotVisible",
+                    "Dimensions": [{"Name": "QueueName", "Value": f"{queue}"}],
                 },
+                "Period": 60,
+                "Stat": "Maximum",
+                "Unit": "Count",
             },
-        ],
+        },
+        "avgGISI": {
+            "MetricStat": {
+                "Metric": {
+                    "Namespace": "AWS/AutoScaling",
+                    "MetricName": "GroupInServiceInstances",
+                    "Dimensions": [
+                        {"Name": "AutoScalingGroupName", "Value": f"{group}"}
+                    ],
+                },
+                "Period": 60,
+                "Stat": "Average",
+                "Unit": "None",
+            },
+        },
+        "avgCL": {
+            "MetricStat": {
+                "Metric": {
+                    "Namespace": "Turbine",
+                    "MetricName": "ClusterLoad",
+                    "Dimensions": [{"Name": "StackName", "Value": f"{stack}"}],
+                },
+                "Period": 60,
+                "Stat": "Average",
+                "Unit": "None",
+            },
+        },
+    }
+
+
+def redis_metric_queries(queue, group, stack):
+    """
+    The queue inputs of a Redis broker, from the metrics the scheduler publishes
+    with airflow_queue_depth.py. There are no empty receives to query.
+    """
+    queries = metric_queries(
+        {"QueueName": queue, "GroupName": group, "StackName": stack}
     )
+    del queries["sumNOER"]
+    for name, metric_name in (
+        ("maxANOMV", "QueueMessagesVisible"),
+        ("maxANOMNV", "QueueMessagesInFlight"),
+    ):
+        metric = queries[name]["MetricStat"]["Metric"]
+        metric["Namespace"] = "Turbine"
+        metric["MetricName"] = metric_name
+    return queries
+
+
+def get_metrics(minutes, worker_sets):
+    """
+    Fetches the inputs and the published ClusterLoad of every worker set over the
+    given minutes with a single batched query, and returns them in the same order
+    as worker_sets, as dicts of datapoints by timestamp keyed by input name.
+    """
+    queries = []
+    inputs = {}
+    for index, worker_set in enumerate(worker_sets):
+        for name, query in metric_queries(worker_set).items():
+            query["Id"] = f"{name}{index}"
+            inputs[query["Id"]] = (index, name)
+            queries.append(query)
+
+    metrics = [{name: {} for name in metric_queries(ws)} for ws in worker_sets]
+    kwargs = {}
+    while True:
+        response = CW.get_metric_data(
+            StartTime=minutes[0],
+            EndTime=minutes[-1] + datetime.timedelta(minutes=1),
+            ScanBy="TimestampAscending",
+            MetricDataQueries=queries,
+            **kwargs,
+        )
+        for m in response["MetricDataResults"]:
+            index, name = inputs[m["Id"]]
+            metrics[index][name].update(zip(m["Timestamps"], m["Values"]))
+        if "NextToken" not in response:
+            break
+        kwargs = {"NextToken": response["NextToken"]}
+    return metrics
+
+
+def idle_inputs(worker_set):
+    """
+    The inputs of the worker set read as 0 when they have no datapoint at all.
+    SQS publishes no metrics for an inactive queue, while the queue metrics of a
+    Redis broker are published every minute by the scheduler, so missing ones
+    mean the publisher is down and are left out. Only the empty receives, not
+    queried for a Redis broker, read as 0 then.
+    """
+    if redis_broker(worker_set):
+        return ("sumNOER",)
+    return QUEUE_INPUTS
+
+
+def fill_window(series, minutes, idle=QUEUE_INPUTS):
+    """
+    Inputs of every minute, carrying the last datapoint forward over gaps of up
+    to MAX_GAP minutes. The idle inputs without any datapoint read as 0, the
+    others are None where no datapoint is available.
+    """
+    max_gap = datetime.timedelta(minutes=MAX_GAP)
+    window = [{} for _ in minutes]
+    for name in INPUTS:
+        datapoints = series.get(name, {})
+        default = 0.0 if name in idle and not datapoints else None
+        last = None
+        for inputs, minute in zip(window, minutes):
+            if minute in datapoints:
+                last = minute
+            if last is not None and minute - last <= max_gap:
+                inputs[name] = datapoints[last]
+            else:
+                inputs[name] = default
+    return window
+
+
+def metric_datum(name, stack, timestamp, value, unit="None"):
     return {
-        m["Id"]: dict(zip(m["Timestamps"], m["Values"]))[timestamp]
-        for m in response["MetricDataResults"]
+        "MetricName": name,
+        "Dimensions": [{"Name": "StackName", "Value": stack}],
+        "Timestamp": timestamp,
+        "Value": value,
+        "Unit": unit,
     }
 
 
-def put_metric(time, value):
-    CW.put_metric_data(
-        Namespace="Turbine",
-        MetricData=[
+def emits_emf():
+    return os.environ.get("MetricOutput", "api") == "emf"
+
+
+def publish_metrics(metric_data):
+    """
+    Publishes with PutMetricData, or as embedded metric format log lines when the
+    MetricOutput variable is emf.
+    """
+    if emits_emf():
+        emit_metrics(metric_data)
+    else:
+        put_metrics(metric_data)
+
+
+def emit_metrics(metric_data):
+    """
+    Prints one embedded metric format record per stack and timestamp, which
+    CloudWatch Logs extracts into the Turbine namespace without any API call.
+    https://docs.aws.amazon.com/AmazonCloudWatch/latest/monitoring/CloudWatch_Embedded_Metric_Format_Specification.html
+    """
+    records = {}
+    for datum in metric_data:
+        stack = datum["Dimensions"][0]["Value"]
+        resolution = datum.get("StorageResolution", 60)
+        key = (stack, datum["Timestamp"], resolution)
+        if key not in records:
+            records[key] = {
+                "_aws": {
+                    "Timestamp": int(datum["Timestamp"].timestamp() * 1000),
+                    "CloudWatchMetrics": [
+                        {
+                            "Namespace": "Turbine",
+                            "Dimensions": [["StackName"]],
+                            "Metrics": [],
+                        }
+                    ],
+                },
+                "StackName": stack,
+            }
+        record = records[key]
+        record["_aws"]["CloudWatchMetrics"][0]["Metrics"].append(
             {
-                "MetricName": "ClusterLoad",
-                "Dimensions": [{"Name": "StackName", "Value": os.environ["StackName"]}],
-                "Timestamp": time,
-                "Value": value,
-                "Unit": "None",
+                "Name": datum["MetricName"],
+                "Unit": datum["Unit"],
+                "StorageResolution": resolution,
             }
-        ],
-    )
+        )
+        record[datum["MetricName"]] = datum["Value"]
+    for record in records.values():
+        print(json.dumps(record))
+
+
+def put_metrics(metric_data):
+    while metric_data:
+        CW.put_metric_data(
+            Namespace="Turbine",
+            MetricData=metric_data[:MAX_METRIC_DATA],
+        )
+        metric_data = metric_data[MAX_METRIC_DATA:]
+
+
+def set_desired_capacities(capacities):
+    """
+    Applies the desired capacities, keyed by AutoScaling group name, within the
+    bounds of each group. Groups already at their desired capacity are left alone.
+    """
+    if not capacities:
+        return
+    paginator = AS.get_paginator("describe_auto_scaling_groups")
+    pages = paginator.paginate(AutoScalingGroupNames=list(capacities))
+    for page in pages:
+        for group in page["AutoScalingGroups"]:
+            name = group["AutoScalingGroupName"]
+            capacity = min(max(capacities[name], group["MinSize"]), group["MaxSize"])
+            if capacity == group["DesiredCapacity"]:
+                continue
+            logging.info(
+                "[%s] desired capacity %s -> %s",
+                name,
+                group["DesiredCapacity"],
+                capacity,
+            )
+            AS.set_desired_capacity(
+                AutoScalingGroupName=name,
+                DesiredCapacity=capacity,
+                HonorCooldown=False,
+            )
+
+
+def in_service_instances(groups):
+    """
+    Number of InService instances of each AutoScaling group, keyed by group name.
+    """
+    machines = dict.fromkeys(groups, 0)
+    paginator = AS.get_paginator("describe_auto_scaling_groups")
+    for page in paginator.paginate(AutoScalingGroupNames=groups):
+        for group in page["AutoScalingGroups"]:
+            machines[group["AutoScalingGroupName"]] = sum(
+                instance["LifecycleState"] == "InService"
+                for instance in group["Instances"]
+            )
+    return machines
+
+
+def account_id(context):
+    # arn:aws:lambda:region:account-id:function:name
+    return context.invoked_function_arn.split(":")[4]
+
+
+def sqs_queue_url(queue, account):
+    region = os.environ["AWS_REGION"]
+    return f"https://sqs.{region}.amazonaws.com/{account}/{queue}"
+
+
+def sample_fast_load(worker_sets, account):
+    """
+    Samples the queue attributes of the worker sets every FAST_PERIOD seconds
+    and publishes their occupancy load as a high resolution ClusterLoad metric,
+    with a single PutMetricData call per sample.
+    """
+    groups = [ws["GroupName"] for ws in worker_sets]
+    queue_urls = [sqs_queue_url(ws["QueueName"], account) for ws in worker_sets]
+    start = time.monotonic()
+    for sample in range(FAST_SAMPLES):
+        delay = start + sample * FAST_PERIOD - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+        timestamp = datetime.datetime.now(datetime.timezone.utc)
+        machines = in_service_instances(groups)
+        metric_data = []
+        for worker_set, queue_url in zip(worker_sets, queue_urls):
+            stack = worker_set["StackName"]
+            attributes = SQS.get_queue_attributes(
+                QueueUrl=queue_url,
+                AttributeNames=[
+                    "ApproximateNumberOfMessages",
+                    "ApproximateNumberOfMessagesNotVisible",
+                ],
+            )["Attributes"]
+            messages = int(attributes["ApproximateNumberOfMessages"])
+            in_flight = int(attributes["ApproximateNumberOfMessagesNotVisible"])
+            slots = int(worker_set.get("WorkerSlots", 16))
+            load = occupancy_load(
+                messages, in_flight, slots, machines[worker_set["GroupName"]]
+            )
+            logging.debug(
+                "[%s] sample %s: ANOM=%s ANOMNV=%s L=%s",
+                stack,
+                sample,
+                messages,
+                in_flight,
+                load,
+            )
+            if load is not None:
+                datum = metric_datum("ClusterLoad", stack, timestamp, load)
+                datum["StorageResolution"] = 1
+                metric_data.append(datum)
+        publish_metrics(metric_data)
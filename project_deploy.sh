@@ -75,6 +75,10 @@ aws s3 cp load_metric.zip s3://${DEPLOY_BUCKET}/${TURBINE_PREFIX}functions/packa
 echo "UPLOADING SCRIPTS HERE"
 aws s3 cp scripts/ s3://${DEPLOY_BUCKET}/${TURBINE_PREFIX}scripts --recursive ${PROFILE_OPT}
 echo "FINISHED UPLOADING SCRIPTS HERE"
+# Upload the prebuilt python wheels, if built with `make wheelhouse`
+if [[ -f wheelhouse/wheelhouse.tar.gz ]]; then
+    aws s3 cp wheelhouse/wheelhouse.tar.gz s3://${DEPLOY_BUCKET}/${TURBINE_PREFIX}wheelhouse/wheelhouse.tar.gz ${PROFILE_OPT}
+fi
 
 # upload vpc script
 aws s3 cp submodules/quickstart-aws-vpc/templates/aws-vpc.template s3://${DEPLOY_BUCKET}/${TURBINE_PREFIX}submodules/quickstart-aws-vpc/templates/aws-vpc.template ${PROFILE_OPT}
@@ -0,0 +1,5 @@
+#!/bin/bash -e
+# Mirrors the DAG folder on EFS to the local disk. Only the files whose size or
+# mtime changed are copied, and --delay-updates moves them all in place at the
+# end, so that a DAG parse sees either the previous or the new set of files.
+rsync -a --delete --delay-updates "/mnt/efs/${EFS_DAGS_FOLDER}/" "${DAGS_MIRROR}/"
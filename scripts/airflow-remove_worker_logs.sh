@@ -1,2 +0,0 @@
-#!/bin/bash -e
-find /airflow/logs/ -type f -mtime +"$REMOVE_LOGS_OLDER_THAN_X_DAYS" -name "*.log" -exec rm -rf {} \;
\ No newline at end of file
@@ -0,0 +1,186 @@
+"""
+Keeps the DAG folder of the node on the DAG bundle last published to the
+deployments bucket, checked every PERIOD seconds.
+
+A bundle is published under the bundles/ prefix as content-addressed objects:
+
+- blobs/<sha256>, the content of every file, uploaded once
+- manifests/<version>.json, the path, hash and mode of every file of a version,
+  named after the hash of its own content
+- current, the version to run, written last
+
+Only the blobs the node does not hold yet are downloaded, in parallel, and
+checked against their hash. The version is then laid out as hard links to the
+blobs in its own directory and the current symlink is flipped to it with a
+rename, so that Airflow sees either the previous or the new version as a whole
+and no service needs a restart. The KEEP_VERSIONS last versions are kept for the
+tasks still running from them, and the blobs no version links are removed.
+
+Runs as airflow-bundle-sync.service, the setup of the node runs it once with
+--once before Airflow starts.
+"""
+import concurrent.futures
+import hashlib
+import json
+import logging
+import os
+import shutil
+import sys
+import time
+
+import boto3
+import botocore.exceptions
+
+S3 = boto3.client("s3")
+logging.basicConfig(level=os.environ.get("LOGLEVEL", logging.INFO))
+
+PERIOD = 15
+PREFIX = "bundles/"
+BUNDLES = "/var/lib/airflow/bundles"
+DOWNLOAD_WORKERS = 16
+KEEP_VERSIONS = 3
+
+
+def main():
+    etag = sync()
+    if sys.argv[1:] == ["--once"]:
+        return
+    while True:
+        time.sleep(PERIOD)
+        etag = sync(etag)
+
+
+def sync(etag=None):
+    """
+    Switches to the current version of the bundle if it changed since the given
+    ETag of the current object, and returns its new ETag
+    """
+    bucket = os.environ["DEPLOYMENTS_BUCKET"]
+    try:
+        response = S3.get_object(
+            Bucket=bucket,
+            Key=PREFIX + "current",
+            **({"IfNoneMatch": etag} if etag else {})
+        )
+    except botocore.exceptions.ClientError as error:
+        code = error.response["Error"]["Code"]
+        if code in ("304", "NotModified"):
+            return etag
+        if code == "NoSuchKey":
+            logging.info("no DAG bundle published to %s yet", bucket)
+            return None
+        raise
+    version = response["Body"].read().decode().strip()
+    if current_version() != version:
+        start = time.monotonic()
+        key = PREFIX + "manifests/" + version + ".json"
+        manifest = json.loads(S3.get_object(Bucket=bucket, Key=key)["Body"].read())
+        fetched = fetch_blobs(bucket, manifest["files"])
+        switch(layout(version, manifest["files"]))
+        logging.info(
+            "switched to version %s, %s of %s files fetched in %.1f seconds",
+            version,
+            fetched,
+            len(manifest["files"]),
+            time.monotonic() - start,
+        )
+        collect_garbage()
+    return response["ETag"]
+
+
+def current_version():
+    try:
+        return os.path.basename(os.readlink(os.path.join(BUNDLES, "current")))
+    except OSError:
+        return None
+
+
+def blob_path(entry):
+    """The local blob of a file, per mode as the hard links to it share it"""
+    return os.path.join(
+        BUNDLES, "blobs", "{}.{:o}".format(entry["sha256"], entry["mode"])
+    )
+
+
+def fetch_blobs(bucket, files):
+    """Downloads the blobs missing locally in parallel, returns how many there were"""
+    missing = {
+        blob_path(entry): entry
+        for entry in files.values()
+        if not os.path.exists(blob_path(entry))
+    }
+    os.makedirs(os.path.join(BUNDLES, "blobs"), exist_ok=True)
+    with concurrent.futures.ThreadPoolExecutor(DOWNLOAD_WORKERS) as executor:
+        for future in [
+            executor.submit(fetch_blob, bucket, path, entry)
+            for path, entry in missing.items()
+        ]:
+            future.result()
+    return len(missing)
+
+
+def fetch_blob(bucket, path, entry):
+    body = S3.get_object(Bucket=bucket, Key=PREFIX + "blobs/" + entry["sha256"])["Body"]
+    digest = hashlib.sha256()
+    with open(path + ".tmp", "wb") as blob:
+        for chunk in iter(lambda: body.read(1 << 20), b""):
+            digest.update(chunk)
+            blob.write(chunk)
+    if digest.hexdigest() != entry["sha256"]:
+        os.remove(path + ".tmp")
+        raise ValueError("blob {} does not match its hash".format(entry["sha256"]))
+    os.chmod(path + ".tmp", entry["mode"])
+    os.rename(path + ".tmp", path)
+
+
+def layout(version, files):
+    """Lays the files of a version out as hard links to their blobs"""
+    target = os.path.join(BUNDLES, "versions", version)
+    if os.path.isdir(target):
+        return target
+    shutil.rmtree(target + ".tmp", ignore_errors=True)
+    for relative, entry in files.items():
+        path = os.path.join(target + ".tmp", relative)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.link(blob_path(entry), path)
+    os.makedirs(target + ".tmp", exist_ok=True)
+    os.rename(target + ".tmp", target)
+    return target
+
+
+def switch(target):
+    """Points the current symlink at the target with an atomic rename"""
+    link = os.path.join(BUNDLES, "current")
+    if os.path.lexists(link + ".tmp"):
+        os.remove(link + ".tmp")
+    os.symlink(os.path.relpath(target, BUNDLES), link + ".tmp")
+    os.replace(link + ".tmp", link)
+    # Keeps the order of the versions by when they were switched to
+    os.utime(target)
+
+
+def collect_garbage():
+    """Removes the older versions, then the blobs no version links anymore"""
+    versions = os.path.join(BUNDLES, "versions")
+    current = current_version()
+    older = sorted(
+        (
+            name
+            for name in os.listdir(versions)
+            if name != current and not name.endswith(".tmp")
+        ),
+        key=lambda name: os.path.getmtime(os.path.join(versions, name)),
+        reverse=True,
+    )
+    keep = KEEP_VERSIONS - 1
+    for name in older[keep:]:
+        shutil.rmtree(os.path.join(versions, name))
+    blobs = os.path.join(BUNDLES, "blobs")
+    for name in os.listdir(blobs):
+        path = os.path.join(blobs, name)
+        if os.stat(path).st_nlink == 1:
+            os.remove(path)
+
+
+if __name__ == "__main__":
+    main()
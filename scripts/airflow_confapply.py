@@ -0,0 +1,250 @@
+"""
+Applies the changes of the Airflow environment files to the services of the
+node, restarting only the services whose configuration changed.
+
+The variables of the environment files are grouped by configuration section,
+AIRFLOW__<SECTION>__<KEY> in <section> and any other variable in environment,
+and every section is hashed. As a service starts, it records the hashes of the
+sections it reads in STATE_DIR. Once airflow-confapply-agent.path sees an
+environment file change, the running services whose recorded hashes differ
+from the current ones are restarted one at a time. A worker stops with a warm
+shutdown, finishing its running tasks without taking new ones, before it starts
+again, and takes nothing from the queue until then.
+
+On the instances of a workerset, whose stack has a RestartLock table, the
+restarts only start once the instance holds one of the CONFAPPLY_MAX_UNAVAILABLE
+slots of the lock, and it keeps it until the last of its services started again.
+The instances of a workerset therefore roll through a change, at most that many
+of them restarting at a time. A slot is leased for LOCK_LEASE seconds and renewed
+while it is held, so the slot of an instance that went away frees itself.
+
+Runs as airflow-confapply-agent.service with the node metadata in its
+environment, and with --started <unit> as the ExecStartPost of the services.
+"""
+import contextlib
+import hashlib
+import json
+import logging
+import os
+import subprocess
+import sys
+import threading
+import time
+
+import boto3
+import botocore.exceptions
+
+DYNAMODB = boto3.client("dynamodb")
+logging.basicConfig(level=os.environ.get("LOGLEVEL", logging.INFO))
+
+STATE_DIR = "/run/airflow/confapply"
+DEFAULT_MAX_UNAVAILABLE = 1
+# Seconds a slot of the restart lock is held without a renewal, renewed every
+# third of it
+LOCK_LEASE = 300
+# Seconds between attempts to take a slot while all of them are held
+LOCK_WAIT = 30
+LOCK_ATTRIBUTES = {"#slot": "Slot", "#owner": "Owner", "#expires": "Expires"}
+# The environment file of every service, in the order they are restarted
+UNITS = {
+    "airflow-scheduler": "/etc/sysconfig/airflow.env",
+    "airflow-webserver": "/etc/sysconfig/airflow.env",
+    "airflow-workerset": "/etc/sysconfig/airflow.env",
+    "airflow-workerset-small": "/etc/sysconfig/airflow-workerset-small.env",
+    "airflow-log-housekeeping": "/etc/sysconfig/airflow.env",
+    "airflow-queue-depth": "/etc/sysconfig/airflow.env",
+}
+CELERY_UNITS = (
+    "airflow-scheduler",
+    "airflow-workerset",
+    "airflow-workerset-small",
+    "airflow-queue-depth",
+)
+# Sections only some of the services read, every other section is read by all
+SECTION_UNITS = {
+    "scheduler": ("airflow-scheduler",),
+    "webserver": ("airflow-webserver",),
+    "celery": CELERY_UNITS,
+    "celery_broker_transport_options": CELERY_UNITS,
+}
+
+
+def main():
+    if sys.argv[1:2] == ["--started"]:
+        record(sys.argv[2])
+        return
+    apply(
+        os.environ.get("RESTART_LOCK_TABLE"),
+        os.environ.get("EC2_INSTANCE_ID"),
+        int(os.environ.get("CONFAPPLY_MAX_UNAVAILABLE", DEFAULT_MAX_UNAVAILABLE)),
+    )
+
+
+def apply(lock_table=None, instance_id=None, max_unavailable=DEFAULT_MAX_UNAVAILABLE):
+    """
+    Restarts every running service whose configuration changed, once, holding a
+    slot of the restart lock table if there is one
+    """
+    if not changed_units(set()):
+        return
+    with restart_lock(lock_table, instance_id, max_unavailable):
+        restarted = set()
+        while True:
+            changed = changed_units(restarted)
+            if not changed:
+                return
+            unit = changed[0]
+            logging.info(
+                "restarting %s for %s", unit, ", ".join(changed_sections(unit))
+            )
+            if subprocess.run(["systemctl", "restart", unit]).returncode != 0:
+                logging.warning("%s did not restart", unit)
+            restarted.add(unit)
+
+
+def changed_units(restarted):
+    return [
+        unit
+        for unit in UNITS
+        if unit not in restarted and is_active(unit) and changed_sections(unit)
+    ]
+
+
+@contextlib.contextmanager
+def restart_lock(table, owner, slots):
+    """Holds a slot of the restart lock table, renewing its lease, if there is one"""
+    if not table:
+        yield
+        return
+    slot = take_slot(table, owner, slots)
+    released = threading.Event()
+    renewer = threading.Thread(
+        target=renew_slot, args=(table, slot, owner, released), daemon=True
+    )
+    renewer.start()
+    try:
+        yield
+    finally:
+        released.set()
+        renewer.join()
+        release_slot(table, slot, owner)
+
+
+def take_slot(table, owner, slots):
+    """Takes the first free or expired slot, waiting for one"""
+    while True:
+        for slot in map(str, range(slots)):
+            now = int(time.time())
+            try:
+                DYNAMODB.put_item(
+                    TableName=table,
+                    Item={
+                        "Slot": {"S": slot},
+                        "Owner": {"S": owner},
+                        "Expires": {"N": str(now + LOCK_LEASE)},
+                    },
+                    ConditionExpression=(
+                        "attribute_not_exists(#slot) OR #expires < :now"
+                        " OR #owner = :owner"
+                    ),
+                    ExpressionAttributeNames=LOCK_ATTRIBUTES,
+                    ExpressionAttributeValues={
+                        ":now": {"N": str(now)},
+                        ":owner": {"S": owner},
+                    },
+                )
+            except botocore.exceptions.ClientError as error:
+                if error.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                    raise
+                continue
+            logging.info("took slot %s of the restart lock %s", slot, table)
+            return slot
+        logging.info("waiting for a free slot of the restart lock %s", table)
+        time.sleep(LOCK_WAIT)
+
+
+def renew_slot(table, slot, owner, released):
+    while not released.wait(LOCK_LEASE / 3):
+        try:
+            DYNAMODB.update_item(
+                TableName=table,
+                Key={"Slot": {"S": slot}},
+                UpdateExpression="SET #expires = :expires",
+                ConditionExpression="#owner = :owner",
+                ExpressionAttributeNames={"#expires": "Expires", "#owner": "Owner"},
+                ExpressionAttributeValues={
+                    ":expires": {"N": str(int(time.time()) + LOCK_LEASE)},
+                    ":owner": {"S": owner},
+                },
+            )
+        except botocore.exceptions.ClientError:
+            logging.exception("could not renew slot %s of the restart lock", slot)
+
+
+def release_slot(table, slot, owner):
+    try:
+        DYNAMODB.delete_item(
+            TableName=table,
+            Key={"Slot": {"S": slot}},
+            ConditionExpression="#owner = :owner",
+            ExpressionAttributeNames={"#owner": "Owner"},
+            ExpressionAttributeValues={":owner": {"S": owner}},
+        )
+    except botocore.exceptions.ClientError:
+        logging.exception("could not release slot %s of the restart lock", slot)
+
+
+def is_active(unit):
+    return subprocess.run(["systemctl", "is-active", "--quiet", unit]).returncode == 0
+
+
+def changed_sections(unit):
+    """The sections read by the unit that changed since it started"""
+    try:
+        with open(os.path.join(STATE_DIR, unit + ".json")) as state:
+            started = json.load(state)
+    except (OSError, ValueError):
+        started = {}
+    current = section_hashes(unit)
+    return sorted(
+        section
+        for section in set(started) | set(current)
+        if started.get(section) != current.get(section)
+    )
+
+
+def record(unit):
+    """Records the hashes of the sections the unit started with"""
+    path = os.path.join(STATE_DIR, unit + ".json")
+    os.makedirs(STATE_DIR, exist_ok=True)
+    with open(path + ".tmp", "w") as state:
+        json.dump(section_hashes(unit), state)
+    os.replace(path + ".tmp", path)
+
+
+def section_hashes(unit):
+    """The hash of every section of the environment file of the unit it reads"""
+    sections = {}
+    with open(UNITS[unit]) as environment:
+        for line in environment:
+            line = line.strip()
+            if not line or line.startswith("#") or "=" not in line:
+                continue
+            section = section_of(line.split("=", 1)[0])
+            if unit in SECTION_UNITS.get(section, (unit,)):
+                sections.setdefault(section, []).append(line)
+    return {
+        section: hashlib.sha256("\n".join(sorted(lines)).encode()).hexdigest()
+        for section, lines in sections.items()
+    }
+
+
+def section_of(variable):
+    parts = variable.split("__")
+    if parts[0] == "AIRFLOW" and len(parts) == 3:
+        return parts[1].lower()
+    return "environment"
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+"""
+Waits for the instance to be terminated by its AutoScaling group and drains its
+worker before completing the terminating lifecycle action.
+
+The terminating lifecycle hook of the workerset holds the instance in the
+Terminating:Wait state, which the instance metadata reports as the Terminated
+target lifecycle state. The agent reads it every few seconds, which costs no API
+call, so the drain starts within seconds of the termination.
+
+To drain, the worker is stopped from taking tasks and the airflow run processes
+of its running tasks are counted. The lifecycle action is kept alive with
+heartbeats only while there are any, and completed as soon as the last one exits.
+
+Runs as airflow-lifecycle-agent.service with the node metadata in its environment.
+"""
+import logging
+import os
+import subprocess
+import time
+import urllib.request
+
+import boto3
+
+AS = boto3.client("autoscaling")
+logging.basicConfig(level=os.environ.get("LOGLEVEL", logging.INFO))
+
+IMDS = "http://169.254.169.254/latest"
+# Seconds between reads of the target lifecycle state
+POLL_PERIOD = 5
+# Seconds between counts of the running tasks while draining
+DRAIN_PERIOD = 5
+# Seconds between heartbeats of the lifecycle action, well within the 180 seconds
+# of HeartbeatTimeout of the hook
+HEARTBEAT_PERIOD = 60
+
+
+def main():
+    instance_id = os.environ["EC2_INSTANCE_ID"]
+    logging.info("waiting for the termination of %s", instance_id)
+    while target_lifecycle_state() != "Terminated":
+        time.sleep(POLL_PERIOD)
+    logging.info("instance metadata reports the instance is terminating")
+    drain(instance_id)
+
+
+def imds(path):
+    """Reads a path of the instance metadata with an IMDSv2 token, or None"""
+    try:
+        request = urllib.request.Request(
+            IMDS + "/api/token",
+            method="PUT",
+            headers={"X-aws-ec2-metadata-token-ttl-seconds": "60"},
+        )
+        token = urllib.request.urlopen(request, timeout=2).read().decode()
+        request = urllib.request.Request(
+            IMDS + "/" + path, headers={"X-aws-ec2-metadata-token": token}
+        )
+        return urllib.request.urlopen(request, timeout=2).read().decode()
+    except OSError:
+        return None
+
+
+def target_lifecycle_state():
+    return imds("meta-data/autoscaling/target-lifecycle-state")
+
+
+def drain(instance_id):
+    """
+    Stops the worker from taking tasks, then waits for its running tasks with
+    heartbeats of the lifecycle action and completes it once they are done
+    """
+    action = {
+        "LifecycleHookName": os.environ["SHUTDOWN_LIFECYCLE_NAME"],
+        "AutoScalingGroupName": os.environ["AUTO_SCALING_GROUP_NAME"],
+        "InstanceId": instance_id,
+    }
+    # Remote control commands such as cancel_consumer are not supported by the SQS
+    # transport, the warm shutdown of the worker also stops it consuming and it
+    # then waits for its running tasks while the unit is deactivating
+    subprocess.run(
+        ["systemctl", "stop", "--no-block", "airflow-workerset"], check=False
+    )
+    heartbeat = time.monotonic()
+    while True:
+        tasks = running_tasks()
+        if not tasks:
+            break
+        if time.monotonic() - heartbeat >= HEARTBEAT_PERIOD:
+            logging.info("%s tasks running, recording a heartbeat", tasks)
+            AS.record_lifecycle_action_heartbeat(**action)
+            heartbeat = time.monotonic()
+        time.sleep(DRAIN_PERIOD)
+    AS.complete_lifecycle_action(LifecycleActionResult="CONTINUE", **action)
+    logging.info("completed the terminating lifecycle action")
+
+
+def running_tasks():
+    count = 0
+    for pid in os.listdir("/proc"):
+        if not pid.isdigit():
+            continue
+        try:
+            with open("/proc/{}/cmdline".format(pid), "rb") as cmdline:
+                args = cmdline.read().decode(errors="replace").split("\0")
+        except OSError:
+            continue
+        if is_task(args):
+            count += 1
+    return count
+
+
+def is_task(args):
+    """
+    Whether a command line is the airflow run of a task instance. Its --raw run,
+    which does the work in a child process, is not counted again.
+    """
+    return (
+        any(arg.endswith("airflow") for arg in args[:2])
+        and "run" in args
+        and "--raw" not in args
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+"""
+Keeps the logs of a node within a budget of its disk, every PERIOD seconds:
+
+- logs older than REMOVE_LOGS_OLDER_THAN_X_DAYS are removed, as they always were
+- finished task logs, not written to for FINISHED_AFTER seconds, are compressed
+  once they are found in the remote log folder, listed once per task directory
+- while the disk holding the logs is used above LOG_DISK_BUDGET_PERCENT, the
+  oldest compressed task logs are evicted, in one batch large enough to get back
+  within the budget
+
+Only logs already in S3 are compressed and evicted, the webserver reads them from
+there. The bytes reclaimed and the disk usage are published as the Turbine
+LogBytesReclaimed and LogDiskUsage metrics of the stack.
+
+Runs as airflow-log-housekeeping.service with the node metadata in its environment.
+"""
+import gzip
+import logging
+import os
+import shutil
+import time
+
+import boto3
+
+S3 = boto3.client("s3")
+CW = boto3.client("cloudwatch")
+logging.basicConfig(level=os.environ.get("LOGLEVEL", logging.INFO))
+
+PERIOD = 300
+FINISHED_AFTER = 600
+DEFAULT_BUDGET_PERCENT = 70
+# Logs of the scheduler and its DAG processor are not sent to the remote log folder
+LOCAL_ONLY = ("scheduler", "dag_processor_manager")
+
+
+def main():
+    while True:
+        housekeep()
+        time.sleep(PERIOD)
+
+
+def housekeep():
+    root = os.path.join(os.environ["AIRFLOW_HOME"], "logs")
+    max_age = int(os.environ.get("REMOVE_LOGS_OLDER_THAN_X_DAYS", 7)) * 86400
+    budget = float(os.environ.get("LOG_DISK_BUDGET_PERCENT", DEFAULT_BUDGET_PERCENT))
+    now = time.time()
+    logs = log_files(root)
+
+    reclaimed = 0
+    for path in [
+        path for path, (mtime, _size) in logs.items() if mtime < now - max_age
+    ]:
+        reclaimed += remove(path, logs)
+
+    finished = [
+        path
+        for path, (mtime, _size) in logs.items()
+        if path.endswith(".log")
+        and mtime < now - FINISHED_AFTER
+        and os.path.relpath(path, root).split(os.sep)[0] not in LOCAL_ONLY
+    ]
+    uploaded = remote_logs(root, {os.path.dirname(path) for path in finished})
+    for path in finished:
+        if uploaded.get(os.path.relpath(path, root), -1) >= logs[path][1]:
+            reclaimed += compress(path, logs)
+
+    usage = disk_usage(root)
+    if usage.used > usage.total * budget / 100:
+        excess = usage.used - usage.total * budget / 100
+        for path in eviction_batch(logs, excess):
+            reclaimed += remove(path, logs)
+        usage = disk_usage(root)
+    remove_empty_dirs(root, now)
+
+    percent = 100 * usage.used / usage.total
+    logging.info("reclaimed %s bytes, disk used at %.1f%%", reclaimed, percent)
+    publish_metrics(reclaimed, percent)
+
+
+def log_files(root):
+    """The mtime and size of every log under root, by path"""
+    logs = {}
+    for directory, _dirs, files in os.walk(root):
+        for name in files:
+            if name.endswith(".log") or name.endswith(".log.gz"):
+                path = os.path.join(directory, name)
+                stat = os.stat(path)
+                logs[path] = (stat.st_mtime, stat.st_size)
+    return logs
+
+
+def remote_logs(root, directories):
+    """The size of the remote logs of the given local directories, by relative path"""
+    folder = os.environ["AIRFLOW__CORE__REMOTE_BASE_LOG_FOLDER"]
+    bucket, _, base = folder.replace("s3://", "", 1).partition("/")
+    base = base.strip("/")
+    skip = len(base) + 1 if base else 0
+    sizes = {}
+    paginator = S3.get_paginator("list_objects_v2")
+    for directory in directories:
+        relative = os.path.relpath(directory, root).replace(os.sep, "/")
+        prefix = "/".join(part for part in (base, relative) if part) + "/"
+        for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+            for item in page.get("Contents", []):
+                sizes[item["Key"][skip:].replace("/", os.sep)] = item["Size"]
+    return sizes
+
+
+def compress(path, logs):
+    """Compresses a log, keeping its mtime, and returns the bytes saved"""
+    mtime, size = logs.pop(path)
+    with open(path, "rb") as source, gzip.open(path + ".gz.tmp", "wb") as target:
+        shutil.copyfileobj(source, target)
+    os.utime(path + ".gz.tmp", (mtime, mtime))
+    os.rename(path + ".gz.tmp", path + ".gz")
+    os.remove(path)
+    logs[path + ".gz"] = (mtime, os.path.getsize(path + ".gz"))
+    return size - logs[path + ".gz"][1]
+
+
+def eviction_batch(logs, excess):
+    """The oldest compressed logs that add up to at least excess bytes"""
+    batch = []
+    for path in sorted(
+        (path for path in logs if path.endswith(".log.gz")), key=lambda path: logs[path]
+    ):
+        if excess <= 0:
+            break
+        batch.append(path)
+        excess -= logs[path][1]
+    return batch
+
+
+def remove(path, logs):
+    _mtime, size = logs.pop(path)
+    os.remove(path)
+    return size
+
+
+def remove_empty_dirs(root, now):
+    """Removes the directories left empty, unless a task may be about to log in it"""
+    for directory, _dirs, _files in os.walk(root, topdown=False):
+        if (
+            directory != root
+            and not os.listdir(directory)
+            and os.path.getmtime(directory) < now - FINISHED_AFTER
+        ):
+            os.rmdir(directory)
+
+
+def disk_usage(root):
+    return shutil.disk_usage(root)
+
+
+def publish_metrics(reclaimed, percent):
+    dimensions = [{"Name": "StackName", "Value": os.environ["AWS_STACK_NAME"]}]
+    CW.put_metric_data(
+        Namespace="Turbine",
+        MetricData=[
+            {
+                "MetricName": "LogBytesReclaimed",
+                "Dimensions": dimensions,
+                "Value": reclaimed,
+                "Unit": "Bytes",
+            },
+            {
+                "MetricName": "LogDiskUsage",
+                "Dimensions": dimensions,
+                "Value": percent,
+                "Unit": "Percent",
+            },
+        ],
+    )
+
+
+if __name__ == "__main__":
+    main()
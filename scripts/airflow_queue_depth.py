@@ -0,0 +1,101 @@
+"""
+Publishes the depth of the Celery queues on Redis as the Turbine
+QueueMessagesVisible and QueueMessagesInFlight metrics by QueueName, the
+signals the load metric function reads for the worker sets of a Redis broker
+in place of the AWS/SQS metrics, which SQS publishes by itself.
+
+The queues are listed in QUEUE_NAMES, separated by commas, which the setup of
+the scheduler writes from the queues the cluster passes it for every worker set,
+the small worker included. The messages waiting in a queue are the lengths of
+its list per priority, and the messages in flight, taken by a worker but not
+acknowledged yet, are counted by routing key in the unacked hash of the Kombu
+Redis transport. Every SAMPLE_PERIOD seconds the queues are sampled, and every
+PUBLISH_PERIOD seconds the highest of the samples are published, as SQS reports
+the maximum of the minute.
+
+Runs as airflow-queue-depth.service on the scheduler.
+"""
+import json
+import logging
+import os
+import time
+
+import boto3
+import redis
+
+CW = boto3.client("cloudwatch")
+REDIS = redis.Redis.from_url(
+    os.environ.get("AIRFLOW__CELERY__BROKER_URL", "redis://localhost:6379/0")
+)
+logging.basicConfig(level=os.environ.get("LOGLEVEL", logging.INFO))
+
+SAMPLE_PERIOD = 10
+PUBLISH_PERIOD = 60
+# The lists of the priorities of a queue after the first are named
+# <queue>\x06\x16<priority>, as the transport orders them by default
+PRIORITY_SEP = "\x06\x16"
+PRIORITY_STEPS = (3, 6, 9)
+UNACKED = "unacked"
+
+
+def main():
+    while True:
+        start = time.monotonic()
+        peaks = {}
+        while time.monotonic() - start < PUBLISH_PERIOD:
+            for queue, depth in sample(queue_names()).items():
+                peak = peaks.setdefault(queue, [0, 0])
+                peak[0] = max(peak[0], depth[0])
+                peak[1] = max(peak[1], depth[1])
+            time.sleep(SAMPLE_PERIOD)
+        publish(peaks)
+
+
+def queue_names():
+    """The queues of every worker set"""
+    names = os.environ.get("QUEUE_NAMES", "").split(",")
+    return sorted({name.strip() for name in names if name.strip()})
+
+
+def sample(queues):
+    """The waiting and in flight messages of every queue"""
+    in_flight = dict.fromkeys(queues, 0)
+    for _tag, delivery in REDIS.hscan_iter(UNACKED):
+        routing_key = json.loads(delivery)[-1]
+        if routing_key in in_flight:
+            in_flight[routing_key] += 1
+    return {
+        queue: (
+            sum(
+                REDIS.llen(key)
+                for key in [queue]
+                + [queue + PRIORITY_SEP + str(step) for step in PRIORITY_STEPS]
+            ),
+            in_flight[queue],
+        )
+        for queue in queues
+    }
+
+
+def publish(depths):
+    metric_data = []
+    for queue, (messages, in_flight) in sorted(depths.items()):
+        logging.debug("[%s] visible=%s in flight=%s", queue, messages, in_flight)
+        for name, value in (
+            ("QueueMessagesVisible", messages),
+            ("QueueMessagesInFlight", in_flight),
+        ):
+            metric_data.append(
+                {
+                    "MetricName": name,
+                    "Dimensions": [{"Name": "QueueName", "Value": queue}],
+                    "Value": value,
+                    "Unit": "Count",
+                }
+            )
+    if metric_data:
+        CW.put_metric_data(Namespace="Turbine", MetricData=metric_data)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+#!/bin/bash
+# Runs the setup of an instance as a graph of steps. A step is a shell function
+# registered with the steps it depends on:
+#
+#   step NAME FUNCTION [DEPENDENCY...]
+#
+# run_steps starts each step in a background subshell as soon as its
+# dependencies are done, so independent steps overlap. Variables a step sets for
+# the steps after it must be passed on with step_export. The wall time of every
+# step is logged and published as the Turbine BootstrapStepDuration metric of
+# the role, together with the BootstrapDuration of the whole run.
+BOOT_DIR=/var/lib/turbine/bootstrap
+STEP_NAMES=()
+declare -A STEP_FUNCS STEP_DEPS
+
+step() {
+    local NAME=$1 FUNC=$2
+    shift 2
+    STEP_NAMES+=("$NAME")
+    STEP_FUNCS[$NAME]=$FUNC
+    STEP_DEPS[$NAME]="$*"
+}
+
+step_export() {
+    local VAR
+    for VAR in "$@"; do
+        printf 'export %s=%q\n' "$VAR" "${!VAR}" >>"$BOOT_DIR/$STEP_NAME.env"
+    done
+}
+
+elapsed() { awk -v start="$1" -v end="$(date +%s.%N)" 'BEGIN {printf "%.1f", end - start}'; }
+
+start_step() {
+    set -e
+    STEP_NAME=$1
+    local START
+    START=$(date +%s.%N)
+    exec > >(sed -u "s/^/[$STEP_NAME] /") 2>&1
+    echo "Started"
+    "${STEP_FUNCS[$STEP_NAME]}"
+    echo "$STEP_NAME $(elapsed "$START")" >>"$BOOT_DIR/timings"
+    echo "Finished in $(elapsed "$START")s"
+}
+
+run_steps() {
+    local ROLE=$1 NAME DEP READY PID START
+    declare -A PIDS DONE
+    for NAME in "${STEP_NAMES[@]}"; do
+        for DEP in ${STEP_DEPS[$NAME]}; do
+            if [ -z "${STEP_FUNCS[$DEP]}" ]; then
+                echo "Step $NAME depends on unknown step $DEP"
+                return 1
+            fi
+        done
+    done
+
+    rm -rf "$BOOT_DIR" && mkdir -p "$BOOT_DIR" && chmod 700 "$BOOT_DIR"
+    # The time the instance took to boot and get to the setup scripts
+    echo "boot $(cut -d ' ' -f 1 /proc/uptime)" >"$BOOT_DIR/timings"
+    START=$(date +%s.%N)
+    while [ ${#DONE[@]} -lt ${#STEP_NAMES[@]} ]; do
+        for NAME in "${STEP_NAMES[@]}"; do
+            if [ -n "${DONE[$NAME]}" ] || [ -n "${PIDS[$NAME]}" ]; then
+                continue
+            fi
+            READY=true
+            for DEP in ${STEP_DEPS[$NAME]}; do
+                if [ -z "${DONE[$DEP]}" ]; then READY=false; fi
+            done
+            if $READY; then
+                start_step "$NAME" &
+                PIDS[$NAME]=$!
+            fi
+        done
+        if [ ${#PIDS[@]} -eq 0 ]; then
+            echo "The steps left have circular dependencies"
+            return 1
+        fi
+
+        # bash 4.2 of Amazon Linux 2 has no wait -n, so poll for finished steps
+        sleep 0.2
+        for NAME in "${!PIDS[@]}"; do
+            PID=${PIDS[$NAME]}
+            if kill -0 "$PID" 2>/dev/null; then
+                continue
+            fi
+            unset "PIDS[$NAME]"
+            if ! wait "$PID"; then
+                echo "Step $NAME failed"
+                kill "${PIDS[@]}" 2>/dev/null || true
+                return 1
+            fi
+            DONE[$NAME]=true
+            if [ -f "$BOOT_DIR/$NAME.env" ]; then
+                . "$BOOT_DIR/$NAME.env"
+                rm "$BOOT_DIR/$NAME.env"
+            fi
+        done
+    done
+
+    echo "Setup finished in $(elapsed "$START")s, step times:"
+    sort -k 2 -n -r "$BOOT_DIR/timings"
+    publish_step_timings "$ROLE" "$(elapsed "$START")"
+}
+
+publish_step_timings() {
+    local METRIC_DATA
+    METRIC_DATA=$(jq -R -s --arg role "$1" --argjson total "$2" '
+        [split("\n")[] | select(length > 0) | split(" ") | {
+            MetricName: "BootstrapStepDuration",
+            Dimensions: [{Name: "Role", Value: $role}, {Name: "Step", Value: .[0]}],
+            Value: (.[1] | tonumber), Unit: "Seconds"
+        }] + [{
+            MetricName: "BootstrapDuration",
+            Dimensions: [{Name: "Role", Value: $role}],
+            Value: $total, Unit: "Seconds"
+        }]' "$BOOT_DIR/timings")
+    # The timings are informative, failing to publish them must not fail the setup
+    aws cloudwatch put-metric-data --namespace Turbine \
+        --metric-data "$METRIC_DATA" --region "$AWS_REGION" || true
+}
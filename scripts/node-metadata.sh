@@ -0,0 +1,108 @@
+#!/bin/bash
+# Resolves what the node scripts need to know about the instance in one pass:
+# the instance identity from IMDSv2, the outputs of its stack and the database
+# URI from Secrets Manager. node_metadata exports them from the cache file
+# $NODE_METADATA, resolving them again only once it is older than
+# $NODE_METADATA_TTL seconds. The cache keeps the stack name, the secret ARN and
+# the PgBouncer endpoint the setup was given, so the timers can refresh it with
+# their own environment. With a PgBouncer endpoint, the database URI points at
+# it instead of the database.
+NODE_METADATA=/var/lib/turbine/node-metadata.env
+NODE_METADATA_TTL=${NODE_METADATA_TTL:-3600}
+NODE_METADATA_VARS=(
+    AWS_STACK_NAME DB_SECRETS_ARN PGBOUNCER_ENDPOINT
+    AWS_PARTITION AWS_REGION AWS_DEFAULT_REGION AWS_ACCOUNT_ID
+    EC2_INSTANCE_ID EC2_HOSTNAME IAM_ROLE
+    AUTO_SCALING_GROUP_NAME SHUTDOWN_LIFECYCLE_NAME
+    RESTART_LOCK_TABLE
+    DATABASE_URI
+)
+IMDS="http://169.254.169.254/latest"
+
+imds_token() {
+    curl -s -f -X PUT "$IMDS/api/token" \
+        -H "X-aws-ec2-metadata-token-ttl-seconds: 21600"
+}
+
+imds() { curl -s -f -H "X-aws-ec2-metadata-token: $IMDS_TOKEN" "$IMDS/$1"; }
+
+stack_output() {
+    jq -r --arg key "$2" '.[] | select(.OutputKey == $key) | .OutputValue' "$1"
+}
+
+resolve_node_metadata() {
+    local IMDS_TOKEN DOCUMENT WORK STACK_PID SECRET_PID VAR
+    IMDS_TOKEN=$(imds_token) || return 1
+    DOCUMENT=$(imds dynamic/instance-identity/document) || return 1
+    AWS_PARTITION=$(imds meta-data/services/partition) || return 1
+    IAM_ROLE=$(imds meta-data/iam/security-credentials/) || return 1
+    # The public hostname if the instance has a public IPv4, its local one otherwise
+    if ! imds meta-data/public-ipv4 >/dev/null ||
+        ! EC2_HOSTNAME=$(imds meta-data/public-hostname); then
+        EC2_HOSTNAME=$(imds meta-data/local-hostname) || return 1
+    fi
+    AWS_REGION=$(jq -r .region <<<"$DOCUMENT")
+    AWS_DEFAULT_REGION=$AWS_REGION
+    AWS_ACCOUNT_ID=$(jq -r .accountId <<<"$DOCUMENT")
+    EC2_INSTANCE_ID=$(jq -r .instanceId <<<"$DOCUMENT")
+
+    # Both calls start a CLI process of a second or so, run them side by side
+    WORK=$(mktemp -d)
+    aws cloudformation describe-stacks --stack-name "$AWS_STACK_NAME" \
+        --region "$AWS_REGION" --query "Stacks[0].Outputs" --output json >"$WORK/outputs" &
+    STACK_PID=$!
+    if [ -n "$DB_SECRETS_ARN" ]; then
+        aws secretsmanager get-secret-value --secret-id "$DB_SECRETS_ARN" \
+            --region "$AWS_REGION" --query SecretString --output text >"$WORK/secret" &
+        SECRET_PID=$!
+    fi
+    if ! wait "$STACK_PID" || { [ -n "$SECRET_PID" ] && ! wait "$SECRET_PID"; }; then
+        rm -rf "$WORK"
+        return 1
+    fi
+
+    AUTO_SCALING_GROUP_NAME=$(stack_output "$WORK/outputs" AutoScalingGroup)
+    SHUTDOWN_LIFECYCLE_NAME=$(stack_output "$WORK/outputs" GracefulShutdownLifecycleHook)
+    RESTART_LOCK_TABLE=$(stack_output "$WORK/outputs" RestartLock)
+    if [ -n "$SECRET_PID" ]; then
+        DATABASE_URI=$(jq -r --arg pgbouncer "$PGBOUNCER_ENDPOINT" \
+            '"\(.engine)://\(.username):\(.password)@\(if $pgbouncer != "" then $pgbouncer else "\(.host):\(.port)" end)/\(.dbname)"' \
+            "$WORK/secret")
+    fi
+    rm -rf "$WORK"
+
+    mkdir -p "$(dirname "$NODE_METADATA")" && rm -f "$NODE_METADATA.tmp"
+    (
+        umask 077
+        {
+            echo "NODE_METADATA_EXPIRES=$(($(date +%s) + NODE_METADATA_TTL))"
+            for VAR in "${NODE_METADATA_VARS[@]}"; do
+                printf 'export %s=%q\n' "$VAR" "${!VAR}"
+            done
+        } >"$NODE_METADATA.tmp"
+    ) && mv "$NODE_METADATA.tmp" "$NODE_METADATA"
+}
+
+node_metadata() {
+    if [ -f "$NODE_METADATA" ]; then
+        . "$NODE_METADATA"
+        if [ "${NODE_METADATA_EXPIRES:-0}" -gt "$(date +%s)" ]; then
+            return 0
+        fi
+    fi
+
+    mkdir -p "$(dirname "$NODE_METADATA")"
+    # Only one script resolves at a time, the others then read its cache
+    if (
+        flock 9
+        if [ -f "$NODE_METADATA" ]; then . "$NODE_METADATA"; fi
+        [ "${NODE_METADATA_EXPIRES:-0}" -gt "$(date +%s)" ] || resolve_node_metadata
+    ) 9>"$NODE_METADATA.lock"; then
+        . "$NODE_METADATA"
+    elif [ -f "$NODE_METADATA" ]; then
+        echo "Could not resolve the node metadata, using the expired $NODE_METADATA" >&2
+    else
+        echo "Could not resolve the node metadata" >&2
+        return 1
+    fi
+}
@@ -0,0 +1,44 @@
+#!/bin/bash -e
+# Sets up an instance of the PgBouncer tier. It runs no Airflow, so it takes
+# only the steps it needs instead of those of commons.setup.sh.
+. "$(dirname $0)/bootstrap.sh"
+. "$(dirname $0)/node-metadata.sh"
+
+FILES=$(dirname "$0")
+
+install_jq() {
+    yum install -y jq
+}
+step jq install_jq
+
+instance_identity() {
+    node_metadata
+    step_export "${NODE_METADATA_VARS[@]}"
+}
+step identity instance_identity jq
+
+install_pgbouncer() {
+    amazon-linux-extras install -y epel
+    yum install -y pgbouncer python3
+}
+step pgbouncer_package install_pgbouncer
+
+pgbouncer_config() {
+    export DATABASE_URI PGBOUNCER_POOL_SIZE PGBOUNCER_MAX_CLIENT_CONN
+    python3 "$FILES/pgbouncer_config.py" /etc/pgbouncer
+    chown -R pgbouncer: /etc/pgbouncer
+
+    # A file descriptor per client and database connection
+    mkdir -p /etc/systemd/system/pgbouncer.service.d
+    printf '[Service]\nLimitNOFILE=%s\n' $((PGBOUNCER_MAX_CLIENT_CONN + PGBOUNCER_POOL_SIZE + 1024)) \
+        > /etc/systemd/system/pgbouncer.service.d/limits.conf
+}
+step pgbouncer_config pgbouncer_config pgbouncer_package identity
+
+pgbouncer() {
+    systemctl daemon-reload
+    systemctl enable --now pgbouncer
+}
+step pgbouncer pgbouncer pgbouncer_config
+
+run_steps pgbouncer
@@ -0,0 +1,94 @@
+"""
+Writes the configuration of PgBouncer, pooling the connections of the Airflow
+instances to the metadata database, to the given directory.
+
+The database to pool and its credentials are read from DATABASE_URI. PgBouncer
+holds at most PGBOUNCER_POOL_SIZE connections to the database and accepts up to
+PGBOUNCER_MAX_CLIENT_CONN connections from the instances. In transaction mode,
+a connection to the database serves a client only for the time of one of its
+transactions, so the many idle connections of the Airflow processes share a few
+connections to the database.
+
+Runs in the setup of the PgBouncer instances as pgbouncer_config.py
+/etc/pgbouncer, and in the pgbouncer-config service of
+examples/pgbouncer/docker-compose.yml.
+"""
+import logging
+import os
+import sys
+import urllib.parse
+
+logging.basicConfig(level=os.environ.get("LOGLEVEL", logging.INFO))
+
+LISTEN_PORT = 6432
+DEFAULT_POOL_SIZE = 90
+DEFAULT_MAX_CLIENT_CONN = 1000
+
+
+def main():
+    directory = sys.argv[1]
+    ini, userlist = render(
+        os.environ["DATABASE_URI"],
+        int(os.environ.get("PGBOUNCER_POOL_SIZE", DEFAULT_POOL_SIZE)),
+        int(os.environ.get("PGBOUNCER_MAX_CLIENT_CONN", DEFAULT_MAX_CLIENT_CONN)),
+        directory,
+    )
+    os.makedirs(directory, exist_ok=True)
+    write(os.path.join(directory, "pgbouncer.ini"), ini)
+    write(os.path.join(directory, "userlist.txt"), userlist)
+    logging.info("wrote the PgBouncer configuration to %s", directory)
+
+
+def render(database_uri, pool_size, max_client_conn, directory):
+    """The content of pgbouncer.ini and userlist.txt"""
+    uri = urllib.parse.urlsplit(database_uri)
+    user = urllib.parse.unquote(uri.username)
+    dbname = uri.path.lstrip("/")
+    ini = "\n".join(
+        [
+            "[databases]",
+            "{} = host={} port={} dbname={}".format(
+                dbname, uri.hostname, uri.port or 5432, dbname
+            ),
+            "",
+            "[pgbouncer]",
+            "listen_addr = 0.0.0.0",
+            "listen_port = {}".format(LISTEN_PORT),
+            # The libpq of Amazon Linux 2 predates SCRAM
+            "auth_type = md5",
+            "auth_file = {}".format(os.path.join(directory, "userlist.txt")),
+            "admin_users = {}".format(user),
+            "stats_users = {}".format(user),
+            "pool_mode = transaction",
+            "default_pool_size = {}".format(pool_size),
+            "max_db_connections = {}".format(pool_size),
+            "max_client_conn = {}".format(max_client_conn),
+            "server_tls_sslmode = prefer",
+            # The network load balancer in front of PgBouncer drops the connections
+            # idle for 350 seconds, keepalives keep those of idle clients open
+            "tcp_keepalive = 1",
+            "tcp_keepidle = 60",
+            "tcp_keepintvl = 30",
+            "ignore_startup_parameters = extra_float_digits,options",
+            "",
+        ]
+    )
+    userlist = "{} {}\n".format(
+        quote(user), quote(urllib.parse.unquote(uri.password or ""))
+    )
+    return ini, userlist
+
+
+def quote(value):
+    return '"{}"'.format(value.replace('"', '""'))
+
+
+def write(path, content):
+    with open(path + ".tmp", "w") as target:
+        os.chmod(path + ".tmp", 0o600)
+        target.write(content)
+    os.replace(path + ".tmp", path)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,29 +2,49 @@
 
 . "$(dirname $0)/commons.setup.sh"
 
-if [ "$TURBINE__CORE__LOAD_DEFAULTS" == "True" ]; then
-    su -c '/usr/local/bin/airflow initdb' ec2-user
-else
-    su -c '/usr/local/bin/airflow upgradedb' ec2-user
-fi
-
-systemctl enable --now airflow-scheduler
-
-mkdir /mnt/efs
-FSPEC="${FILE_SYSTEM_ID}.efs.$AWS_REGION.amazonaws.com:/"
-PARAMS="nfsvers=4.1,rsize=1048576,wsize=1048576"
-PARAMS="$PARAMS,hard,timeo=600,retrans=2,noresvport"
-echo "$FSPEC /mnt/efs nfs $PARAMS,_netdev 0 0" >> /etc/fstab
-mount /mnt/efs && chown -R ec2-user: /mnt/efs
-
-chown -R ec2-user /airflow/logs
-
-if ! [ -z "${SMALL_QUEUE_NAME}" ]; then
-    if [ "$CD_PENDING_DEPLOY" = "false" ]; then
-        systemctl enable --now airflow-workerset-small
+airflow_db() {
+    if [ "$TURBINE__CORE__LOAD_DEFAULTS" == "True" ]; then
+        su -c '/usr/local/bin/airflow initdb' ec2-user
     else
-        systemctl enable airflow-workerset-small
+        su -c '/usr/local/bin/airflow upgradedb' ec2-user
     fi
-fi
+}
+step airflow_db airflow_db airflow_config python_packages
 
-cd_agent
+scheduler() {
+    systemctl enable --now airflow-scheduler
+}
+step scheduler scheduler airflow_db dags_mirror dag_bundle
+
+# The load metric function reads the depth of the Redis queues from the metrics
+# the scheduler publishes, as Redis publishes none. The service restarts on every
+# run of the setup, to pick up the queues of the worker sets added since
+queue_depth() {
+    if [ "$CELERY_BROKER" = "Redis" ]; then
+        echo "QUEUE_NAMES=$QUEUE_NAME,$SMALL_QUEUE_NAME,$WORKER_SET_QUEUE_NAMES" \
+            > /etc/sysconfig/airflow-queue-depth.env
+        systemctl enable airflow-queue-depth
+        systemctl restart airflow-queue-depth
+    fi
+}
+step queue_depth queue_depth airflow_config python_packages
+
+step efs mount_efs identity
+step dags_mirror dags_mirror efs airflow_config
+
+small_worker() {
+    chown -R ec2-user /airflow/logs
+
+    if ! [ -z "${SMALL_QUEUE_NAME}" ]; then
+        if [ "$CD_PENDING_DEPLOY" = "false" ]; then
+            systemctl enable --now airflow-workerset-small
+        else
+            systemctl enable airflow-workerset-small
+        fi
+    fi
+}
+step small_worker small_worker scheduler efs codedeploy_pending
+
+step codedeploy cd_agent small_worker codedeploy_download
+
+run_steps scheduler
@@ -0,0 +1,21 @@
+"""
+The Celery configuration of the workers: the default one of Airflow with the
+worker settings it has no option for, sized by the workerset for its instance
+type. The workers load it from $AIRFLOW_HOME/config, as their
+celery_config_options.
+"""
+import os
+
+from airflow.config_templates.default_celery import DEFAULT_CELERY_CONFIG
+
+CELERY_CONFIG = dict(
+    DEFAULT_CELERY_CONFIG,
+    worker_prefetch_multiplier=int(
+        os.environ.get("TURBINE__CELERY__WORKER_PREFETCH_MULTIPLIER", 1)
+    ),
+    # 0 keeps the processes, as Celery does without a limit
+    worker_max_tasks_per_child=int(
+        os.environ.get("TURBINE__CELERY__WORKER_MAX_TASKS_PER_CHILD", 0)
+    )
+    or None,
+)
@@ -0,0 +1,38 @@
+#!/bin/bash
+# Starts the worker of an instance going in service. Instances launched into the
+# warm pool only complete their launch lifecycle action, so that they are stopped
+# until they leave the pool and this runs again as they boot.
+. "$(dirname "$0")/node-metadata.sh"
+node_metadata
+
+# The lifecycle state changes as the instance moves, so it is never cached
+IMDS_TOKEN=$(imds_token)
+TARGET_STATE=$(imds meta-data/autoscaling/target-lifecycle-state)
+
+complete_launch() {
+    if [ -n "$AWS_LAUNCH_LIFECYCLE_NAME" ]; then
+        aws autoscaling complete-lifecycle-action \
+        --instance-id "$EC2_INSTANCE_ID" \
+        --lifecycle-hook-name "$AWS_LAUNCH_LIFECYCLE_NAME" \
+        --auto-scaling-group-name "$AUTO_SCALING_GROUP_NAME" \
+        --lifecycle-action-result CONTINUE \
+        --region "$AWS_REGION" || true
+    fi
+}
+
+case "$TARGET_STATE" in
+    Warmed:*)
+        complete_launch
+        exit 0
+        ;;
+esac
+
+if [ "$CD_PENDING_DEPLOY" = "false" ]; then
+    systemctl enable --now airflow-workerset
+else
+    # The first CodeDeploy deployment starts the worker, later boots start it here
+    systemctl enable airflow-workerset
+    sed -i 's/^CD_PENDING_DEPLOY=.*/CD_PENDING_DEPLOY=false/' \
+        /etc/sysconfig/airflow-activate.env
+fi
+complete_launch
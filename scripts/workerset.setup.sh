@@ -2,18 +2,48 @@
 
 . "$(dirname $0)/commons.setup.sh"
 
+step efs mount_efs identity
+step dags_mirror dags_mirror efs airflow_config
 
-mkdir /mnt/efs
-FSPEC="${FILE_SYSTEM_ID}.efs.$AWS_REGION.amazonaws.com:/"
-PARAMS="nfsvers=4.1,rsize=1048576,wsize=1048576"
-PARAMS="$PARAMS,hard,timeo=600,retrans=2,noresvport"
-echo "$FSPEC /mnt/efs nfs $PARAMS,_netdev 0 0" >> /etc/fstab
-mount /mnt/efs && chown -R ec2-user: /mnt/efs
+# The Celery worker settings the template generator sized for the instance type
+celery_worker() {
+    {
+        echo "AIRFLOW__CELERY__WORKER_CONCURRENCY=$WORKER_CONCURRENCY"
+        if [ -n "$WORKER_AUTOSCALE" ]; then
+            echo "AIRFLOW__CELERY__WORKER_AUTOSCALE=$WORKER_AUTOSCALE"
+        fi
+        echo "AIRFLOW__CELERY__CELERY_CONFIG_OPTIONS=turbine_celery_config.CELERY_CONFIG"
+        echo "TURBINE__CELERY__WORKER_PREFETCH_MULTIPLIER=$WORKER_PREFETCH_MULTIPLIER"
+        echo "TURBINE__CELERY__WORKER_MAX_TASKS_PER_CHILD=$WORKER_MAX_TASKS_PER_CHILD"
+        # Matching the attributes of the queue the generator set for the workerset
+        echo "AIRFLOW__CELERY_BROKER_TRANSPORT_OPTIONS__WAIT_TIME_SECONDS=$QUEUE_WAIT_TIME"
+        echo "AIRFLOW__CELERY_BROKER_TRANSPORT_OPTIONS__VISIBILITY_TIMEOUT=$QUEUE_VISIBILITY_TIMEOUT"
+        echo "AIRFLOW__CELERY_BROKER_TRANSPORT_OPTIONS__POLLING_INTERVAL=$QUEUE_POLLING_INTERVAL"
+    } >> /etc/sysconfig/airflow.env
+    mkdir -p "$AIRFLOW_HOME/config"
+    cp "$FILES/turbine_celery_config.py" "$AIRFLOW_HOME/config/"
+    chown -R ec2-user: "$AIRFLOW_HOME/config"
+}
+step celery_worker celery_worker airflow_config
 
+# Everything here runs once, as the instance is launched. The worker is started
+# by airflow-activate, which runs on every boot so that instances initialised in
+# the warm pool are activated when they are started to go in service.
+activate_env() {
+    LAUNCH_LIFECYCLE_NAME=""
+    if [ "$WARM_POOL_SIZE" -gt 0 ]; then
+        LAUNCH_LIFECYCLE_NAME="turbine-launch"
+    fi
+    echo "CD_PENDING_DEPLOY=$CD_PENDING_DEPLOY" > /etc/sysconfig/airflow-activate.env
+    echo "AWS_LAUNCH_LIFECYCLE_NAME=$LAUNCH_LIFECYCLE_NAME" >> /etc/sysconfig/airflow-activate.env
+}
+step activate_env activate_env airflow_config codedeploy_pending dags_mirror dag_bundle celery_worker
 
-if [ "$CD_PENDING_DEPLOY" = "false" ]; then
-    systemctl enable --now airflow-workerset
-else
-    systemctl enable airflow-workerset
-fi
-cd_agent
+step codedeploy cd_agent activate_env efs python_packages codedeploy_download
+
+activate() {
+    systemctl enable --now airflow-activate
+}
+step activate activate codedeploy
+
+run_steps workerset
@@ -0,0 +1,544 @@
+"""
+Replays a queue arrival trace against a model of a workerset AutoScaling group,
+driven by the real load metric function with stubbed AWS clients.
+
+The model runs in one second steps:
+
+- tasks arrive on the queue and start on the first in-service instance with a
+  free worker slot
+- every in-service instance with a free slot polls the queue POLLING_RATE times
+  per minute, which count as empty receives while the queue is empty
+- per minute SQS and AutoScaling metrics are published METRIC_DELAY seconds
+  after the minute ends
+- the load metric handler runs every minute; the load alarms of ClusterLoad
+  worker sets then run their simple scaling, step scaling or target tracking
+  policy
+- launched instances take boot_time seconds to get in service and instances
+  being terminated stop taking tasks and drain before they go away
+
+Usage:
+    python simulator/simulate.py --hours 6
+    python simulator/simulate.py --trace trace.csv --scaling-mode DesiredCapacity
+
+Traces are CSV files with an arrival and a duration column, both in seconds.
+"""
+import argparse
+import contextlib
+import csv
+import datetime
+import json
+import math
+import os
+import random
+import sys
+import types
+
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "functions"))
+
+import load_metric  # noqa: E402
+
+EPOCH = datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc)
+GROUP = "simulated-group"
+QUEUE = "simulated-queue"
+STACK = "simulated-stack"
+# Empty receives per minute of a worker with a free slot while the queue is empty
+POLLING_RATE = 5.5
+# Seconds after the end of a minute at which its SQS and AutoScaling metrics appear
+METRIC_DELAY = 60
+# Scaling actions reversing the previous one within this many seconds are flaps
+FLAP_WINDOW = 600
+
+
+class Instance:
+    def __init__(self, launched, ready):
+        self.launched = launched
+        self.ready = ready
+        self.tasks = []
+        self.draining = False
+
+    def state(self, now):
+        if self.draining:
+            return "Terminating:Wait"
+        if now < self.ready:
+            return "Pending"
+        return "InService"
+
+
+class Simulation:
+    def __init__(
+        self,
+        trace,
+        scaling_mode="ClusterLoad",
+        worker_slots=16,
+        min_size=0,
+        max_size=10,
+        growth_threshold=0.9,
+        shrink_threshold=0.5,
+        cooldown=180,
+        boot_time=180,
+        fast_scaling=False,
+        scaling_policy_type="SimpleScaling",
+        scale_out_steps=(1, 2, 4),
+        scale_out_step_bounds=(0.03, 0.08),
+        scale_in_evaluation_periods=5,
+        target_load=0.75,
+        load_formula="EmptyReceives",
+    ):
+        self.trace = sorted(trace)
+        self.scaling_mode = scaling_mode
+        self.worker_slots = worker_slots
+        self.min_size = min_size
+        self.max_size = max_size
+        self.growth_threshold = growth_threshold
+        self.shrink_threshold = shrink_threshold
+        self.cooldown = cooldown
+        self.boot_time = boot_time
+        self.fast_scaling = fast_scaling
+        self.scaling_policy_type = scaling_policy_type
+        self.scale_out_steps = scale_out_steps
+        self.scale_out_step_bounds = scale_out_step_bounds
+        self.scale_in_evaluation_periods = scale_in_evaluation_periods
+        self.target_load = target_load
+        self.load_formula = load_formula
+
+        self.now = 0
+        self.desired = min_size
+        self.cooldown_until = 0
+        self.instances = []
+        self.queue = []
+        self.next_task = 0
+        self.waits = []
+        self.instance_seconds = 0
+        self.actions = []
+
+        self.minute = {}
+        self.metrics = {}
+        self.load = []
+        self.baselines = "{}"
+
+    # AWS clients used by load_metric
+
+    def get_metric_data(self, **kwargs):
+        results = []
+        for query in kwargs["MetricDataQueries"]:
+            metric = query["MetricStat"]["Metric"]["MetricName"]
+            if metric == "ClusterLoad":
+                points = self.minute_load(kwargs["StartTime"], kwargs["EndTime"])
+            else:
+                points = {
+                    timestamp: value
+                    for timestamp, value in self.metrics.get(metric, {}).items()
+                    if kwargs["StartTime"] <= timestamp < kwargs["EndTime"]
+                    and timestamp + datetime.timedelta(seconds=60 + METRIC_DELAY)
+                    <= self.timestamp()
+                }
+            results.append(
+                {
+                    "Id": query["Id"],
+                    "Timestamps": list(points),
+                    "Values": list(points.values()),
+                }
+            )
+        return {"MetricDataResults": results}
+
+    def put_metric_data(self, Namespace, MetricData):
+        for datum in MetricData:
+            if datum["MetricName"] == "ClusterLoad":
+                self.load.append((datum["Timestamp"], datum["Value"]))
+            if datum["MetricName"] == "DesiredCapacity":
+                self.metrics.setdefault("DesiredCapacity", {})[
+                    datum["Timestamp"]
+                ] = datum["Value"]
+
+    def get_paginator(self, _name):
+        return self
+
+    def paginate(self, AutoScalingGroupNames):
+        return [
+            {
+                "AutoScalingGroups": [
+                    {
+                        "AutoScalingGroupName": GROUP,
+                        "MinSize": self.min_size,
+                        "MaxSize": self.max_size,
+                        "DesiredCapacity": self.desired,
+                        "Instances": [
+                            {"LifecycleState": instance.state(self.now)}
+                            for instance in self.instances
+                        ],
+                    }
+                ]
+            }
+        ]
+
+    def set_desired_capacity(self, AutoScalingGroupName, DesiredCapacity, **_kwargs):
+        self.scale(DesiredCapacity)
+
+    def get_queue_attributes(self, **_kwargs):
+        return {
+            "Attributes": {
+                "ApproximateNumberOfMessages": str(len(self.queue)),
+                "ApproximateNumberOfMessagesNotVisible": str(self.running()),
+            }
+        }
+
+    def get_parameter(self, Name):
+        return {"Parameter": {"Name": Name, "Value": self.baselines}}
+
+    def put_parameter(self, Name, Value, **_kwargs):
+        self.baselines = Value
+
+    # Clock used by load_metric
+
+    def timestamp(self):
+        return EPOCH + datetime.timedelta(seconds=self.now)
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.advance(self.now + math.ceil(seconds))
+
+    # Model
+
+    def running(self):
+        return sum(len(instance.tasks) for instance in self.instances)
+
+    def minute_load(self, start, end):
+        minutes = {}
+        for timestamp, value in self.load:
+            if start <= timestamp < end:
+                minute = timestamp.replace(second=0, microsecond=0)
+                minutes.setdefault(minute, []).append(value)
+        return {minute: sum(v) / len(v) for minute, v in minutes.items()}
+
+    def scale(self, desired):
+        desired = min(max(desired, self.min_size), self.max_size)
+        if desired == self.desired:
+            return
+        self.actions.append((self.now, desired - self.desired))
+        self.desired = desired
+
+    def reconcile(self):
+        active = [i for i in self.instances if not i.draining]
+        for _ in range(self.desired - len(active)):
+            self.instances.append(Instance(self.now, self.now + self.boot_time))
+        for _ in range(len(active) - self.desired):
+            pending = [i for i in active if i.state(self.now) == "Pending"]
+            victim = pending[-1] if pending else active[0]
+            victim.draining = True
+            active.remove(victim)
+
+    def step(self):
+        while (
+            self.next_task < len(self.trace)
+            and self.trace[self.next_task][0] <= self.now
+        ):
+            self.queue.append(self.trace[self.next_task])
+            self.next_task += 1
+
+        self.reconcile()
+        for instance in list(self.instances):
+            instance.tasks = [end for end in instance.tasks if end > self.now]
+            if instance.draining and not instance.tasks:
+                self.instances.remove(instance)
+        in_service = [i for i in self.instances if i.state(self.now) == "InService"]
+        for instance in in_service:
+            while self.queue and len(instance.tasks) < self.worker_slots:
+                arrival, duration = self.queue.pop(0)
+                self.waits.append(self.now - arrival)
+                instance.tasks.append(self.now + duration)
+
+        polling = sum(len(i.tasks) < self.worker_slots for i in in_service)
+        self.record(
+            ApproximateNumberOfMessagesVisible=len(self.queue),
+            ApproximateNumberOfMessagesNotVisible=self.running(),
+            NumberOfEmptyReceives=0 if self.queue else polling * POLLING_RATE / 60,
+            GroupInServiceInstances=len(in_service),
+        )
+        self.instance_seconds += len(self.instances)
+        self.now += 1
+
+    def record(self, **values):
+        for name, value in values.items():
+            self.minute.setdefault(name, []).append(value)
+        if (self.now + 1) % 60:
+            return
+        minute = self.timestamp().replace(second=0)
+        for name, samples in self.minute.items():
+            if name.startswith("Approximate"):
+                value = max(samples)
+            elif name == "NumberOfEmptyReceives":
+                value = sum(samples)
+            else:
+                value = sum(samples) / len(samples)
+            self.metrics.setdefault(name, {})[minute] = value
+        self.minute = {}
+
+    def latest_averages(self, period, count):
+        """
+        Like CloudWatch alarms, evaluates the latest periods with data, looking
+        back a few periods for datapoints published late.
+        """
+        averages = []
+        for index in range(count + 4):
+            end = self.timestamp() - datetime.timedelta(seconds=index * period)
+            start = end - datetime.timedelta(seconds=period)
+            values = [v for t, v in self.load if start <= t < end]
+            if values:
+                averages.append(sum(values) / len(values))
+        return averages[:count] if len(averages) >= count else None
+
+    def evaluate_alarms(self):
+        if self.scaling_policy_type == "TargetTrackingScaling":
+            self.track_target()
+            return
+        period, evaluation_periods = (10, 3) if self.fast_scaling else (60, 1)
+        above = self.latest_averages(period, evaluation_periods)
+        if self.scaling_policy_type == "StepScaling":
+            evaluation_periods = self.scale_in_evaluation_periods
+        below = self.latest_averages(period, evaluation_periods)
+
+        if self.scaling_policy_type == "StepScaling":
+            if above and all(average >= self.growth_threshold for average in above):
+                offset = above[0] - self.growth_threshold
+                bounds = [b for b in self.scale_out_step_bounds if offset >= b]
+                step = self.scale_out_steps[len(bounds)]
+                # Instances still warming up count towards the new step
+                warming = sum(
+                    1 for i in self.instances if self.now < i.launched + self.cooldown
+                )
+                self.scale(max(self.desired, self.desired - warming + step))
+            elif below and all(average <= self.shrink_threshold for average in below):
+                self.scale(self.desired - 1)
+            return
+
+        if self.now < self.cooldown_until:
+            return
+        if above and all(average >= self.growth_threshold for average in above):
+            self.scale(self.desired + 1)
+            self.cooldown_until = self.now + self.cooldown
+        elif below and all(average <= self.shrink_threshold for average in below):
+            self.scale(self.desired - 1)
+            self.cooldown_until = self.now + self.cooldown
+
+    def track_target(self):
+        """
+        Target tracking scales out after 3 minutes above the target and in after
+        15 minutes below 90% of it, to the capacity proportional to the load.
+        """
+        if self.now % 60:
+            return
+        above = self.latest_averages(60, 3)
+        below = self.latest_averages(60, 15)
+        if above and all(average > self.target_load for average in above):
+            capacity = math.ceil(self.desired * above[0] / self.target_load)
+            self.scale(max(capacity, self.desired))
+        elif below and all(average < 0.9 * self.target_load for average in below):
+            capacity = math.ceil(self.desired * below[0] / self.target_load)
+            self.scale(min(capacity, self.desired))
+
+    def advance(self, until):
+        period = 10 if self.fast_scaling else 60
+        while self.now < until:
+            self.step()
+            if self.scaling_mode == "ClusterLoad" and self.now % period == 0:
+                self.evaluate_alarms()
+
+    def run(self, duration):
+        worker_set = {
+            "QueueName": QUEUE,
+            "GroupName": GROUP,
+            "StackName": STACK,
+            "ScalingMode": self.scaling_mode,
+            "WorkerSlots": self.worker_slots,
+            "FastScaling": str(self.fast_scaling),
+            "LoadFormula": self.load_formula,
+        }
+        clock = types.SimpleNamespace(
+            datetime=types.SimpleNamespace(now=lambda tz=None: self.timestamp()),
+            timedelta=datetime.timedelta,
+            timezone=datetime.timezone,
+        )
+        patches = {
+            "CW": self,
+            "AS": self,
+            "SQS": self,
+            "SSM": self,
+            "time": types.SimpleNamespace(monotonic=self.monotonic, sleep=self.sleep),
+            "datetime": clock,
+        }
+        environ = {"BaselineParameter": STACK, "AWS_REGION": "us-east-1"}
+        context = types.SimpleNamespace(
+            invoked_function_arn="arn:aws:lambda:us-east-1:123456789012:function:load"
+        )
+        with patched(load_metric, patches), patched(os.environ, environ, item=True):
+            while self.now < duration:
+                load_metric.handler({"WorkerSets": [worker_set]}, context)
+                self.advance(60 * (self.now // 60 + 1))
+        return self.report(duration)
+
+    def report(self, duration):
+        waits = sorted(self.waits)
+        flaps = sum(
+            1
+            for (t0, d0), (t1, d1) in zip(self.actions, self.actions[1:])
+            if (d0 > 0) != (d1 > 0) and t1 - t0 <= FLAP_WINDOW
+        )
+        return {
+            "hours": duration / 3600,
+            "tasks": len(self.trace),
+            "started": len(waits),
+            "wait_p50": percentile(waits, 50),
+            "wait_p90": percentile(waits, 90),
+            "wait_p99": percentile(waits, 99),
+            "wait_max": percentile(waits, 100),
+            "instance_hours": round(self.instance_seconds / 3600, 2),
+            "scale_outs": sum(1 for _, d in self.actions if d > 0),
+            "scale_ins": sum(1 for _, d in self.actions if d < 0),
+            "flaps": flaps,
+        }
+
+
+@contextlib.contextmanager
+def patched(target, values, item=False):
+    """
+    Temporarily replaces the attributes (or items) of target with values.
+    """
+    missing = object()
+    get = target.get if item else lambda name, default: getattr(target, name, default)
+    saved = {name: get(name, missing) for name in values}
+    for name, value in values.items():
+        if item:
+            target[name] = value
+        else:
+            setattr(target, name, value)
+    try:
+        yield
+    finally:
+        for name, value in saved.items():
+            if value is missing:
+                if item:
+                    del target[name]
+                else:
+                    delattr(target, name)
+            elif item:
+                target[name] = value
+            else:
+                setattr(target, name, value)
+
+
+def percentile(values, percent):
+    if not values:
+        return None
+    return round(values[min(len(values) - 1, int(len(values) * percent / 100))], 1)
+
+
+def read_trace(path):
+    with open(path) as f:
+        return [
+            (float(row["arrival"]), float(row["duration"])) for row in csv.DictReader(f)
+        ]
+
+
+def synthetic_trace(
+    hours, burst_tasks=200, burst_interval=3600, background_rate=0.5, seed=0
+):
+    """
+    Bursts of burst_tasks tasks every burst_interval seconds, like hourly DAGs
+    fanning out, on top of background_rate tasks per minute. Task durations are
+    log-normal around 3 minutes.
+    """
+    rng = random.Random(seed)
+    duration = hours * 3600
+    trace = []
+    for start in range(0, int(duration), burst_interval):
+        for _ in range(burst_tasks):
+            trace.append((start + rng.uniform(0, 60), rng.lognormvariate(5.2, 0.6)))
+    if not background_rate:
+        return trace
+    arrival = rng.expovariate(background_rate / 60)
+    while arrival < duration:
+        trace.append((arrival, rng.lognormvariate(5.2, 0.6)))
+        arrival += rng.expovariate(background_rate / 60)
+    return trace
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--trace", help="CSV trace with arrival and duration columns")
+    parser.add_argument("--hours", type=float, default=6)
+    parser.add_argument("--burst-tasks", type=int, default=200)
+    parser.add_argument("--burst-interval", type=int, default=3600)
+    parser.add_argument("--background-rate", type=float, default=0.5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--scaling-mode",
+        choices=("ClusterLoad", "DesiredCapacity"),
+        default="ClusterLoad",
+    )
+    parser.add_argument("--fast-scaling", action="store_true")
+    parser.add_argument(
+        "--load-formula",
+        choices=("EmptyReceives", "Occupancy"),
+        default="EmptyReceives",
+    )
+    parser.add_argument(
+        "--scaling-policy-type",
+        choices=("SimpleScaling", "StepScaling", "TargetTrackingScaling"),
+        default="SimpleScaling",
+    )
+    parser.add_argument("--scale-out-steps", type=int, nargs=3, default=(1, 2, 4))
+    parser.add_argument(
+        "--scale-out-step-bounds", type=float, nargs=2, default=(0.03, 0.08)
+    )
+    parser.add_argument("--scale-in-evaluation-periods", type=int, default=5)
+    parser.add_argument("--target-load", type=float, default=0.75)
+    parser.add_argument("--worker-slots", type=int, default=16)
+    parser.add_argument("--min-size", type=int, default=0)
+    parser.add_argument("--max-size", type=int, default=10)
+    parser.add_argument("--growth-threshold", type=float, default=0.9)
+    parser.add_argument("--shrink-threshold", type=float, default=0.5)
+    parser.add_argument("--cooldown", type=int, default=180)
+    parser.add_argument("--boot-time", type=int, default=180)
+    args = parser.parse_args(argv)
+
+    if args.trace:
+        trace = read_trace(args.trace)
+        duration = max(arrival for arrival, _ in trace) + 3600
+    else:
+        trace = synthetic_trace(
+            args.hours,
+            args.burst_tasks,
+            args.burst_interval,
+            args.background_rate,
+            args.seed,
+        )
+        duration = args.hours * 3600
+
+    simulation = Simulation(
+        trace,
+        scaling_mode=args.scaling_mode,
+        worker_slots=args.worker_slots,
+        min_size=args.min_size,
+        max_size=args.max_size,
+        growth_threshold=args.growth_threshold,
+        shrink_threshold=args.shrink_threshold,
+        cooldown=args.cooldown,
+        boot_time=args.boot_time,
+        fast_scaling=args.fast_scaling,
+        scaling_policy_type=args.scaling_policy_type,
+        scale_out_steps=args.scale_out_steps,
+        scale_out_step_bounds=args.scale_out_step_bounds,
+        scale_in_evaluation_periods=args.scale_in_evaluation_periods,
+        target_load=args.target_load,
+        load_formula=args.load_formula,
+    )
+    print(json.dumps(simulation.run(duration), indent=2))
+
+
+if __name__ == "__main__":
+    logging_level = os.environ.get("LOGLEVEL", "WARNING")
+    load_metric.logging.getLogger().setLevel(logging_level)
+    main()
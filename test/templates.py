@@ -10,5 +10,7 @@ with open("./templates/turbine-webserver.template") as f:
     WEBSERVER = load_yaml(f.read())
 with open("./templates/turbine-workerset.template") as f:
     WORKERSET = load_yaml(f.read())
+with open("./templates/turbine-pgbouncer.template") as f:
+    PGBOUNCER = load_yaml(f.read())
 
-ALL = [MASTER, CLUSTER, SCHEDULER, WEBSERVER, WORKERSET]
+ALL = [MASTER, CLUSTER, SCHEDULER, WEBSERVER, WORKERSET, PGBOUNCER]
@@ -0,0 +1,143 @@
+import hashlib
+import io
+import os
+import sys
+
+import botocore.exceptions
+import pytest
+
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "scripts"))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "examples", "project"))
+
+import airflow_bundle_sync as bundle_sync  # noqa: E402
+import publish_bundle  # noqa: E402
+
+
+class StubS3:
+    def __init__(self):
+        self.objects = {}
+        self.gets = []
+        self.uploads = []
+
+    def put_object(self, Bucket, Key, Body):
+        assert Bucket == "deployments"
+        self.objects[Key] = Body
+
+    def upload_file(self, path, bucket, key):
+        self.uploads.append(key)
+        with open(path, "rb") as source:
+            self.put_object(bucket, key, source.read())
+
+    def get_object(self, Bucket, Key, IfNoneMatch=None):
+        assert Bucket == "deployments"
+        self.gets.append(Key)
+        if Key not in self.objects:
+            raise client_error("NoSuchKey")
+        etag = hashlib.md5(self.objects[Key]).hexdigest()
+        if IfNoneMatch == etag:
+            raise client_error("304")
+        return {"Body": io.BytesIO(self.objects[Key]), "ETag": etag}
+
+    def get_paginator(self, _operation):
+        return self
+
+    def paginate(self, Bucket, Prefix):
+        yield {
+            "Contents": [{"Key": key} for key in self.objects if key.startswith(Prefix)]
+        }
+
+
+def client_error(code):
+    return botocore.exceptions.ClientError({"Error": {"Code": code}}, "GetObject")
+
+
+@pytest.fixture
+def s3(monkeypatch, tmp_path):
+    stub = StubS3()
+    monkeypatch.setenv("DEPLOYMENTS_BUCKET", "deployments")
+    monkeypatch.setattr(bundle_sync, "S3", stub)
+    monkeypatch.setattr(publish_bundle, "S3", stub)
+    monkeypatch.setattr(bundle_sync, "BUNDLES", str(tmp_path / "bundles"))
+    return stub
+
+
+def write(folder, relative, content, mode=0o644):
+    path = folder / relative
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(content)
+    path.chmod(mode)
+
+
+def current(relative):
+    with open(os.path.join(bundle_sync.BUNDLES, "current", relative)) as source:
+        return source.read()
+
+
+def blob_gets(s3):
+    return [key for key in s3.gets if key.startswith("bundles/blobs/")]
+
+
+def test_syncs_only_changed_files(s3, tmp_path):
+    dags = tmp_path / "dags"
+    write(dags, "a.py", "a = 1")
+    write(dags, "lib/b.py", "b = 1")
+    write(dags, "run.sh", "#!/bin/bash", 0o755)
+    first = publish_bundle.publish("deployments", str(dags))
+    etag = bundle_sync.sync()
+    assert bundle_sync.current_version() == first
+    assert current("lib/b.py") == "b = 1"
+    path = os.path.join(bundle_sync.BUNDLES, "current", "run.sh")
+    assert os.stat(path).st_mode & 0o777 == 0o755
+    assert len(blob_gets(s3)) == 3
+
+    write(dags, "a.py", "a = 2")
+    s3.uploads, s3.gets = [], []
+    second = publish_bundle.publish("deployments", str(dags))
+    assert len(s3.uploads) == 1
+    bundle_sync.sync(etag)
+    assert bundle_sync.current_version() == second
+    assert current("a.py") == "a = 2"
+    assert len(blob_gets(s3)) == 1
+    assert os.path.isdir(os.path.join(bundle_sync.BUNDLES, "versions", first))
+
+
+def test_unchanged_pointer_is_not_read_again(s3, tmp_path):
+    write(tmp_path / "dags", "a.py", "a = 1")
+    publish_bundle.publish("deployments", str(tmp_path / "dags"))
+    etag = bundle_sync.sync()
+    s3.gets = []
+    assert bundle_sync.sync(etag) == etag
+    assert s3.gets == ["bundles/current"]
+
+
+def test_nothing_published(s3):
+    assert bundle_sync.sync() is None
+    assert bundle_sync.current_version() is None
+
+
+def test_corrupt_blob_keeps_current_version(s3, tmp_path):
+    dags = tmp_path / "dags"
+    write(dags, "a.py", "a = 1")
+    first = publish_bundle.publish("deployments", str(dags))
+    etag = bundle_sync.sync()
+    write(dags, "a.py", "a = 2")
+    publish_bundle.publish("deployments", str(dags))
+    s3.objects["bundles/blobs/" + hashlib.sha256(b"a = 2").hexdigest()] = b"a = 3"
+    with pytest.raises(ValueError):
+        bundle_sync.sync(etag)
+    assert bundle_sync.current_version() == first
+    assert current("a.py") == "a = 1"
+
+
+def test_old_versions_and_their_blobs_are_removed(s3, tmp_path):
+    dags = tmp_path / "dags"
+    versions = []
+    for number in range(bundle_sync.KEEP_VERSIONS + 1):
+        write(dags, "a.py", "a = {}".format(number))
+        versions.append(publish_bundle.publish("deployments", str(dags)))
+        bundle_sync.sync()
+    kept = os.listdir(os.path.join(bundle_sync.BUNDLES, "versions"))
+    assert sorted(kept) == sorted(versions[1:])
+    blobs = os.listdir(os.path.join(bundle_sync.BUNDLES, "blobs"))
+    assert len(blobs) == bundle_sync.KEEP_VERSIONS
@@ -0,0 +1,213 @@
+import os
+import subprocess
+import sys
+import threading
+import time
+
+import botocore.exceptions
+import pytest
+
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "scripts"))
+
+import airflow_confapply as confapply  # noqa: E402
+
+ENVIRONMENT = [
+    "AWS_DEFAULT_REGION=us-east-1",
+    "AIRFLOW__CORE__PARALLELISM=32",
+    "AIRFLOW__CELERY__WORKER_CONCURRENCY=16",
+    "AIRFLOW__WEBSERVER__WORKERS=4",
+    "AIRFLOW__SCHEDULER__MAX_THREADS=2",
+]
+
+
+class StubSystemctl:
+    def __init__(self, active):
+        self.active = set(active)
+        self.restarted = []
+
+    def run(self, args, **_kwargs):
+        command, unit = args[1], args[-1]
+        if command == "restart":
+            self.restarted.append(unit)
+            # As the ExecStartPost of the unit
+            confapply.record(unit)
+        returncode = 0 if unit in self.active else 3
+        return subprocess.CompletedProcess(args, returncode)
+
+
+class StubDynamoDB:
+    """A restart lock table, applying the conditions of the agent"""
+
+    def __init__(self, **items):
+        self.items = items
+        self.lock = threading.Lock()
+
+    def put_item(self, Item, ExpressionAttributeValues, **_kwargs):
+        slot, owner = Item["Slot"]["S"], Item["Owner"]["S"]
+        now = int(ExpressionAttributeValues[":now"]["N"])
+        with self.lock:
+            held = self.items.get(slot)
+            if held and held[0] != owner and held[1] >= now:
+                raise conditional_check_failed("PutItem")
+            self.items[slot] = (owner, int(Item["Expires"]["N"]))
+
+    def update_item(self, Key, ExpressionAttributeValues, **_kwargs):
+        slot, owner = Key["Slot"]["S"], ExpressionAttributeValues[":owner"]["S"]
+        with self.lock:
+            if self.items.get(slot, (None,))[0] != owner:
+                raise conditional_check_failed("UpdateItem")
+            self.items[slot] = (owner, int(ExpressionAttributeValues[":expires"]["N"]))
+
+    def delete_item(self, Key, ExpressionAttributeValues, **_kwargs):
+        slot, owner = Key["Slot"]["S"], ExpressionAttributeValues[":owner"]["S"]
+        with self.lock:
+            if self.items.get(slot, (None,))[0] != owner:
+                raise conditional_check_failed("DeleteItem")
+            del self.items[slot]
+
+
+def conditional_check_failed(operation):
+    error = {"Error": {"Code": "ConditionalCheckFailedException"}}
+    return botocore.exceptions.ClientError(error, operation)
+
+
+class StubFleet:
+    """The systemctl of several instances, counting those restarting at once"""
+
+    def __init__(self):
+        self.restarting = set()
+        self.most_restarting = 0
+        self.restarted = []
+        self.lock = threading.Lock()
+
+    def run(self, args, **_kwargs):
+        instance = threading.current_thread().name
+        if args[1] == "restart":
+            with self.lock:
+                self.restarting.add(instance)
+                self.most_restarting = max(self.most_restarting, len(self.restarting))
+            time.sleep(0.01)
+            with self.lock:
+                self.restarting.discard(instance)
+                self.restarted.append((instance, args[-1]))
+        return subprocess.CompletedProcess(args, 0)
+
+
+@pytest.fixture
+def node(monkeypatch, tmp_path):
+    environment = tmp_path / "airflow.env"
+    environment.write_text("\n".join(ENVIRONMENT) + "\n")
+    units = {unit: str(environment) for unit in confapply.UNITS}
+    monkeypatch.setattr(confapply, "UNITS", units)
+    monkeypatch.setattr(confapply, "STATE_DIR", str(tmp_path / "state"))
+    for unit in units:
+        confapply.record(unit)
+    return environment
+
+
+def apply(monkeypatch, environment, lines, active=confapply.UNITS):
+    environment.write_text("\n".join(lines) + "\n")
+    systemctl = StubSystemctl(active)
+    monkeypatch.setattr(confapply.subprocess, "run", systemctl.run)
+    confapply.apply()
+    return systemctl.restarted
+
+
+def replace(old, new):
+    return [new if line == old else line for line in ENVIRONMENT]
+
+
+def test_nothing_changed(monkeypatch, node):
+    assert apply(monkeypatch, node, ENVIRONMENT) == []
+
+
+def test_celery_change_restarts_the_celery_services(monkeypatch, node):
+    lines = replace(
+        "AIRFLOW__CELERY__WORKER_CONCURRENCY=16",
+        "AIRFLOW__CELERY__WORKER_CONCURRENCY=8",
+    )
+    assert apply(monkeypatch, node, lines) == [
+        "airflow-scheduler",
+        "airflow-workerset",
+        "airflow-workerset-small",
+        "airflow-queue-depth",
+    ]
+
+
+def test_webserver_change_restarts_the_webserver(monkeypatch, node):
+    lines = ENVIRONMENT + ["AIRFLOW__WEBSERVER__BASE_URL=http://10.0.0.1:8080"]
+    assert apply(monkeypatch, node, lines) == ["airflow-webserver"]
+
+
+def test_shared_change_restarts_running_services(monkeypatch, node):
+    lines = replace("AIRFLOW__CORE__PARALLELISM=32", "AIRFLOW__CORE__PARALLELISM=64")
+    active = ["airflow-workerset", "airflow-log-housekeeping"]
+    assert apply(monkeypatch, node, lines, active) == active
+
+
+def test_unrecorded_service_is_restarted(monkeypatch, node, tmp_path):
+    os.remove(str(tmp_path / "state" / "airflow-webserver.json"))
+    assert apply(monkeypatch, node, ENVIRONMENT) == ["airflow-webserver"]
+
+
+def test_section_of():
+    assert confapply.section_of("AIRFLOW__CORE__EXECUTOR") == "core"
+    assert (
+        confapply.section_of("AIRFLOW__CELERY_BROKER_TRANSPORT_OPTIONS__REGION")
+        == "celery_broker_transport_options"
+    )
+    assert confapply.section_of("AIRFLOW_HOME") == "environment"
+    assert confapply.section_of("TURBINE__CORE__LOAD_DEFAULTS") == "environment"
+
+
+def apply_on_fleet(monkeypatch, environment, instances, dynamodb, max_unavailable=1):
+    """Applies a change on every instance at once, sharing a restart lock table"""
+    lines = replace(
+        "AIRFLOW__CELERY__WORKER_CONCURRENCY=16",
+        "AIRFLOW__CELERY__WORKER_CONCURRENCY=8",
+    )
+    environment.write_text("\n".join(lines) + "\n")
+    fleet = StubFleet()
+    monkeypatch.setattr(confapply.subprocess, "run", fleet.run)
+    monkeypatch.setattr(confapply, "DYNAMODB", dynamodb)
+    monkeypatch.setattr(confapply, "LOCK_WAIT", 0.001)
+    monkeypatch.setattr(confapply, "UNITS", {"airflow-workerset": str(environment)})
+    threads = [
+        threading.Thread(
+            target=confapply.apply,
+            args=("lock", instance, max_unavailable),
+            name=instance,
+        )
+        for instance in instances
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return fleet
+
+
+def test_instances_restart_one_at_a_time(monkeypatch, node):
+    instances = ["i-1", "i-2", "i-3", "i-4"]
+    dynamodb = StubDynamoDB()
+    fleet = apply_on_fleet(monkeypatch, node, instances, dynamodb)
+    assert fleet.most_restarting == 1
+    assert sorted(fleet.restarted) == [
+        (instance, "airflow-workerset") for instance in instances
+    ]
+    assert dynamodb.items == {}
+
+
+def test_max_unavailable_instances_restart_at_once(monkeypatch, node):
+    instances = ["i-1", "i-2", "i-3", "i-4"]
+    fleet = apply_on_fleet(monkeypatch, node, instances, StubDynamoDB(), 2)
+    assert fleet.most_restarting <= 2
+    assert len(fleet.restarted) == 4
+
+
+def test_expired_slot_is_taken(monkeypatch, node):
+    dynamodb = StubDynamoDB(**{"0": ("i-gone", int(time.time()) - 1)})
+    fleet = apply_on_fleet(monkeypatch, node, ["i-1"], dynamodb)
+    assert fleet.restarted == [("i-1", "airflow-workerset")]
+    assert dynamodb.items == {}
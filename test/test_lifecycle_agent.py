@@ -0,0 +1,100 @@
+import os
+import sys
+
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "scripts"))
+
+import airflow_lifecycle_agent as agent  # noqa: E402
+
+ENVIRONMENT = {
+    "EC2_INSTANCE_ID": "i-own",
+    "SHUTDOWN_LIFECYCLE_NAME": "hook",
+    "AUTO_SCALING_GROUP_NAME": "group",
+}
+
+
+class StubAutoScaling:
+    def __init__(self):
+        self.heartbeats = []
+        self.completed = []
+
+    def record_lifecycle_action_heartbeat(self, **kwargs):
+        self.heartbeats.append(kwargs)
+
+    def complete_lifecycle_action(self, **kwargs):
+        self.completed.append(kwargs)
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+def run_agent(monkeypatch, states=(), tasks=()):
+    autoscaling = StubAutoScaling()
+    states = list(states) + ["Terminated"]
+    tasks = list(tasks)
+    stopped = []
+    clock = FakeClock()
+    for name, value in ENVIRONMENT.items():
+        monkeypatch.setenv(name, value)
+    monkeypatch.setattr(agent, "AS", autoscaling)
+    monkeypatch.setattr(agent, "target_lifecycle_state", lambda: states.pop(0))
+    monkeypatch.setattr(agent.subprocess, "run", lambda args, **_: stopped.append(args))
+    monkeypatch.setattr(agent, "running_tasks", lambda: tasks.pop(0) if tasks else 0)
+    monkeypatch.setattr(agent, "time", clock)
+    agent.main()
+    return autoscaling, stopped, clock
+
+
+def test_drains_once_the_metadata_reports_the_termination(monkeypatch):
+    autoscaling, stopped, clock = run_agent(
+        monkeypatch, ["InService", None, "InService"]
+    )
+    assert clock.now == 3 * agent.POLL_PERIOD
+    assert stopped == [["systemctl", "stop", "--no-block", "airflow-workerset"]]
+    assert autoscaling.heartbeats == []
+    assert autoscaling.completed == [
+        {
+            "LifecycleHookName": "hook",
+            "AutoScalingGroupName": "group",
+            "InstanceId": "i-own",
+            "LifecycleActionResult": "CONTINUE",
+        }
+    ]
+
+
+def test_warmed_states_do_not_drain(monkeypatch):
+    autoscaling, stopped, clock = run_agent(
+        monkeypatch, ["Warmed:Stopped", "InService"]
+    )
+    assert clock.now == 2 * agent.POLL_PERIOD
+    assert len(stopped) == 1
+    assert len(autoscaling.completed) == 1
+
+
+def test_heartbeats_only_while_tasks_run(monkeypatch):
+    # 26 counts 5 seconds apart with tasks running, 125 seconds of draining
+    tasks = [2] * 20 + [1] * 6
+    autoscaling, _stopped, _clock = run_agent(monkeypatch, tasks=tasks)
+    assert len(autoscaling.heartbeats) == 2
+    assert autoscaling.heartbeats[0] == {
+        "LifecycleHookName": "hook",
+        "AutoScalingGroupName": "group",
+        "InstanceId": "i-own",
+    }
+    assert len(autoscaling.completed) == 1
+
+
+def test_is_task():
+    local = ["/usr/bin/python3", "/usr/local/bin/airflow", "run", "dag", "task"]
+    assert agent.is_task(local + ["2020-01-01", "--local"])
+    assert not agent.is_task(local + ["2020-01-01", "--raw"])
+    assert not agent.is_task(["/usr/bin/python3", "/usr/local/bin/airflow", "worker"])
+    assert not agent.is_task(["/bin/bash", "run.sh", "run"])
@@ -0,0 +1,479 @@
+import datetime
+import json
+import os
+import sys
+import types
+
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "functions"))
+
+import load_metric  # noqa: E402
+
+TIMESTAMP = datetime.datetime(2020, 1, 1, 12, 0, tzinfo=datetime.timezone.utc)
+WORKER_SETS = [
+    {"QueueName": "queue-a", "GroupName": "group-a", "StackName": "stack-a"},
+    {"QueueName": "queue-b", "GroupName": "group-b", "StackName": "stack-b"},
+]
+
+
+class StubCloudWatch:
+    def __init__(self, values):
+        self.values = values
+        self.get_calls = []
+        self.put_calls = []
+
+    def get_metric_data(self, **kwargs):
+        """
+        Values are either the datapoint of the last minute requested, or dicts of
+        datapoints keyed by how many minutes they precede the last minute.
+        """
+        self.get_calls.append(kwargs)
+        last = kwargs["EndTime"] - datetime.timedelta(minutes=1)
+        results = []
+        for query in kwargs["MetricDataQueries"]:
+            values = self.values.get(query["Id"], {})
+            if not isinstance(values, dict):
+                values = {0: values}
+            results.append(
+                {
+                    "Id": query["Id"],
+                    "Timestamps": [
+                        last - datetime.timedelta(minutes=offset) for offset in values
+                    ],
+                    "Values": list(values.values()),
+                }
+            )
+        return {"MetricDataResults": results}
+
+    def put_metric_data(self, **kwargs):
+        self.put_calls.append(kwargs)
+
+
+def test_worker_sets_are_read_from_the_event():
+    assert load_metric.get_worker_sets({"WorkerSets": WORKER_SETS}) == WORKER_SETS
+
+
+def test_single_worker_set_fallback(monkeypatch):
+    monkeypatch.setenv("QueueName", "queue-a")
+    monkeypatch.setenv("GroupName", "group-a")
+    monkeypatch.setenv("StackName", "stack-a")
+    assert load_metric.get_worker_sets({}) == WORKER_SETS[:1]
+
+
+def test_metrics_are_fetched_in_one_batch(monkeypatch):
+    stub = StubCloudWatch(
+        {
+            "maxANOMV0": 3.0,
+            "maxANOMNV0": 0.0,
+            "sumNOER0": 0.0,
+            "avgGISI0": 1.0,
+            "maxANOMV1": 0.0,
+            "maxANOMNV1": 0.0,
+            "sumNOER1": 11.0,
+            "avgGISI1": 2.0,
+        }
+    )
+    monkeypatch.setattr(load_metric, "CW", stub)
+    metrics = load_metric.get_metrics([TIMESTAMP], WORKER_SETS)
+    assert len(stub.get_calls) == 1
+    assert len(stub.get_calls[0]["MetricDataQueries"]) == 5 * len(WORKER_SETS)
+    assert metrics == [
+        {
+            "maxANOMV": {TIMESTAMP: 3.0},
+            "maxANOMNV": {TIMESTAMP: 0.0},
+            "sumNOER": {TIMESTAMP: 0.0},
+            "avgGISI": {TIMESTAMP: 1.0},
+            "avgCL": {},
+        },
+        {
+            "maxANOMV": {TIMESTAMP: 0.0},
+            "maxANOMNV": {TIMESTAMP: 0.0},
+            "sumNOER": {TIMESTAMP: 11.0},
+            "avgGISI": {TIMESTAMP: 2.0},
+            "avgCL": {},
+        },
+    ]
+
+
+def test_cluster_load():
+    assert load_metric.cluster_load(0, 0, 1) == 1.0
+    assert load_metric.cluster_load(0, 11, 2) == 0.0
+    assert load_metric.cluster_load(5, 0, 0) == 1.0
+    assert load_metric.cluster_load(0, 0, 0) is None
+
+
+def test_handler_publishes_every_worker_set_in_one_call(monkeypatch):
+    stub = StubCloudWatch(
+        {
+            "maxANOMV0": 3.0,
+            "maxANOMNV0": 0.0,
+            "sumNOER0": 0.0,
+            "avgGISI0": 1.0,
+            "maxANOMV1": 0.0,
+            "maxANOMNV1": 0.0,
+            "sumNOER1": 11.0,
+            "avgGISI1": 2.0,
+        }
+    )
+    monkeypatch.setattr(load_metric, "CW", stub)
+    load_metric.handler({"WorkerSets": WORKER_SETS}, None)
+    assert len(stub.put_calls) == 1
+    data = [
+        d for d in stub.put_calls[0]["MetricData"] if d["MetricName"] == "ClusterLoad"
+    ]
+    assert [d["Dimensions"][0]["Value"] for d in data] == ["stack-a", "stack-b"]
+    assert [d["Value"] for d in data] == [1.0, 0.0]
+
+
+def test_handler_skips_worker_sets_with_missing_datapoints(monkeypatch):
+    stub = StubCloudWatch(
+        {"maxANOMV0": 3.0, "maxANOMNV0": 0.0, "sumNOER0": 0.0, "avgGISI0": 1.0}
+    )
+    monkeypatch.setattr(load_metric, "CW", stub)
+    load_metric.handler({"WorkerSets": WORKER_SETS}, None)
+    data = stub.put_calls[0]["MetricData"]
+    assert {d["Dimensions"][0]["Value"] for d in data} == {"stack-a"}
+
+
+class StubAutoScaling:
+    def __init__(self, groups):
+        self.groups = groups
+        self.set_calls = []
+
+    def get_paginator(self, _name):
+        return self
+
+    def paginate(self, AutoScalingGroupNames):
+        return [
+            {
+                "AutoScalingGroups": [
+                    g
+                    for g in self.groups
+                    if g["AutoScalingGroupName"] in AutoScalingGroupNames
+                ]
+            }
+        ]
+
+    def set_desired_capacity(self, **kwargs):
+        self.set_calls.append(kwargs)
+
+
+def test_desired_capacity():
+    assert load_metric.desired_capacity(0, 0, 16, 0) == 0
+    assert load_metric.desired_capacity(40, 0, 16, 0) == 3
+    assert load_metric.desired_capacity(10, 6, 16, 1) == 1
+    assert load_metric.desired_capacity(0, 0, 16, 4) == 3
+
+
+def test_handler_sets_desired_capacity(monkeypatch):
+    worker_sets = [
+        dict(WORKER_SETS[0], ScalingMode="DesiredCapacity", WorkerSlots=8),
+        WORKER_SETS[1],
+    ]
+    stub = StubCloudWatch(
+        {
+            "maxANOMV0": 30.0,
+            "sumNOER0": 0.0,
+            "avgGISI0": 0.0,
+            "maxANOMNV0": 2.0,
+            "maxANOMV1": 0.0,
+            "maxANOMNV1": 0.0,
+            "sumNOER1": 11.0,
+            "avgGISI1": 2.0,
+        }
+    )
+    autoscaling = StubAutoScaling(
+        [
+            {
+                "AutoScalingGroupName": "group-a",
+                "MinSize": 0,
+                "MaxSize": 10,
+                "DesiredCapacity": 0,
+            }
+        ]
+    )
+    monkeypatch.setattr(load_metric, "CW", stub)
+    monkeypatch.setattr(load_metric, "AS", autoscaling)
+    load_metric.handler({"WorkerSets": worker_sets}, None)
+    data = stub.put_calls[0]["MetricData"]
+    assert [(d["MetricName"], d["Value"]) for d in data] == [
+        ("EmptyReceiveBaseline", 5.5),
+        ("DesiredCapacity", 4),
+        ("EmptyReceiveBaseline", 5.5),
+        ("ClusterLoad", 0.0),
+    ]
+    assert autoscaling.set_calls == [
+        {
+            "AutoScalingGroupName": "group-a",
+            "DesiredCapacity": 4,
+            "HonorCooldown": False,
+        }
+    ]
+
+
+class StubSSM:
+    def __init__(self, value):
+        self.value = value
+        self.put_calls = []
+
+    def get_parameter(self, Name):
+        return {"Parameter": {"Name": Name, "Value": self.value}}
+
+    def put_parameter(self, **kwargs):
+        self.put_calls.append(kwargs)
+
+
+def test_learn_baseline():
+    assert load_metric.learn_baseline(None, 0, 0, 0, 0) == 5.5
+    assert load_metric.learn_baseline(6.0, 3, 0, 2, 1) == 6.0
+    assert load_metric.learn_baseline(6.0, 0, 2, 2, 1) == 6.0
+    assert load_metric.learn_baseline(6.0, 0, 0, 14, 2) == 6.1
+
+
+def test_handler_uses_and_persists_learned_baseline(monkeypatch):
+    stub = StubCloudWatch(
+        {
+            "maxANOMV0": 0.0,
+            "maxANOMNV0": 0.0,
+            "sumNOER0": 24.0,
+            "avgGISI0": 2.0,
+        }
+    )
+    ssm = StubSSM(json.dumps({"stack-a": 10.0}))
+    monkeypatch.setattr(load_metric, "CW", stub)
+    monkeypatch.setattr(load_metric, "SSM", ssm)
+    monkeypatch.setenv("BaselineParameter", "baseline")
+    load_metric.handler({"WorkerSets": WORKER_SETS[:1]}, None)
+    data = {d["MetricName"]: d["Value"] for d in stub.put_calls[0]["MetricData"]}
+    assert data["EmptyReceiveBaseline"] == 10.2
+    assert data["ClusterLoad"] == 1.0 - 24.0 / (2.0 * 10.2)
+    assert json.loads(ssm.put_calls[0]["Value"]) == {"stack-a": 10.2}
+
+
+class StubSQS:
+    def __init__(self, attributes):
+        self.attributes = attributes
+        self.calls = []
+
+    def get_queue_attributes(self, QueueUrl, AttributeNames):
+        self.calls.append(QueueUrl)
+        return {"Attributes": self.attributes[QueueUrl]}
+
+
+def test_occupancy_load():
+    assert load_metric.occupancy_load(0, 4, 8, 1) == 0.5
+    assert load_metric.occupancy_load(40, 8, 8, 2) == 1.0
+    assert load_metric.occupancy_load(3, 0, 8, 0) == 1.0
+    assert load_metric.occupancy_load(0, 0, 8, 0) is None
+
+
+def test_handler_samples_fast_worker_sets(monkeypatch):
+    worker_sets = [
+        dict(WORKER_SETS[0], FastScaling="True", WorkerSlots=8),
+        WORKER_SETS[1],
+    ]
+    stub = StubCloudWatch(
+        {
+            "maxANOMV0": 3.0,
+            "maxANOMNV0": 0.0,
+            "sumNOER0": 0.0,
+            "avgGISI0": 1.0,
+            "maxANOMV1": 0.0,
+            "maxANOMNV1": 0.0,
+            "sumNOER1": 11.0,
+            "avgGISI1": 2.0,
+        }
+    )
+    autoscaling = StubAutoScaling(
+        [
+            {
+                "AutoScalingGroupName": "group-a",
+                "Instances": [
+                    {"LifecycleState": "InService"},
+                    {"LifecycleState": "Pending"},
+                ],
+            }
+        ]
+    )
+    sqs = StubSQS(
+        {
+            "https://sqs.us-east-1.amazonaws.com/123456789012/queue-a": {
+                "ApproximateNumberOfMessages": "2",
+                "ApproximateNumberOfMessagesNotVisible": "4",
+            }
+        }
+    )
+    monkeypatch.setattr(load_metric, "CW", stub)
+    monkeypatch.setattr(load_metric, "AS", autoscaling)
+    monkeypatch.setattr(load_metric, "SQS", sqs)
+    monkeypatch.setattr(load_metric, "FAST_PERIOD", 0)
+    monkeypatch.setenv("AWS_REGION", "us-east-1")
+    context = types.SimpleNamespace(
+        invoked_function_arn="arn:aws:lambda:us-east-1:123456789012:function:load"
+    )
+    load_metric.handler({"WorkerSets": worker_sets}, context)
+    assert len(sqs.calls) == load_metric.FAST_SAMPLES
+    minute = [
+        d for d in stub.put_calls[0]["MetricData"] if d["MetricName"] == "ClusterLoad"
+    ]
+    assert [d["Dimensions"][0]["Value"] for d in minute] == ["stack-b"]
+    for call in stub.put_calls[1:]:
+        [datum] = call["MetricData"]
+        assert datum["Dimensions"][0]["Value"] == "stack-a"
+        assert datum["StorageResolution"] == 1
+        assert datum["Value"] == 0.75
+
+
+def test_fill_window():
+    minutes = [TIMESTAMP + datetime.timedelta(minutes=m) for m in range(6)]
+    series = {
+        "maxANOMV": {minutes[1]: 2.0},
+        "maxANOMNV": {},
+        "sumNOER": {minutes[0]: 5.0, minutes[2]: 6.0},
+        "avgGISI": {minutes[0]: 1.0},
+    }
+    window = load_metric.fill_window(series, minutes)
+    assert [w["maxANOMV"] for w in window] == [None, 2.0, 2.0, 2.0, 2.0, None]
+    assert [w["maxANOMNV"] for w in window] == [0.0] * 6
+    assert [w["sumNOER"] for w in window] == [5.0, 5.0, 6.0, 6.0, 6.0, 6.0]
+    assert [w["avgGISI"] for w in window] == [1.0, 1.0, 1.0, 1.0, None, None]
+
+
+def test_handler_fills_gaps_and_backfills_cluster_load(monkeypatch):
+    stub = StubCloudWatch(
+        {
+            "maxANOMV0": {2: 3.0, 1: 3.0},
+            "maxANOMNV0": {2: 0.0, 1: 0.0},
+            "sumNOER0": {2: 0.0, 1: 0.0},
+            "avgGISI0": {2: 1.0, 1: 1.0, 0: 1.0},
+            "avgCL0": {2: 1.0},
+        }
+    )
+    monkeypatch.setattr(load_metric, "CW", stub)
+    load_metric.handler({"WorkerSets": WORKER_SETS[:1]}, None)
+    [call] = stub.get_calls
+    assert call["EndTime"] - call["StartTime"] == datetime.timedelta(
+        minutes=load_metric.WINDOW_MINUTES
+    )
+    data = [
+        d for d in stub.put_calls[0]["MetricData"] if d["MetricName"] == "ClusterLoad"
+    ]
+    last = call["EndTime"] - datetime.timedelta(minutes=1)
+    assert [d["Timestamp"] for d in data] == [
+        last - datetime.timedelta(minutes=1),
+        last,
+    ]
+    assert [d["Value"] for d in data] == [1.0, 1.0]
+
+
+def test_handler_acts_only_on_current_datapoints(monkeypatch):
+    # CloudWatch lags a minute behind, the last datapoints are carried forward
+    worker_sets = [
+        WORKER_SETS[0],
+        dict(WORKER_SETS[1], ScalingMode="DesiredCapacity", WorkerSlots=8),
+    ]
+    stub = StubCloudWatch(
+        {
+            "maxANOMV0": {1: 0.0},
+            "maxANOMNV0": {1: 0.0},
+            "sumNOER0": {1: 24.0},
+            "avgGISI0": {1: 2.0},
+            "avgCL0": {1: 0.0},
+            "maxANOMV1": {1: 30.0},
+            "maxANOMNV1": {1: 2.0},
+            "sumNOER1": {1: 0.0},
+            "avgGISI1": {1: 1.0},
+        }
+    )
+    autoscaling = StubAutoScaling(
+        [
+            {
+                "AutoScalingGroupName": "group-b",
+                "MinSize": 0,
+                "MaxSize": 10,
+                "DesiredCapacity": 1,
+            }
+        ]
+    )
+    ssm = StubSSM(json.dumps({"stack-a": 10.0}))
+    monkeypatch.setattr(load_metric, "CW", stub)
+    monkeypatch.setattr(load_metric, "AS", autoscaling)
+    monkeypatch.setattr(load_metric, "SSM", ssm)
+    monkeypatch.setenv("BaselineParameter", "baseline")
+    load_metric.handler({"WorkerSets": worker_sets}, None)
+    data = stub.put_calls[0]["MetricData"]
+    assert [(d["MetricName"], d["Value"]) for d in data] == [
+        ("ClusterLoad", 1.0 - 24.0 / (2.0 * 10.0))
+    ]
+    assert ssm.put_calls == []
+    assert autoscaling.set_calls == []
+
+
+def test_handler_emits_embedded_metric_format(monkeypatch, capsys):
+    stub = StubCloudWatch(
+        {
+            "maxANOMV0": 3.0,
+            "maxANOMNV0": 0.0,
+            "sumNOER0": 0.0,
+            "avgGISI0": 1.0,
+        }
+    )
+    monkeypatch.setattr(load_metric, "CW", stub)
+    monkeypatch.setenv("MetricOutput", "emf")
+    load_metric.handler({"WorkerSets": WORKER_SETS[:1]}, None)
+    assert stub.put_calls == []
+    [line] = capsys.readouterr().out.splitlines()
+    record = json.loads(line)
+    [directive] = record["_aws"]["CloudWatchMetrics"]
+    assert directive["Namespace"] == "Turbine"
+    assert directive["Dimensions"] == [["StackName"]]
+    assert [m["Name"] for m in directive["Metrics"]] == [
+        "ANOMV",
+        "ANOMNV",
+        "NOER",
+        "GISI",
+        "EmptyReceiveBaseline",
+        "ClusterLoad",
+    ]
+    assert record["StackName"] == "stack-a"
+    assert record["ANOMV"] == 3.0
+    assert record["ClusterLoad"] == 1.0
+
+
+def test_handler_uses_occupancy_for_redis_worker_sets(monkeypatch):
+    worker_sets = [dict(WORKER_SETS[0], Broker="Redis", WorkerSlots=8)]
+    stub = StubCloudWatch({"maxANOMV0": 2.0, "maxANOMNV0": 4.0, "avgGISI0": 1.0})
+    monkeypatch.setattr(load_metric, "CW", stub)
+    load_metric.handler({"WorkerSets": worker_sets}, None)
+    queries = {q["Id"]: q for q in stub.get_calls[0]["MetricDataQueries"]}
+    assert set(queries) == {"maxANOMV0", "maxANOMNV0", "avgGISI0", "avgCL0"}
+    metric = queries["maxANOMV0"]["MetricStat"]["Metric"]
+    assert metric["Namespace"] == "Turbine"
+    assert metric["MetricName"] == "QueueMessagesVisible"
+    assert metric["Dimensions"] == [{"Name": "QueueName", "Value": "queue-a"}]
+    data = stub.put_calls[0]["MetricData"]
+    assert [(d["MetricName"], d["Value"]) for d in data] == [("ClusterLoad", 0.75)]
+
+
+def test_handler_skips_redis_worker_sets_without_queue_metrics(monkeypatch):
+    worker_sets = [dict(WORKER_SETS[0], Broker="Redis", WorkerSlots=8)]
+    stub = StubCloudWatch({"avgGISI0": 2.0})
+    monkeypatch.setattr(load_metric, "CW", stub)
+    load_metric.handler({"WorkerSets": worker_sets}, None)
+    assert all(not call["MetricData"] for call in stub.put_calls)
+
+
+def test_handler_uses_occupancy_for_the_occupancy_load_formula(monkeypatch):
+    worker_sets = [dict(WORKER_SETS[0], LoadFormula="Occupancy", WorkerSlots=8)]
+    stub = StubCloudWatch(
+        {
+            "maxANOMV0": 0.0,
+            "maxANOMNV0": 4.0,
+            "sumNOER0": 3.0,
+            "avgGISI0": 1.0,
+        }
+    )
+    monkeypatch.setattr(load_metric, "CW", stub)
+    load_metric.handler({"WorkerSets": worker_sets}, None)
+    data = stub.put_calls[0]["MetricData"]
+    assert [(d["MetricName"], d["Value"]) for d in data] == [("ClusterLoad", 0.5)]
@@ -0,0 +1,118 @@
+import collections
+import gzip
+import os
+import sys
+import time
+
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "scripts"))
+
+import airflow_log_housekeeping as housekeeping  # noqa: E402
+
+Usage = collections.namedtuple("Usage", "total used free")
+HOUR = 3600
+
+
+class StubS3:
+    def __init__(self, sizes):
+        self.sizes = sizes
+        self.prefixes = []
+
+    def get_paginator(self, _operation):
+        return self
+
+    def paginate(self, Bucket, Prefix):
+        assert Bucket == "logs"
+        self.prefixes.append(Prefix)
+        yield {
+            "Contents": [
+                {"Key": key, "Size": size}
+                for key, size in self.sizes.items()
+                if key.startswith(Prefix)
+            ]
+        }
+
+
+class StubCloudWatch:
+    def __init__(self):
+        self.put_calls = []
+
+    def put_metric_data(self, **kwargs):
+        self.put_calls.append(kwargs)
+
+
+def write_log(root, relative, content, age):
+    path = os.path.join(root, "logs", relative)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as log:
+        log.write(content)
+    mtime = time.time() - age
+    os.utime(path, (mtime, mtime))
+    return path
+
+
+def run(monkeypatch, tmp_path, remote, used=(50, 50)):
+    used = list(used)
+    s3 = StubS3(remote)
+    cloudwatch = StubCloudWatch()
+    monkeypatch.setenv("AIRFLOW_HOME", str(tmp_path))
+    monkeypatch.setenv("AIRFLOW__CORE__REMOTE_BASE_LOG_FOLDER", "s3://logs")
+    monkeypatch.setenv("REMOVE_LOGS_OLDER_THAN_X_DAYS", "7")
+    monkeypatch.setenv("LOG_DISK_BUDGET_PERCENT", "70")
+    monkeypatch.setenv("AWS_STACK_NAME", "stack")
+    monkeypatch.setattr(housekeeping, "S3", s3)
+    monkeypatch.setattr(housekeeping, "CW", cloudwatch)
+    monkeypatch.setattr(
+        housekeeping, "disk_usage", lambda _root: Usage(100, used.pop(0), 0)
+    )
+    housekeeping.housekeep()
+    return s3, cloudwatch
+
+
+def test_compresses_only_finished_logs_found_remotely(monkeypatch, tmp_path):
+    uploaded = write_log(tmp_path, "dag/task/2020-01-01/1.log", "done " * 100, HOUR)
+    pending = write_log(tmp_path, "dag/task/2020-01-01/2.log", "done", HOUR)
+    running = write_log(tmp_path, "dag/task/2020-01-02/1.log", "running", 60)
+    scheduler = write_log(tmp_path, "scheduler/2020-01-01/dag.py.log", "x", HOUR)
+    s3, cloudwatch = run(monkeypatch, tmp_path, {"dag/task/2020-01-01/1.log": 500})
+    assert s3.prefixes == ["dag/task/2020-01-01/"]
+    assert not os.path.exists(uploaded)
+    with gzip.open(uploaded + ".gz", "rt") as log:
+        assert log.read() == "done " * 100
+    assert os.path.getmtime(uploaded + ".gz") < time.time() - HOUR + 5
+    assert os.path.exists(pending)
+    assert os.path.exists(running)
+    assert os.path.exists(scheduler)
+    metrics = cloudwatch.put_calls[0]["MetricData"]
+    assert metrics[0]["Value"] == 500 - os.path.getsize(uploaded + ".gz")
+    assert metrics[1] == {
+        "MetricName": "LogDiskUsage",
+        "Dimensions": [{"Name": "StackName", "Value": "stack"}],
+        "Value": 50,
+        "Unit": "Percent",
+    }
+
+
+def test_evicts_oldest_compressed_logs_over_budget(monkeypatch, tmp_path):
+    oldest = write_log(tmp_path, "dag/a/2020-01-01/1.log", "a", 3 * HOUR)
+    older = write_log(tmp_path, "dag/a/2020-01-02/1.log", "b", 2 * HOUR)
+    newest = write_log(tmp_path, "dag/a/2020-01-03/1.log", "c", HOUR)
+    unconfirmed = write_log(tmp_path, "dag/b/2020-01-01/1.log", "d", 4 * HOUR)
+    remote = {
+        "dag/a/2020-01-01/1.log": 1,
+        "dag/a/2020-01-02/1.log": 1,
+        "dag/a/2020-01-03/1.log": 1,
+    }
+    # Used 1 byte over the budget, which the oldest compressed log covers
+    run(monkeypatch, tmp_path, remote, used=(71, 69))
+    assert not os.path.exists(oldest + ".gz")
+    assert os.path.exists(older + ".gz")
+    assert os.path.exists(newest + ".gz")
+    assert os.path.exists(unconfirmed)
+
+
+def test_removes_logs_past_the_age_limit(monkeypatch, tmp_path):
+    old = write_log(tmp_path, "scheduler/2020-01-01/dag.py.log", "x" * 10, 8 * 86400)
+    _s3, cloudwatch = run(monkeypatch, tmp_path, {})
+    assert not os.path.exists(old)
+    assert cloudwatch.put_calls[0]["MetricData"][0]["Value"] == 10
@@ -0,0 +1,69 @@
+import json
+import os
+import sys
+
+import pytest
+
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "scripts"))
+
+import airflow_queue_depth as queue_depth  # noqa: E402
+
+
+class StubRedis:
+    def __init__(self, lists, unacked):
+        self.lists = lists
+        self.unacked = unacked
+
+    def llen(self, key):
+        return len(self.lists.get(key, []))
+
+    def hscan_iter(self, name):
+        assert name == "unacked"
+        for tag, routing_key in self.unacked.items():
+            yield tag, json.dumps([{"body": "..."}, "", routing_key]).encode()
+
+
+class StubCloudWatch:
+    def __init__(self):
+        self.metric_data = []
+
+    def put_metric_data(self, Namespace, MetricData):
+        assert Namespace == "Turbine"
+        self.metric_data += MetricData
+
+
+@pytest.fixture
+def queues(monkeypatch):
+    # The small queue is empty without a small worker
+    monkeypatch.setenv("QUEUE_NAMES", "default,,heavy")
+    monkeypatch.setenv("AIRFLOW__DEDUCTIVE_CUSTOM__OTHER_QUEUE", "other")
+    return queue_depth.queue_names()
+
+
+def test_queue_names(queues):
+    assert queues == ["default", "heavy"]
+
+
+def test_counts_every_priority_and_the_unacked_messages(monkeypatch, queues):
+    stub = StubRedis(
+        {
+            "default": ["a", "b"],
+            "default\x06\x169": ["c"],
+            "heavy": ["d"],
+            "other": ["e"],
+        },
+        {"1": "default", "2": "heavy", "3": "heavy", "4": "other"},
+    )
+    monkeypatch.setattr(queue_depth, "REDIS", stub)
+    assert queue_depth.sample(queues) == {"default": (3, 1), "heavy": (1, 2)}
+
+
+def test_publishes_by_queue_name(monkeypatch):
+    cloudwatch = StubCloudWatch()
+    monkeypatch.setattr(queue_depth, "CW", cloudwatch)
+    queue_depth.publish({"heavy": [4, 2]})
+    assert [
+        (datum["MetricName"], datum["Dimensions"][0]["Value"], datum["Value"])
+        for datum in cloudwatch.metric_data
+    ] == [("QueueMessagesVisible", "heavy", 4), ("QueueMessagesInFlight", "heavy", 2)]
@@ -0,0 +1,49 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "simulator"))
+
+import simulate  # noqa: E402
+
+
+def test_synthetic_trace_is_reproducible():
+    assert simulate.synthetic_trace(1, seed=1) == simulate.synthetic_trace(1, seed=1)
+
+
+def test_simulation_scales_out_and_back_in():
+    trace = simulate.synthetic_trace(1, burst_tasks=100, background_rate=0)
+    cw = simulate.load_metric.CW
+    report = simulate.Simulation(trace, boot_time=60).run(2 * 3600)
+    assert simulate.load_metric.CW is cw
+    assert report["started"] == report["tasks"] == 100
+    assert report["scale_outs"] > 0
+    assert report["scale_ins"] > 0
+    assert 0 < report["instance_hours"] < 2 * 10
+
+
+def test_desired_capacity_mode_scales_out_in_one_step():
+    trace = [(0, 600)] * 64
+    simulation = simulate.Simulation(
+        trace, scaling_mode="DesiredCapacity", worker_slots=16, boot_time=60
+    )
+    report = simulation.run(3600)
+    assert simulation.actions[0][1] == 4
+    assert report["wait_max"] < 600
+
+
+def test_step_scaling_adds_several_instances_at_once():
+    trace = simulate.synthetic_trace(1, burst_tasks=200, background_rate=0)
+    simulation = simulate.Simulation(
+        trace, min_size=1, scaling_policy_type="StepScaling", boot_time=60
+    )
+    simulation.run(3600)
+    assert max(change for _, change in simulation.actions) > 1
+
+
+def test_occupancy_load_formula_scales_out_and_back_in():
+    trace = simulate.synthetic_trace(1, burst_tasks=100, background_rate=0)
+    simulation = simulate.Simulation(trace, boot_time=60, load_formula="Occupancy")
+    report = simulation.run(2 * 3600)
+    assert report["started"] == report["tasks"] == 100
+    assert report["scale_outs"] > 0
+    assert report["scale_ins"] > 0
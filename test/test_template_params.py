@@ -1,6 +1,6 @@
 import re
 from cfn_tools import dump_yaml
-from templates import ALL, MASTER, CLUSTER, SCHEDULER, WEBSERVER, WORKERSET
+from templates import ALL, MASTER, CLUSTER, SCHEDULER, WEBSERVER, WORKERSET, PGBOUNCER
 
 
 def test_if_important_properties_are_specified():
@@ -65,6 +65,7 @@ def test_consistency():
         (CLUSTER, SCHEDULER),
         (CLUSTER, WEBSERVER),
         (CLUSTER, WORKERSET),
+        (CLUSTER, PGBOUNCER),
     ]
     for (t_outer, t_inner) in pairs:
         for param1, specs1 in t_outer["Parameters"].items():
@@ -0,0 +1,322 @@
+import importlib.util
+import json
+import os
+import re
+import string
+import sys
+
+import pytest
+
+# The generator imports the dashboards as psyclone.dashboards, so the checkout is
+# loaded as the psyclone package whatever the name of its folder
+ROOT = os.path.join(os.path.dirname(__file__), "..")
+if "psyclone" not in sys.modules:
+    spec = importlib.util.spec_from_file_location(
+        "psyclone",
+        os.path.join(ROOT, "__init__.py"),
+        submodule_search_locations=[ROOT],
+    )
+    sys.modules["psyclone"] = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(sys.modules["psyclone"])
+
+from psyclone.update_yaml_templates import UpdateTemplates  # noqa: E402
+
+
+@pytest.fixture
+def no_credentials(monkeypatch, tmp_path):
+    """Leaves boto3 no credentials to find, so that any AWS call fails"""
+    for name in [
+        "AWS_ACCESS_KEY_ID",
+        "AWS_SECRET_ACCESS_KEY",
+        "AWS_SESSION_TOKEN",
+        "AWS_SECURITY_TOKEN",
+        "AWS_PROFILE",
+        "AWS_CONTAINER_CREDENTIALS_RELATIVE_URI",
+        "AWS_CONTAINER_CREDENTIALS_FULL_URI",
+        "AWS_WEB_IDENTITY_TOKEN_FILE",
+    ]:
+        monkeypatch.delenv(name, raising=False)
+    monkeypatch.setenv("AWS_CONFIG_FILE", str(tmp_path / "config"))
+    monkeypatch.setenv("AWS_SHARED_CREDENTIALS_FILE", str(tmp_path / "credentials"))
+    monkeypatch.setenv("AWS_EC2_METADATA_DISABLED", "true")
+
+
+class StageTemplates(UpdateTemplates):
+    STAGE_NAMES_AND_CONFIGS = {
+        "DEV": {
+            "worker_instance_type": "c5.xlarge",
+            "celery": {"prefetch_multiplier": 2},
+            "instances": {"alternative_types": ["c6i.xlarge"]},
+        }
+    }
+
+
+def test_templates_generate_and_validate_without_credentials(
+    monkeypatch, no_credentials, tmp_path
+):
+    monkeypatch.setattr(
+        StageTemplates, "VALIDATION_CACHE_PATH", str(tmp_path / "cache")
+    )
+    templates = StageTemplates(
+        "./templates", "./policies", str(tmp_path), "DEV", "project"
+    )
+    templates.update_instance_types()
+    templates.add_new_workerset("r5.large", 0, 4, "Heavy")
+    profile = templates.performance_profile()
+    templates.update_templates()
+
+    assert profile["core"]["parallelism"] > 0
+    for name in templates.templates_dict:
+        assert (tmp_path / "turbine-{}.template".format(name)).exists()
+    assert len(os.listdir(str(tmp_path / "cache"))) == len(templates.templates_dict)
+
+
+def test_load_metric_input_fits_a_dozen_worker_sets(no_credentials, tmp_path):
+    templates = StageTemplates(
+        "./templates", "./policies", str(tmp_path), "DEV", "project"
+    )
+    for label in string.ascii_uppercase[:11]:
+        templates.add_new_workerset("m5.large", 0, 4, label)
+
+    # Rendered with the longest physical names CloudFormation generates: 80
+    # characters for a queue and 128 for a stack
+    stack = "s" * 128
+    config = templates.templates_dict["workerset"]["Outputs"]["LoadMetricConfig"]
+    values = {
+        "QueueName": "q" * 80,
+        "AutoScalingGroup": stack + "-AutoScalingGroup-ABCDEFGHIJKLM",
+        "AWS::StackName": stack,
+        "ScalingMode": "DesiredCapacity",
+        "WorkerSlots": "64",
+        "FastScaling": "False",
+        "CeleryBroker": "Redis",
+        "LoadFormula": "EmptyReceives",
+    }
+    rendered_config = re.sub(
+        r"\$\{([^}]+)\}", lambda m: values[m.group(1)], config["Value"]["Fn::Sub"]
+    )
+    target = templates.templates_dict["cluster"]["Resources"][
+        "CloudWatchMetricLambdaTimer"
+    ]["Properties"]["Targets"][0]
+    prefix, configs, suffix = target["Input"]["Fn::Join"][1]
+    rendered = prefix + ",".join(rendered_config for _ in configs["Fn::Join"][1])
+    rendered += suffix
+
+    assert len(json.loads(rendered)["WorkerSets"]) == 12
+    # EventBridge caps the constant input of a target at 8192 characters
+    assert len(rendered) <= 8192
+
+
+def test_queue_settings_are_cast(no_credentials, tmp_path):
+    templates = StageTemplates(
+        "./templates", "./policies", str(tmp_path), "DEV", "project"
+    )
+    templates.add_new_workerset(
+        "m5.large",
+        0,
+        4,
+        "Heavy",
+        queue={
+            "wait_time_seconds": "20",
+            "visibility_timeout": "3600",
+            "polling_interval": "0.5",
+        },
+    )
+    parameters = templates.templates_dict["cluster"]["Resources"][
+        "WorkerSetStackHeavy"
+    ]["Properties"]["Parameters"]
+    assert parameters["QueueWaitTime"] == 20
+    assert parameters["QueueVisibilityTimeout"] == 3600
+    assert parameters["QueuePollingInterval"] == 0.5
+    assert parameters["LoadFormula"] == "Occupancy"
+
+    with pytest.raises(ValueError):
+        templates.add_new_workerset(
+            "m5.large", 0, 4, "Light", queue={"polling_interval": "-1"}
+        )
+
+
+def stage_templates(tmp_path, **config):
+    """Templates of a DEV stage with the given config, its instance types applied"""
+    templates = type(
+        "ConfiguredTemplates",
+        (UpdateTemplates,),
+        {"STAGE_NAMES_AND_CONFIGS": {"DEV": config}},
+    )("./templates", "./policies", str(tmp_path), "DEV", "project")
+    templates.update_instance_types()
+    return templates
+
+
+def workerset_parameters(templates, ws_stack_name="WorkerSetStack"):
+    return templates.templates_dict["cluster"]["Resources"][ws_stack_name][
+        "Properties"
+    ]["Parameters"]
+
+
+class StubEC2:
+    def __init__(self, instance_types):
+        self.instance_types = instance_types
+        self.calls = []
+
+    def describe_instance_types(self, InstanceTypes):
+        self.calls.extend(InstanceTypes)
+        vcpus, memory = self.instance_types[InstanceTypes[0]]
+        return {
+            "InstanceTypes": [
+                {
+                    "VCpuInfo": {"DefaultVCpus": vcpus},
+                    "MemoryInfo": {"SizeInMiB": memory},
+                }
+            ]
+        }
+
+
+@pytest.mark.parametrize(
+    "instance_type, concurrency, autoscale",
+    [
+        # 2 vCPUs, 4 GiB: bound by the vCPUs
+        ("t3.medium", 4, "4,2"),
+        # 2 vCPUs, 2 GiB: bound by the memory left for the tasks
+        ("t3.small", 2, "2,2"),
+        # 1 vCPU, 1 GiB: no memory left, a single task
+        ("t2.micro", 1, "1,1"),
+        # 16 vCPUs, 64 GiB
+        ("m5.4xlarge", 32, "32,16"),
+    ],
+)
+def test_celery_is_sized_for_the_instance_type(
+    no_credentials, tmp_path, instance_type, concurrency, autoscale
+):
+    templates = stage_templates(tmp_path, worker_instance_type=instance_type)
+    parameters = workerset_parameters(templates)
+    assert parameters["WorkerConcurrency"] == concurrency
+    assert parameters["WorkerAutoscale"] == autoscale
+    assert parameters["WorkerPrefetchMultiplier"] == 1
+    assert parameters["WorkerMaxTasksPerChild"] == 100
+    assert parameters["WorkerSlots"] == concurrency
+
+
+def test_celery_overrides(no_credentials, tmp_path):
+    templates = stage_templates(
+        tmp_path,
+        worker_instance_type="m5.4xlarge",
+        celery={
+            "concurrency": "6",
+            "autoscale": None,
+            "prefetch_multiplier": 2,
+            "max_tasks_per_child": 0,
+        },
+    )
+    parameters = workerset_parameters(templates)
+    assert parameters["WorkerConcurrency"] == 6
+    assert parameters["WorkerAutoscale"] == ""
+    assert parameters["WorkerPrefetchMultiplier"] == 2
+    assert parameters["WorkerMaxTasksPerChild"] == 0
+    assert parameters["WorkerSlots"] == 6
+
+    # The pool grows up to the max size of autoscale, explicit worker slots are kept
+    templates.add_new_workerset(
+        "m5.large", 0, 4, "Heavy", worker_slots=10, celery={"autoscale": [8, 3]}
+    )
+    parameters = workerset_parameters(templates, "WorkerSetStackHeavy")
+    assert parameters["WorkerConcurrency"] == 8
+    assert parameters["WorkerAutoscale"] == "8,3"
+    assert parameters["WorkerSlots"] == 10
+
+    with pytest.raises(ValueError):
+        templates.add_new_workerset(
+            "m5.large", 0, 4, "Light", celery={"autoscale": [2, 3]}
+        )
+
+
+def test_instance_types_missing_from_the_table_are_looked_up_once(
+    no_credentials, tmp_path
+):
+    templates = stage_templates(tmp_path)
+    ec2 = StubEC2({"x9.huge": (12, 49152)})
+    templates._ec2 = ec2
+
+    # Without celery settings the template defaults are kept, with no lookup
+    templates.add_new_workerset("x9.huge", 0, 4, "Default")
+    assert "WorkerConcurrency" not in workerset_parameters(
+        templates, "WorkerSetStackDefault"
+    )
+    templates.add_new_workerset("m5.large", 0, 4, "Table", celery={})
+    assert ec2.calls == []
+
+    for label in ["Looked", "Cached"]:
+        templates.add_new_workerset(
+            "x9.huge", 0, 4, label, celery={"prefetch_multiplier": 1}
+        )
+        parameters = workerset_parameters(templates, "WorkerSetStack" + label)
+        assert parameters["WorkerConcurrency"] == 24
+        assert parameters["WorkerAutoscale"] == "24,12"
+    assert ec2.calls == ["x9.huge"]
+
+
+def test_performance_profile_defaults(no_credentials, tmp_path):
+    # db.t2.micro allows 112 connections, t3.medium workers take 4 tasks each
+    templates = stage_templates(tmp_path)
+    assert templates.performance_profile() == {
+        "core": {
+            "parallelism": 40,
+            "dag_concurrency": 20,
+            "sql_alchemy_pool_size": 3,
+            "sql_alchemy_max_overflow": 3,
+            "store_serialized_dags": True,
+            "store_dag_code": True,
+            "min_serialized_dag_update_interval": 30,
+        },
+        "scheduler": {"max_threads": 2},
+        "webserver": {"workers": 3},
+    }
+
+    # 80 task slots, but only 92 connections for 2 each
+    templates.add_new_workerset("m5.large", 0, 10, "Heavy")
+    assert templates.performance_profile()["core"]["parallelism"] == 46
+
+
+def test_performance_profile_of_large_instances(no_credentials, tmp_path):
+    templates = stage_templates(
+        tmp_path,
+        scheduler_instance_type="m5.xlarge",
+        webserver_instance_type="m5.xlarge",
+        rds_instance_type="db.r5.24xlarge",
+        performance_profile={"webserver": {"workers": 4}},
+    )
+    # 192 tasks on each of 50 instances, on top of the 40 of the default workerset
+    templates.add_new_workerset("m5.24xlarge", 0, 50, "Heavy")
+    profile = templates.performance_profile()
+    # The 768 GiB of the database would allow 86517 connections, RDS caps them at
+    # 5000, of which 20 are reserved
+    assert profile["core"]["parallelism"] == 2490
+    assert profile["core"]["dag_concurrency"] == 1245
+    assert profile["core"]["sql_alchemy_pool_size"] == 5
+    assert profile["scheduler"]["max_threads"] == 4
+    assert profile["webserver"]["workers"] == 4
+
+
+@pytest.mark.parametrize(
+    "pgbouncer, pool_size, max_client_connections, parallelism",
+    [
+        # 92 database connections pooled for 360 clients, 160 of them for 80 task slots
+        ({}, 92, 360, 80),
+        ({"pool_size": 50, "max_client_connections": 300}, 50, 300, 50),
+    ],
+)
+def test_performance_profile_with_pgbouncer(
+    no_credentials, tmp_path, pgbouncer, pool_size, max_client_connections, parallelism
+):
+    templates = stage_templates(
+        tmp_path, pgbouncer=dict(pgbouncer, instance_type="t3.small")
+    )
+    templates.add_new_workerset("m5.large", 0, 10, "Heavy")
+    profile = templates.performance_profile()
+    master_parameters = templates.templates_dict["master"]["Parameters"]
+    assert master_parameters["PgBouncerInstanceType"]["Default"] == "t3.small"
+    assert master_parameters["PgBouncerPoolSize"]["Default"] == pool_size
+    assert (
+        master_parameters["PgBouncerMaxClientConnections"]["Default"]
+        == max_client_connections
+    )
+    assert profile["core"]["parallelism"] == parallelism
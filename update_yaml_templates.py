@@ -1,5 +1,8 @@
+import concurrent.futures
 import configparser
 import glob
+import hashlib
+import itertools
 import json
 import logging
 import os
@@ -10,7 +13,10 @@ import sys
 import boto3
 from awacs.aws import PolicyDocument, Statement, Principal, Action, Condition, StringEquals
 from cfn_tools import load_yaml, dump_yaml
-from troposphere import Ref, Parameter, Template, Output, Join, GetAtt, Split, NoValue, AccountId, Sub
+from cfnlint.api import lint
+from cfnlint.core import get_rules
+from cfnlint.version import __version__ as cfnlint_version
+from troposphere import Ref, Parameter, Template, Output, Join, GetAtt, If, Split, NoValue, AccountId, Sub
 from troposphere import cloudformation
 from troposphere import ec2
 from troposphere import elasticloadbalancingv2
@@ -36,14 +42,76 @@ class Labels:
     workerset_label = "workerset"
     scheduler_label = "scheduler"
     webserver_label = "webserver"
+    pgbouncer_label = "pgbouncer"
     vpc_s3_endpoint_id = "VPCS3EndpointID"
 
 
+def _lint_template(body, region, ignore_checks):
+    """
+    Runs the schema and lint checks of cfn-lint on a template, in a process of its own as the checks are CPU bound
+    :return: list of the rule id, line and message of the errors and warnings found
+    """
+    rules = get_rules([], list(ignore_checks), ["W", "E"])
+    return [[match.rule.id, match.linenumber, match.message] for match in lint(body, rules, [region])]
+
+
 class UpdateTemplates:
     ALLOWED_STAGES = ["PROD", "STAG", "DEV", "DEV-1", "DEV-2", "DEV-3"]
     PRODLIKE_STACKS = ["PROD", "STAG"]
     DOMAIN = "psyclone.pro"
     STAGE_NAMES_AND_CONFIGS = ()
+    # Airflow tasks mostly wait on other systems, so a vCPU runs two of them, and each takes about 512 MiB for its
+    # airflow run process and their --raw child, beside the 1 GiB kept for the worker itself and the system
+    TASKS_PER_VCPU = 2
+    TASK_MEMORY_MIB = 512
+    RESERVED_MEMORY_MIB = 1024
+    # vCPUs and memory in MiB of the common instance types, and of the database instance classes of the same name, so
+    # that sizing for them needs no AWS credentials. Any other type is looked up with EC2
+    INSTANCE_TYPES = {
+        "t2.nano": (1, 512), "t2.micro": (1, 1024), "t2.small": (1, 2048), "t2.medium": (2, 4096),
+        "t2.large": (2, 8192), "t2.xlarge": (4, 16384), "t2.2xlarge": (8, 32768),
+        "t3.nano": (2, 512), "t3.micro": (2, 1024), "t3.small": (2, 2048), "t3.medium": (2, 4096),
+        "t3.large": (2, 8192), "t3.xlarge": (4, 16384), "t3.2xlarge": (8, 32768),
+        "t3a.nano": (2, 512), "t3a.micro": (2, 1024), "t3a.small": (2, 2048), "t3a.medium": (2, 4096),
+        "t3a.large": (2, 8192), "t3a.xlarge": (4, 16384), "t3a.2xlarge": (8, 32768),
+        "m5.large": (2, 8192), "m5.xlarge": (4, 16384), "m5.2xlarge": (8, 32768), "m5.4xlarge": (16, 65536),
+        "m5.8xlarge": (32, 131072), "m5.12xlarge": (48, 196608), "m5.16xlarge": (64, 262144),
+        "m5.24xlarge": (96, 393216),
+        "m5a.large": (2, 8192), "m5a.xlarge": (4, 16384), "m5a.2xlarge": (8, 32768), "m5a.4xlarge": (16, 65536),
+        "m5a.8xlarge": (32, 131072), "m5a.12xlarge": (48, 196608), "m5a.16xlarge": (64, 262144),
+        "m5a.24xlarge": (96, 393216),
+        "m6i.large": (2, 8192), "m6i.xlarge": (4, 16384), "m6i.2xlarge": (8, 32768), "m6i.4xlarge": (16, 65536),
+        "m6i.8xlarge": (32, 131072), "m6i.12xlarge": (48, 196608), "m6i.16xlarge": (64, 262144),
+        "m6i.24xlarge": (96, 393216),
+        "c5.large": (2, 4096), "c5.xlarge": (4, 8192), "c5.2xlarge": (8, 16384), "c5.4xlarge": (16, 32768),
+        "c5.9xlarge": (36, 73728), "c5.12xlarge": (48, 98304), "c5.18xlarge": (72, 147456),
+        "c5.24xlarge": (96, 196608),
+        "c6i.large": (2, 4096), "c6i.xlarge": (4, 8192), "c6i.2xlarge": (8, 16384), "c6i.4xlarge": (16, 32768),
+        "c6i.8xlarge": (32, 65536), "c6i.12xlarge": (48, 98304), "c6i.16xlarge": (64, 131072),
+        "c6i.24xlarge": (96, 196608),
+        "r5.large": (2, 16384), "r5.xlarge": (4, 32768), "r5.2xlarge": (8, 65536), "r5.4xlarge": (16, 131072),
+        "r5.8xlarge": (32, 262144), "r5.12xlarge": (48, 393216), "r5.16xlarge": (64, 524288),
+        "r5.24xlarge": (96, 786432),
+        "r6i.large": (2, 16384), "r6i.xlarge": (4, 32768), "r6i.2xlarge": (8, 65536), "r6i.4xlarge": (16, 131072),
+        "r6i.8xlarge": (32, 262144), "r6i.12xlarge": (48, 393216), "r6i.16xlarge": (64, 524288),
+        "r6i.24xlarge": (96, 786432),
+    }
+    # A running task keeps a connection to the database from both its airflow run processes, the scheduler, webserver
+    # and maintenance sessions get the reserved ones
+    DB_CONNECTIONS_PER_TASK = 2
+    RESERVED_DB_CONNECTIONS = 20
+    WEBSERVER_WORKER_MEMORY_MIB = 256
+    # Through PgBouncer the client connections of the running tasks come on top of those of the SQLAlchemy pools of the
+    # scheduler and webserver processes
+    PGBOUNCER_RESERVED_CLIENT_CONNECTIONS = 200
+    # Templates are validated locally with cfn-lint, the results cached by the hash of the template in
+    # VALIDATION_CACHE_PATH, None not to cache them. Errors fail the generation, warnings are logged. The load metric
+    # function runs on a Lambda runtime deprecated since the pinned cfn-lint release (E2531)
+    VALIDATION_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".cache", "psyclone", "template-validation")
+    VALIDATION_IGNORE_CHECKS = ["E2531"]
+    # Validating with the CloudFormation API as well takes AWS credentials, and template bodies of up to 51200 bytes
+    REMOTE_VALIDATION = False
+    REMOTE_VALIDATION_MAX_BYTES = 51200
 
     @staticmethod
     def _random_generator(size=3, chars=string.ascii_lowercase):
@@ -61,12 +129,17 @@ class UpdateTemplates:
             Labels.cluster_label,
             Labels.webserver_label,
             Labels.scheduler_label,
-            Labels.workerset_label
+            Labels.workerset_label,
+            Labels.pgbouncer_label
         ]
         self.templates_dict = dict()
         self.region = region
-        # Only used for validating templates currently, hence region isn't mandatory
+        # Only used for validating templates with REMOTE_VALIDATION, hence region isn't mandatory
         self._cf = boto3.client("cloudformation", region_name=self.region if self.region else "us-east-1")
+        # Only used for the vCPUs and memory of the instance types missing from INSTANCE_TYPES, the same in every
+        # region, hence created on the first of them
+        self._ec2 = None
+        self._instance_types = {}
         self._load_templates()
         self.random_string = self._random_generator()
         self.project_name = project_name
@@ -144,6 +217,15 @@ class UpdateTemplates:
                         "Default"] = instance_type
                 else:
                     logger.info("No worker_instance_type detected")
+                for role in ["scheduler", "webserver"]:
+                    if role + "_instance_type" in self.STAGE_NAMES_AND_CONFIGS[self.stage_name]:
+                        instance_type = self.STAGE_NAMES_AND_CONFIGS[self.stage_name][role + "_instance_type"]
+                        logger.info("Updating templates to use {} as {} instance type from class attribute".format(
+                            instance_type, role))
+                        self.templates_dict[Labels.master_label]["Parameters"][role.title() + "InstanceType"][
+                            "Default"] = instance_type
+                    else:
+                        logger.info("No {}_instance_type detected".format(role))
                 if "rds_instance_type" in self.STAGE_NAMES_AND_CONFIGS[self.stage_name]:
                     rds_instance_type = self.STAGE_NAMES_AND_CONFIGS[self.stage_name]["rds_instance_type"]
                     logger.info("Updating templates to use {} as rds instance type from class attribute".format(
@@ -155,13 +237,472 @@ class UpdateTemplates:
                 if "max_spot_price" in self.STAGE_NAMES_AND_CONFIGS[self.stage_name]:
                     max_spot_price = self.STAGE_NAMES_AND_CONFIGS[self.stage_name]["max_spot_price"]
                     logger.info("Updating templates to use spot price {}".format(max_spot_price))
-                    self.templates_dict[Labels.workerset_label]["Resources"]["LaunchConfiguration"]["Properties"][
-                        "SpotPrice"] = max_spot_price
+                    workerset_parameters = self.templates_dict[Labels.workerset_label]["Parameters"]
+                    workerset_parameters["SpotMaxPrice"]["Default"] = str(max_spot_price)
+                    workerset_parameters["OnDemandPercentageAboveBaseCapacity"]["Default"] = 0
                 else:
                     logger.info('No max_spot_price not detected')
-
+                if "instances" in self.STAGE_NAMES_AND_CONFIGS[self.stage_name]:
+                    instances = self.STAGE_NAMES_AND_CONFIGS[self.stage_name]["instances"]
+                    logger.info("Updating default workerset to launch instances with {}".format(instances))
+                    self._set_workerset_instances(
+                        "WorkerSetStack",
+                        self.templates_dict[Labels.master_label]["Parameters"]["WorkerInstanceType"]["Default"],
+                        instances)
+                else:
+                    logger.info("No instances detected")
+                scaling_mode = self.STAGE_NAMES_AND_CONFIGS[self.stage_name].get("scaling_mode")
+                worker_slots = self.STAGE_NAMES_AND_CONFIGS[self.stage_name].get("worker_slots")
+                fast_scaling = self.STAGE_NAMES_AND_CONFIGS[self.stage_name].get("fast_scaling")
+                scaling_policy = self.STAGE_NAMES_AND_CONFIGS[self.stage_name].get("scaling_policy")
+                if scaling_mode or worker_slots or fast_scaling is not None or scaling_policy:
+                    logger.info(
+                        "Updating default workerset to use scaling mode {} with {} worker slots, fast scaling {}, "
+                        "scaling policy {}".format(scaling_mode, worker_slots, fast_scaling, scaling_policy))
+                    self._set_workerset_scaling(
+                        "WorkerSetStack", scaling_mode, worker_slots, fast_scaling, scaling_policy)
+                else:
+                    logger.info("No scaling_mode, worker_slots, fast_scaling or scaling_policy detected")
+                if "metric_output" in self.STAGE_NAMES_AND_CONFIGS[self.stage_name]:
+                    metric_output = self.STAGE_NAMES_AND_CONFIGS[self.stage_name]["metric_output"]
+                    if metric_output not in ("api", "emf"):
+                        raise ValueError("metric_output must be either api or emf")
+                    logger.info("Updating load metric function to publish metrics with {}".format(metric_output))
+                    self.templates_dict[Labels.cluster_label]["Resources"]["CloudWatchMetricLambda"]["Properties"][
+                        "Environment"]["Variables"]["MetricOutput"] = metric_output
+                else:
+                    logger.info("No metric_output detected")
+                if "warm_pool_size" in self.STAGE_NAMES_AND_CONFIGS[self.stage_name]:
+                    warm_pool_size = self.STAGE_NAMES_AND_CONFIGS[self.stage_name]["warm_pool_size"]
+                    logger.info("Updating default workerset to use a warm pool of {} instances".format(warm_pool_size))
+                    self._set_workerset_warm_pool("WorkerSetStack", warm_pool_size)
+                else:
+                    logger.info("No warm_pool_size detected")
+                if "efs_dags_folder" in self.STAGE_NAMES_AND_CONFIGS[self.stage_name]:
+                    efs_dags_folder = self.STAGE_NAMES_AND_CONFIGS[self.stage_name]["efs_dags_folder"].strip("/")
+                    logger.info("Updating templates to parse DAGs from a local mirror of {} on EFS".format(
+                        efs_dags_folder))
+                    for label in [Labels.scheduler_label, Labels.workerset_label]:
+                        self.templates_dict[label]["Parameters"]["EfsDagsFolder"]["Default"] = efs_dags_folder
+                else:
+                    logger.info("No efs_dags_folder detected")
+                if "dag_distribution" in self.STAGE_NAMES_AND_CONFIGS[self.stage_name]:
+                    dag_distribution = self.STAGE_NAMES_AND_CONFIGS[self.stage_name]["dag_distribution"]
+                    allowed = self.templates_dict[Labels.scheduler_label]["Parameters"]["DagDistribution"][
+                        "AllowedValues"]
+                    if dag_distribution not in allowed:
+                        raise ValueError("dag_distribution must be one of {}".format(allowed))
+                    if dag_distribution == "Bundle" and "efs_dags_folder" in self.STAGE_NAMES_AND_CONFIGS[
+                            self.stage_name]:
+                        raise ValueError("DAG bundles replace the DAG folder, remove efs_dags_folder to use them")
+                    logger.info("Updating templates to distribute the DAGs with {}".format(dag_distribution))
+                    for label in [Labels.scheduler_label, Labels.webserver_label, Labels.workerset_label]:
+                        self.templates_dict[label]["Parameters"]["DagDistribution"]["Default"] = dag_distribution
+                else:
+                    logger.info("No dag_distribution detected")
+                if "pgbouncer" in self.STAGE_NAMES_AND_CONFIGS[self.stage_name]:
+                    pgbouncer = self.STAGE_NAMES_AND_CONFIGS[self.stage_name]["pgbouncer"]
+                    unknown = set(pgbouncer) - {"instance_type", "pool_size", "max_client_connections"}
+                    if unknown or "instance_type" not in pgbouncer:
+                        raise ValueError("pgbouncer must set instance_type, and may set pool_size and "
+                                         "max_client_connections")
+                    logger.info("Updating templates to connect to the database through PgBouncer on {}".format(
+                        pgbouncer["instance_type"]))
+                    self.templates_dict[Labels.master_label]["Parameters"]["PgBouncerInstanceType"][
+                        "Default"] = pgbouncer["instance_type"]
+                else:
+                    logger.info("No pgbouncer detected")
+                master_parameters = self.templates_dict[Labels.master_label]["Parameters"]
+                for key, parameter in [("celery_broker", "CeleryBroker"),
+                                       ("celery_result_backend", "CeleryResultBackend")]:
+                    if key in self.STAGE_NAMES_AND_CONFIGS[self.stage_name]:
+                        value = self.STAGE_NAMES_AND_CONFIGS[self.stage_name][key]
+                        allowed = master_parameters[parameter]["AllowedValues"]
+                        if value not in allowed:
+                            raise ValueError("{} must be one of {}".format(key, allowed))
+                        logger.info("Updating templates to use {} as {}".format(value, key))
+                        master_parameters[parameter]["Default"] = value
+                    else:
+                        logger.info("No {} detected".format(key))
+                if master_parameters["CeleryBroker"]["Default"] == "Redis" and fast_scaling:
+                    raise ValueError("Fast scaling samples the SQS queues, remove fast_scaling to use the Redis broker")
+                if "redis_node_type" in self.STAGE_NAMES_AND_CONFIGS[self.stage_name]:
+                    redis_node_type = self.STAGE_NAMES_AND_CONFIGS[self.stage_name]["redis_node_type"]
+                    logger.info("Updating templates to use {} as Redis node type".format(redis_node_type))
+                    master_parameters["RedisNodeType"]["Default"] = redis_node_type
+                else:
+                    logger.info("No redis_node_type detected")
+
+        stage_config = (self.STAGE_NAMES_AND_CONFIGS or {}).get(self.stage_name, {})
+        instance_type = self.templates_dict[Labels.master_label]["Parameters"]["WorkerInstanceType"]["Default"]
+        logger.info("Updating default workerset to size its Celery worker for {}".format(instance_type))
+        self._set_workerset_celery(
+            "WorkerSetStack", instance_type, stage_config.get("celery"), stage_config.get("worker_slots"))
+        self._set_workerset_queue("WorkerSetStack", "TaskQueue", stage_config.get("queue"))
+        # The small queue follows the queue of the default workerset unless the small_queue key sets its own
+        queue = {key: value for key, value in (stage_config.get("queue") or {}).items() if key != "load_formula"}
+        self._set_small_queue(stage_config.get("small_queue", queue))
         return
 
+    def _set_workerset_scaling(self, ws_stack_name, scaling_mode=None, worker_slots=None, fast_scaling=None,
+                               scaling_policy=None):
+        """
+        Passes the scaling mode and worker slots to a workerset stack of the cluster template
+        :param ws_stack_name: logical name of the workerset stack within the cluster template
+        :param scaling_mode: ClusterLoad (alarms on the load metric) or DesiredCapacity (set from the queue depth)
+        :param worker_slots: number of tasks a single worker instance runs at once
+        :param fast_scaling: bool, sample the queue every 10 seconds and scale on high resolution alarms
+        :param scaling_policy: dict configuring the policy scaling on the cluster load, with the keys
+        - type: SimpleScaling (default), StepScaling or TargetTrackingScaling
+        - scale_out_steps: StepScaling, instances added for each of the three load intervals, e.g. [1, 2, 4]
+        - scale_out_step_bounds: StepScaling, offsets above the growth threshold between the intervals, e.g. [0.03, 0.08]
+        - scale_in_evaluation_periods: StepScaling, periods the load stays below the shrink threshold before scaling in
+        - target_load: TargetTrackingScaling, cluster load to keep
+        :return: None
+        """
+        allowed_modes = self.templates_dict[Labels.workerset_label]["Parameters"]["ScalingMode"]["AllowedValues"]
+        parameters = self.templates_dict[Labels.cluster_label]["Resources"][ws_stack_name]["Properties"]["Parameters"]
+        if scaling_mode is not None:
+            if scaling_mode not in allowed_modes:
+                raise ValueError("Parameter scaling_mode must be one of {}".format(allowed_modes))
+            parameters["ScalingMode"] = scaling_mode
+        if worker_slots is not None:
+            if int(worker_slots) < 1:
+                raise ValueError("Parameter worker_slots must be at least 1")
+            parameters["WorkerSlots"] = int(worker_slots)
+        if fast_scaling is not None:
+            broker = self.templates_dict[Labels.master_label]["Parameters"]["CeleryBroker"]["Default"]
+            if fast_scaling and broker == "Redis":
+                raise ValueError("Fast scaling samples the SQS queues, remove fast_scaling to use the Redis broker")
+            parameters["FastScaling"] = str(bool(fast_scaling))
+        if scaling_policy:
+            parameters.update(self._scaling_policy_parameters(scaling_policy, parameters["MinGroupSize"]))
+
+    def _set_workerset_warm_pool(self, ws_stack_name, warm_pool_size):
+        """
+        Attaches a warm pool of stopped, initialised instances to a workerset stack of the cluster template
+        :param ws_stack_name: logical name of the workerset stack within the cluster template
+        :param warm_pool_size: number of instances in the warm pool, 0 to remove it
+        :return: None
+        """
+        if int(warm_pool_size) < 0:
+            raise ValueError("Parameter warm_pool_size must not be negative")
+        workerset_parameters = self.templates_dict[Labels.workerset_label]["Parameters"]
+        parameters = self.templates_dict[Labels.cluster_label]["Resources"][ws_stack_name]["Properties"]["Parameters"]
+        on_demand_percentage, alternative_types = [
+            parameters.get(name, workerset_parameters[name]["Default"])
+            for name in ["OnDemandPercentageAboveBaseCapacity", "AlternativeInstanceTypes"]]
+        if int(warm_pool_size) and (int(on_demand_percentage) < 100 or alternative_types.strip(",")):
+            raise ValueError("Warm pools only launch a single instance type on demand, remove max_spot_price and the "
+                             "instances key to use warm_pool_size")
+        parameters["WarmPoolSize"] = int(warm_pool_size)
+
+    def _set_workerset_instances(self, ws_stack_name, instance_type, instances=None):
+        """
+        Sets the instances the mixed instances policy of a workerset stack of the cluster template launches, so that
+        scaling out goes on when the instance type or the spot pool of the workerset has no capacity
+        :param ws_stack_name: logical name of the workerset stack within the cluster template
+        :param instance_type: EC2 instance type of the workerset
+        :param instances: dict with the keys
+        - alternative_types: up to 3 instance types launched when the instance type has no capacity, with at least its
+        vCPUs and memory since the Celery worker is sized for it
+        - on_demand_base_capacity: instances always launched on demand, 0
+        - on_demand_percentage: percentage of the instances above the base capacity launched on demand, the others are
+        spot instances from the pools with the most capacity, 100
+        - max_spot_price: highest price per instance-hour of the spot instances, the on demand price if not set
+        :return: None
+        """
+        instances = instances or {}
+        unknown = set(instances) - {
+            "alternative_types", "on_demand_base_capacity", "on_demand_percentage", "max_spot_price"}
+        if unknown:
+            raise ValueError("Unknown instances keys {}".format(sorted(unknown)))
+
+        parameters = self.templates_dict[Labels.cluster_label]["Resources"][ws_stack_name]["Properties"]["Parameters"]
+        alternative_types = list(instances.get("alternative_types", []))
+        if len(alternative_types) > 3 or len(set(alternative_types + [instance_type])) != len(alternative_types) + 1:
+            raise ValueError("instances alternative_types must be up to 3 instance types other than {}".format(
+                instance_type))
+        vcpus, memory = self._instance_type_resources(instance_type)
+        for alternative_type in alternative_types:
+            alternative_vcpus, alternative_memory = self._instance_type_resources(alternative_type)
+            if alternative_vcpus < vcpus or alternative_memory < memory:
+                raise ValueError("Alternative instance type {} has less vCPUs or memory than {}".format(
+                    alternative_type, instance_type))
+        if alternative_types:
+            parameters["AlternativeInstanceTypes"] = ",".join(alternative_types + [""] * (3 - len(alternative_types)))
+        if "on_demand_base_capacity" in instances:
+            if int(instances["on_demand_base_capacity"]) < 0:
+                raise ValueError("instances on_demand_base_capacity must not be negative")
+            parameters["OnDemandBaseCapacity"] = int(instances["on_demand_base_capacity"])
+        if "on_demand_percentage" in instances:
+            if not 0 <= int(instances["on_demand_percentage"]) <= 100:
+                raise ValueError("instances on_demand_percentage must be between 0 and 100")
+            parameters["OnDemandPercentageAboveBaseCapacity"] = int(instances["on_demand_percentage"])
+        if "max_spot_price" in instances:
+            parameters["SpotMaxPrice"] = str(instances["max_spot_price"])
+
+    def performance_profile(self):
+        """
+        Airflow settings sized for the instance types of the scheduler, webserver and worker sets and the database
+        instance class of the templates, to pass to write_modified_airflow_config once every workerset is added
+        - parallelism: the task slots of the worker sets at their max size, within the database connections, or the
+        client connections of PgBouncer
+        - dag_concurrency: half the parallelism, at least the Airflow default of 16
+        - max_threads: one DAG parsing process per vCPU of the scheduler, the SQLAlchemy pools sized to match
+        - workers: the webserver gunicorn workers, 2 per vCPU plus one within WEBSERVER_WORKER_MEMORY_MIB each
+        - store_serialized_dags: the webserver reads the DAGs the scheduler serialises to the database
+        The performance_profile key of STAGE_NAMES_AND_CONFIGS overrides any setting, by section
+        With PgBouncer, its pool size defaults to the database connections and its client connections to those of the
+        running tasks, in the master template
+        :return: dict of airflow.cfg options by section
+        """
+        master_parameters = self.templates_dict[Labels.master_label]["Parameters"]
+        scheduler_vcpus, _ = self._instance_type_resources(master_parameters["SchedulerInstanceType"]["Default"])
+        webserver_vcpus, webserver_memory = self._instance_type_resources(
+            master_parameters["WebserverInstanceType"]["Default"])
+        db_class = self.templates_dict[Labels.cluster_label]["Resources"]["DBInstance"]["Properties"][
+            "DBInstanceClass"]
+        # A database instance class has the memory of the EC2 instance type of the same name, and RDS for PostgreSQL
+        # allows a connection per 9531392 bytes of it by default
+        _, db_memory = self._instance_type_resources(db_class.replace("db.", "", 1))
+        db_connections = min(db_memory * 1048576 // 9531392, 5000)
+
+        task_slots = sum(self._workerset_task_slots())
+        connections = db_connections - self.RESERVED_DB_CONNECTIONS
+        if master_parameters["PgBouncerInstanceType"]["Default"]:
+            connections = self._set_pgbouncer_size(connections, task_slots)
+        parallelism = max(1, min(task_slots, connections // self.DB_CONNECTIONS_PER_TASK))
+        max_threads = max(2, scheduler_vcpus)
+        webserver_workers = min(2 * webserver_vcpus + 1, webserver_memory // self.WEBSERVER_WORKER_MEMORY_MIB - 1)
+        profile = {
+            "core": {
+                "parallelism": parallelism,
+                "dag_concurrency": min(parallelism, max(16, parallelism // 2)),
+                "sql_alchemy_pool_size": max_threads + 1,
+                "sql_alchemy_max_overflow": max_threads + 1,
+                "store_serialized_dags": True,
+                "store_dag_code": True,
+                "min_serialized_dag_update_interval": 30,
+            },
+            "scheduler": {
+                "max_threads": max_threads,
+            },
+            "webserver": {
+                "workers": max(1, webserver_workers),
+            },
+        }
+        overrides = (self.STAGE_NAMES_AND_CONFIGS or {}).get(self.stage_name, {}).get("performance_profile", {})
+        for section, options in overrides.items():
+            profile.setdefault(section, {}).update(options)
+        logger.info("Airflow performance profile for {} database connections and {} task slots: {}".format(
+            db_connections, task_slots, profile))
+        return profile
+
+    def _set_pgbouncer_size(self, db_connections, task_slots):
+        """
+        Sizes PgBouncer in the master template, unless the pgbouncer key of STAGE_NAMES_AND_CONFIGS sets its sizes
+        :param db_connections: connections of the database left to PgBouncer
+        :param task_slots: task slots of every workerset at its max size
+        :return: client connections of PgBouncer left to the running tasks
+        """
+        pgbouncer = (self.STAGE_NAMES_AND_CONFIGS or {}).get(self.stage_name, {}).get("pgbouncer", {})
+        pool_size = int(pgbouncer.get("pool_size", max(1, db_connections)))
+        max_client_connections = int(pgbouncer.get(
+            "max_client_connections",
+            task_slots * self.DB_CONNECTIONS_PER_TASK + self.PGBOUNCER_RESERVED_CLIENT_CONNECTIONS))
+        logger.info("Updating PgBouncer to pool {} database connections for {} client connections".format(
+            pool_size, max_client_connections))
+        master_parameters = self.templates_dict[Labels.master_label]["Parameters"]
+        master_parameters["PgBouncerPoolSize"]["Default"] = pool_size
+        master_parameters["PgBouncerMaxClientConnections"]["Default"] = max_client_connections
+        return max_client_connections - self.PGBOUNCER_RESERVED_CLIENT_CONNECTIONS
+
+    def _workerset_task_slots(self):
+        """
+        :return: task slots of every workerset of the cluster template at its max size
+        """
+        master_parameters = self.templates_dict[Labels.master_label]["Parameters"]
+        workerset_parameters = self.templates_dict[Labels.workerset_label]["Parameters"]
+        for name, resource in self.templates_dict[Labels.cluster_label]["Resources"].items():
+            if not name.startswith("WorkerSetStack"):
+                continue
+            parameters = resource["Properties"]["Parameters"]
+            worker_slots = parameters.get("WorkerSlots", workerset_parameters["WorkerSlots"]["Default"])
+            max_size = parameters["MaxGroupSize"]
+            # The default workerset takes its max size from the master template
+            if isinstance(max_size, dict):
+                max_size = master_parameters["MaxGroupSize"]["Default"]
+            yield int(worker_slots) * int(max_size)
+
+    def _instance_type_resources(self, instance_type):
+        """
+        :return: number of vCPUs and memory in MiB of an EC2 instance type, from INSTANCE_TYPES or else looked up once
+        per type with EC2
+        """
+        if instance_type in self.INSTANCE_TYPES:
+            return self.INSTANCE_TYPES[instance_type]
+        if instance_type not in self._instance_types:
+            logger.info("Looking up the vCPUs and memory of {} with EC2".format(instance_type))
+            if self._ec2 is None:
+                self._ec2 = boto3.client("ec2", region_name=self.region if self.region else "us-east-1")
+            info = self._ec2.describe_instance_types(InstanceTypes=[instance_type])["InstanceTypes"][0]
+            self._instance_types[instance_type] = (info["VCpuInfo"]["DefaultVCpus"], info["MemoryInfo"]["SizeInMiB"])
+        return self._instance_types[instance_type]
+
+    def _set_workerset_celery(self, ws_stack_name, instance_type, celery=None, worker_slots=None):
+        """
+        Passes Celery worker settings sized for the instance type to a workerset stack of the cluster template
+        :param ws_stack_name: logical name of the workerset stack within the cluster template
+        :param instance_type: EC2 instance type of the workerset
+        :param celery: dict overriding the settings derived from the instance type, with the keys
+        - concurrency: tasks a worker runs at once, TASKS_PER_VCPU per vCPU within the memory left for the tasks
+        - autoscale: [max, min] pool sizes, from one process per vCPU up to the concurrency, None for a fixed pool
+        - prefetch_multiplier: messages reserved per pool process, 1 so that a long task holds no other one back
+        - max_tasks_per_child: tasks a pool process runs before it is replaced, 100, 0 to keep them
+        :param worker_slots: worker slots of the workerset if set explicitly, the largest pool size otherwise
+        :return: None
+        """
+        celery = celery or {}
+        unknown = set(celery) - {"concurrency", "autoscale", "prefetch_multiplier", "max_tasks_per_child"}
+        if unknown:
+            raise ValueError("Unknown celery keys {}".format(sorted(unknown)))
+        if not celery and instance_type not in self.INSTANCE_TYPES:
+            logger.info("No celery detected and {} is not in INSTANCE_TYPES, keeping the default Celery settings of "
+                        "the workerset".format(instance_type))
+            return
+
+        vcpus, memory = self._instance_type_resources(instance_type)
+        concurrency = int(celery.get("concurrency", max(
+            1, min(vcpus * self.TASKS_PER_VCPU, (memory - self.RESERVED_MEMORY_MIB) // self.TASK_MEMORY_MIB))))
+        autoscale = celery.get("autoscale", [concurrency, min(vcpus, concurrency)])
+        if autoscale is not None:
+            autoscale = [int(size) for size in autoscale]
+            if len(autoscale) != 2 or not 1 <= autoscale[1] <= autoscale[0]:
+                raise ValueError("celery autoscale must be the max and min pool sizes, with 1 <= min <= max")
+            # The worker grows its pool up to the max size, whatever its concurrency
+            concurrency = autoscale[0]
+        prefetch_multiplier = int(celery.get("prefetch_multiplier", 1))
+        max_tasks_per_child = int(celery.get("max_tasks_per_child", 100))
+        if concurrency < 1 or prefetch_multiplier < 1 or max_tasks_per_child < 0:
+            raise ValueError("celery concurrency and prefetch_multiplier must be positive, max_tasks_per_child "
+                             "must not be negative")
+
+        parameters = self.templates_dict[Labels.cluster_label]["Resources"][ws_stack_name]["Properties"]["Parameters"]
+        parameters["WorkerConcurrency"] = concurrency
+        parameters["WorkerAutoscale"] = ",".join(map(str, autoscale)) if autoscale else ""
+        parameters["WorkerPrefetchMultiplier"] = prefetch_multiplier
+        parameters["WorkerMaxTasksPerChild"] = max_tasks_per_child
+        if worker_slots is None:
+            parameters["WorkerSlots"] = concurrency
+
+    def _set_workerset_queue(self, ws_stack_name, queue_label, queue=None):
+        """
+        Sets how the workers of a workerset stack of the cluster template consume its queue, on both the SQS queue and
+        the Celery transport of the workers, and the load formula matching it
+        :param ws_stack_name: logical name of the workerset stack within the cluster template
+        :param queue_label: logical name of the SQS queue of the workerset within the cluster template
+        :param queue: dict overriding the defaults, with the keys
+        - wait_time_seconds: seconds a receive waits for a message, 0 for short polling, up to 20 for long polling
+        - visibility_timeout: seconds a received message stays hidden, 21600, must exceed the longest task
+        - polling_interval: seconds a worker sleeps after finding the queue empty, 1
+        - load_formula: EmptyReceives to measure the load by the empty receives, Occupancy by the worker slots taken,
+        defaults to EmptyReceives for short polling and to Occupancy for long polling, which makes few empty receives
+        and leaves the learned baseline of EmptyReceives unused
+        :return: None
+        """
+        queue = queue or {}
+        wait_time_seconds, visibility_timeout, polling_interval = self._set_queue_polling(
+            queue_label, queue, {"load_formula"})
+        load_formula = queue.get("load_formula", "Occupancy" if wait_time_seconds else "EmptyReceives")
+        allowed_formulas = self.templates_dict[Labels.workerset_label]["Parameters"]["LoadFormula"]["AllowedValues"]
+        if load_formula not in allowed_formulas:
+            raise ValueError("queue load_formula must be one of {}".format(allowed_formulas))
+
+        parameters = self.templates_dict[Labels.cluster_label]["Resources"][ws_stack_name]["Properties"]["Parameters"]
+        parameters["QueueWaitTime"] = wait_time_seconds
+        parameters["QueueVisibilityTimeout"] = visibility_timeout
+        parameters["QueuePollingInterval"] = polling_interval
+        parameters["LoadFormula"] = load_formula
+
+    def _set_small_queue(self, queue=None):
+        """
+        Sets how the small worker of the scheduler consumes the small queue, on both the SQS queue and the Celery
+        transport of the worker
+        :param queue: dict overriding the defaults, with the keys of _set_workerset_queue but load_formula, as the small
+        worker does not scale
+        :return: None
+        """
+        wait_time_seconds, visibility_timeout, polling_interval = self._set_queue_polling("SmallTaskQueue", queue or {})
+        parameters = self.templates_dict[Labels.cluster_label]["Resources"]["SchedulerStack"]["Properties"][
+            "Parameters"]
+        parameters["SmallQueueWaitTime"] = wait_time_seconds
+        parameters["SmallQueueVisibilityTimeout"] = visibility_timeout
+        parameters["SmallQueuePollingInterval"] = polling_interval
+
+    def _set_queue_polling(self, queue_label, queue, other_keys=frozenset()):
+        """
+        Validates the polling keys of a queue dict, see _set_workerset_queue, and sets them on the SQS queue
+        :param queue_label: logical name of the SQS queue within the cluster template
+        :param queue: dict of the queue settings
+        :param other_keys: keys of the queue dict handled by the caller
+        :return: wait time, visibility timeout and polling interval of the workers consuming the queue
+        """
+        unknown = set(queue) - {"wait_time_seconds", "visibility_timeout", "polling_interval"} - set(other_keys)
+        if unknown:
+            raise ValueError("Unknown queue keys {}".format(sorted(unknown)))
+
+        wait_time_seconds = int(queue.get("wait_time_seconds", 0))
+        visibility_timeout = int(queue.get("visibility_timeout", 21600))
+        polling_interval = float(queue.get("polling_interval", 1))
+        if not 0 <= wait_time_seconds <= 20 or not 0 <= visibility_timeout <= 43200 or polling_interval < 0:
+            raise ValueError("queue wait_time_seconds must be between 0 and 20, visibility_timeout between 0 and 43200 "
+                             "and polling_interval must not be negative")
+
+        queue_properties = self.templates_dict[Labels.cluster_label]["Resources"][queue_label].setdefault(
+            "Properties", {})
+        queue_properties["ReceiveMessageWaitTimeSeconds"] = wait_time_seconds
+        queue_properties["VisibilityTimeout"] = visibility_timeout
+        return wait_time_seconds, visibility_timeout, polling_interval
+
+    def _scaling_policy_parameters(self, scaling_policy, min_count):
+        """
+        :return: workerset stack parameters for the scaling_policy dict described in _set_workerset_scaling
+        """
+        unknown = set(scaling_policy) - {
+            "type", "scale_out_steps", "scale_out_step_bounds", "scale_in_evaluation_periods", "target_load"}
+        if unknown:
+            raise ValueError("Unknown scaling_policy keys {}".format(sorted(unknown)))
+
+        workerset_parameters = self.templates_dict[Labels.workerset_label]["Parameters"]
+        allowed_types = workerset_parameters["ScalingPolicyType"]["AllowedValues"]
+        policy_type = scaling_policy.get("type", "SimpleScaling")
+        if policy_type not in allowed_types:
+            raise ValueError("scaling_policy type must be one of {}".format(allowed_types))
+        if policy_type == "TargetTrackingScaling":
+            # The default workerset takes its minimum size from the master template
+            if isinstance(min_count, dict):
+                min_count = self.templates_dict[Labels.master_label]["Parameters"]["MinGroupSize"]["Default"]
+            if int(min_count) < 1:
+                raise ValueError("TargetTrackingScaling cannot scale out from 0 instances, the min count must be at least 1")
+
+        parameters = {"ScalingPolicyType": policy_type}
+        if "scale_out_steps" in scaling_policy:
+            steps = [int(step) for step in scaling_policy["scale_out_steps"]]
+            if len(steps) != 3 or min(steps) < 1:
+                raise ValueError("scale_out_steps must be 3 positive numbers of instances")
+            parameters["ScaleOutSteps"] = ",".join(map(str, steps))
+        if "scale_out_step_bounds" in scaling_policy:
+            bounds = [float(bound) for bound in scaling_policy["scale_out_step_bounds"]]
+            if len(bounds) != 2 or not 0 < bounds[0] < bounds[1]:
+                raise ValueError("scale_out_step_bounds must be 2 increasing positive offsets")
+            parameters["ScaleOutStepBounds"] = ",".join(map(str, bounds))
+        if "scale_in_evaluation_periods" in scaling_policy:
+            parameters["ScaleInEvaluationPeriods"] = int(scaling_policy["scale_in_evaluation_periods"])
+        if "target_load" in scaling_policy:
+            parameters["TargetLoad"] = float(scaling_policy["target_load"])
+        return parameters
+
     @staticmethod
     def to_pascal_case(filename):
         split_name = filename.split('-')
@@ -285,38 +826,114 @@ class UpdateTemplates:
         self._join_to_userdata(cluster, metrics_userdata)
 
     @staticmethod
-    def _join_to_userdata(cluster, userdata):
+    def _launch_resource(cluster):
+        """
+        :param cluster: cluster from templates_dict
+        :return: logical name of the launch configuration or launch template of the cluster, holding its cfn-init
+        metadata, and the properties holding its user data
+        """
+        if "LaunchTemplate" in cluster['Resources']:
+            return "LaunchTemplate", cluster['Resources']['LaunchTemplate']['Properties']['LaunchTemplateData']
+        return "LaunchConfiguration", cluster['Resources']['LaunchConfiguration']['Properties']
+
+    def _join_to_userdata(self, cluster, userdata):
         """
         Adds to instance metadata for a given cluster
         :param cluster: cluster from templates_dict to add to
         :param userdata: Metadata you wish to add (as a list of strings)
         :return: None
         """
-        existing_userdata = cluster['Resources']['LaunchConfiguration']['Properties']['UserData']['Fn::Base64'][
-            'Fn::Sub']
-        cluster['Resources']['LaunchConfiguration']['Properties']['UserData']['Fn::Base64']['Fn::Sub'] = "".join(
-            [existing_userdata, *userdata])
+        _, properties = self._launch_resource(cluster)
+        existing_userdata = properties['UserData']['Fn::Base64']['Fn::Sub']
+        properties['UserData']['Fn::Base64']['Fn::Sub'] = "".join([existing_userdata, *userdata])
 
     def save_templates(self):
         # Append the cfn-signal here? Seems a better idea than what's being done rn...
-        cfn_signal = """
-/opt/aws/bin/cfn-signal -e $? --region ${AWS::Region} --stack ${AWS::StackName} --resource LaunchConfiguration
-        """
-        self._join_to_userdata(self.templates_dict[Labels.workerset_label], cfn_signal)
-        self._join_to_userdata(self.templates_dict[Labels.webserver_label], cfn_signal)
-        self._join_to_userdata(self.templates_dict[Labels.scheduler_label], cfn_signal)
-
+        for label in [Labels.workerset_label, Labels.webserver_label, Labels.scheduler_label]:
+            resource, _ = self._launch_resource(self.templates_dict[label])
+            cfn_signal = """
+/opt/aws/bin/cfn-signal -e $? --region ${{AWS::Region}} --stack ${{AWS::StackName}} --resource {}
+        """.format(resource)
+            self._join_to_userdata(self.templates_dict[label], cfn_signal)
+
+        templates = {}
         for template_name in self.templates_dict.keys():
 
             path_to_template = os.path.join(self.updated_templates_path, "turbine-{}.template".format(template_name))
             with open(path_to_template, 'w') as outfile:
                 val = dump_yaml(self.templates_dict[template_name])
                 outfile.write(val)
-                if len(val) > 51200:
-                    logger.info("Template {} too long to run validation".format(template_name))
+                templates[template_name] = val
+        self._validate_templates(templates)
+
+    def _validate_templates(self, templates):
+        """
+        Lints the templates with cfn-lint in parallel, reusing the results cached for unchanged templates, and with
+        REMOTE_VALIDATION validates them with the CloudFormation API too
+        :param templates: dict of the YAML bodies of the templates by template name
+        :return: None
+        """
+        region = self.region or "us-east-1"
+        ignore_checks = sorted(self.VALIDATION_IGNORE_CHECKS)
+        # The result of a template also depends on the release of cfn-lint and the checks run
+        keys = {
+            template_name: hashlib.sha256(
+                "\n".join([cfnlint_version, region, ",".join(ignore_checks), body]).encode()).hexdigest()
+            for template_name, body in templates.items()
+        }
+        results = {template_name: self._cached_validation(key) for template_name, key in keys.items()}
+        pending = [template_name for template_name, result in results.items() if result is None]
+        if pending:
+            logger.info("Linting {} with cfn-lint {}".format(", ".join(pending), cfnlint_version))
+            with concurrent.futures.ProcessPoolExecutor(max_workers=min(len(pending), os.cpu_count() or 1)) as pool:
+                linted = pool.map(_lint_template, [templates[template_name] for template_name in pending],
+                                  itertools.repeat(region), itertools.repeat(ignore_checks))
+                for template_name, result in zip(pending, linted):
+                    results[template_name] = result
+                    self._cache_validation(keys[template_name], result)
+
+        errors = []
+        for template_name, result in results.items():
+            for rule_id, line, message in result:
+                match = "turbine-{}.template:{} {} {}".format(template_name, line, rule_id, message)
+                if rule_id.startswith("E"):
+                    errors.append(match)
                 else:
-                    logger.info(f"validating {template_name} at {path_to_template}")
-                    self._cf.validate_template(TemplateBody=val)
+                    logger.warning(match)
+        if errors:
+            raise ValueError("Templates failed validation:\n{}".format("\n".join(errors)))
+
+        if self.REMOTE_VALIDATION:
+            remote = []
+            for template_name, body in templates.items():
+                if len(body) > self.REMOTE_VALIDATION_MAX_BYTES:
+                    logger.info("Template {} too long to validate with CloudFormation, linted only".format(
+                        template_name))
+                else:
+                    remote.append(body)
+            with concurrent.futures.ThreadPoolExecutor(max_workers=len(remote) or 1) as pool:
+                list(pool.map(lambda body: self._cf.validate_template(TemplateBody=body), remote))
+
+    def _cached_validation(self, key):
+        """
+        :return: list of the matches cached for the hash of a template, None if it was not linted yet
+        """
+        if not self.VALIDATION_CACHE_PATH:
+            return None
+        try:
+            with open(os.path.join(self.VALIDATION_CACHE_PATH, key + ".json")) as cached:
+                return json.load(cached)
+        except (OSError, ValueError):
+            return None
+
+    def _cache_validation(self, key, result):
+        if not self.VALIDATION_CACHE_PATH:
+            return
+        os.makedirs(self.VALIDATION_CACHE_PATH, exist_ok=True)
+        path = os.path.join(self.VALIDATION_CACHE_PATH, key + ".json")
+        with open(path + ".tmp", "w") as cached:
+            json.dump(result, cached)
+        os.replace(path + ".tmp", path)
 
     def add_policies(self, policies_base_path=""):
 
@@ -432,7 +1049,8 @@ class UpdateTemplates:
             self.project_name,
             stage_name=stage_name,
             source_path=source_path,
-            template_path=template_path
+            template_path=template_path,
+            broker=self.templates_dict[Labels.master_label]["Parameters"]["CeleryBroker"]["Default"],
         )
 
         dashboard_template = dashboard.generate_template(**outputs)
@@ -480,7 +1098,9 @@ class UpdateTemplates:
         child_stack['Parameters'].update({parameter: {"Type": ptype}})
         parent_stack_resource['Properties']['Parameters'].update({parameter: value})
 
-    def add_new_workerset(self, instance_type, min_count, max_count, label):
+    def add_new_workerset(self, instance_type, min_count, max_count, label, scaling_mode=None, worker_slots=None,
+                          fast_scaling=None, scaling_policy=None, warm_pool_size=None, celery=None, queue=None,
+                          instances=None):
         """
         Method adds workerset and queue associated with it, also adds exports for queue names where needed
         :param instance_type: EC2 instance type to use
@@ -490,6 +1110,18 @@ class UpdateTemplates:
         - the queue name will appear under DEDUCTIVE_CUSTOM as {LABEL}_QUEUE in the airflow config
         - must be unique
         - must contain only ascii letters
+        :param scaling_mode: ClusterLoad (default) to scale on load alarms, or DesiredCapacity to size the group from
+        the queue depth
+        :param worker_slots: number of tasks a single worker instance runs at once, used by DesiredCapacity
+        :param fast_scaling: bool, sample the queue every 10 seconds and scale on high resolution alarms
+        :param scaling_policy: dict configuring the policy scaling on the cluster load, see _set_workerset_scaling
+        :param warm_pool_size: number of stopped, initialised instances kept in a warm pool to scale out faster
+        :param celery: dict overriding the Celery worker settings derived from the instance type, see
+        _set_workerset_celery
+        :param queue: dict overriding how the workers poll the queue and the matching load formula, see
+        _set_workerset_queue
+        :param instances: dict of the alternative instance types and the on demand and spot instances the workerset
+        launches, see _set_workerset_instances
         :return: None
         """
 
@@ -513,6 +1145,12 @@ class UpdateTemplates:
             queue_label+"Arn", GetAtt(queue_label, "Arn").to_dict(),
         )
 
+        # The scheduler publishes the depth of the queue of every workerset for a Redis broker
+        scheduler_parameters = self.templates_dict[Labels.cluster_label]['Resources']['SchedulerStack'][
+            'Properties']['Parameters']
+        queue_names = scheduler_parameters.setdefault("WorkerSetQueueNames", Join(",", []).to_dict())
+        queue_names["Fn::Join"][1].append(GetAtt(queue_label, "QueueName").to_dict())
+
         # Add to policy for scheduler to allow it to change the queue - this will be a little arcane ...
         # there's no better solution rn
         policy_to_edit = self.templates_dict[Labels.scheduler_label]['Resources']['IamRole']['Properties']['Policies'][2]
@@ -550,8 +1188,15 @@ class UpdateTemplates:
                 "PrivateSubnet2AID": Ref("PrivateSubnet2AID").to_dict(),
                 "SecurityGroupID": Ref("InstancesSecurityGroup").to_dict(),
                 "DatabaseSecret": Ref("Secret").to_dict(),
+                "PgBouncerEndpoint": If(
+                    "PgBouncerCondition", GetAtt("PgBouncerStack", "Outputs.Endpoint"), "").to_dict(),
+                "CeleryBroker": Ref("CeleryBroker").to_dict(),
+                "CeleryResultBackend": Ref("CeleryResultBackend").to_dict(),
+                "RedisEndpoint": If(
+                    "RedisCondition", Sub("${Redis.RedisEndpoint.Address}:${Redis.RedisEndpoint.Port}"), "").to_dict(),
                 "QueueName": GetAtt(queue_label, "QueueName").to_dict(),
                 "LogsBucket": Ref("LogsBucket").to_dict(),
+                "DeploymentsBucket": Ref("DeploymentsBucket").to_dict(),
                 "InstanceType": instance_type,
                 "MinGroupSize": min_count,
                 "MaxGroupSize": max_count,
@@ -568,11 +1213,31 @@ class UpdateTemplates:
 
         self.templates_dict[Labels.cluster_label]["Resources"].update({queue_label: queue_resource.to_dict()})
         self.templates_dict[Labels.cluster_label]["Resources"].update({ws_stack_name: ws_stack.to_dict()})
+        self._set_workerset_scaling(ws_stack_name, scaling_mode, worker_slots, fast_scaling, scaling_policy)
+        self._set_workerset_celery(ws_stack_name, instance_type, celery, worker_slots)
+        self._set_workerset_queue(ws_stack_name, queue_label, queue)
+        if instances is not None:
+            self._set_workerset_instances(ws_stack_name, instance_type, instances)
+        if warm_pool_size is not None:
+            self._set_workerset_warm_pool(ws_stack_name, warm_pool_size)
 
         # Ensure code deploy also includes the instances from the new autoscaling group
         self.templates_dict[Labels.cluster_label]["Resources"]["CodeDeployDeploymentGroup"]["Properties"][
             "AutoScalingGroups"].append(GetAtt(ws_stack_name, "Outputs.AutoScalingGroup").to_dict())
 
+        # The single load metric function evaluates every workerset, so list the new one in its configuration
+        self._load_metric_worker_sets().append(GetAtt(ws_stack_name, "Outputs.LoadMetricConfig").to_dict())
+
+    def _load_metric_worker_sets(self):
+        """
+        :return: list of workerset configurations joined into the WorkerSets key of the input of the load metric
+        function
+        """
+        target = self.templates_dict[Labels.cluster_label]["Resources"]["CloudWatchMetricLambdaTimer"]["Properties"][
+            "Targets"][0]
+        # The input is built as !Join ['', ['{"WorkerSets": [', !Join [',', [configs...]], ']}']]
+        return target["Input"]["Fn::Join"][1][1]["Fn::Join"][1]
+
 
 class LoadBalancerTemplate:
 
@@ -846,7 +1511,7 @@ class LoadBalancerTemplate:
 
     @staticmethod
     def write_modified_airflow_config(path_to_unmodified, path_to_config, stage_name, project_name, domain,
-                                      custom_configs=None):
+                                      custom_configs=None, performance_profile=None):
         cfg = configparser.ConfigParser()
         cfg.read(path_to_unmodified)
         lower_under_stage = stage_name.lower().replace('-', '_')
@@ -864,6 +1529,13 @@ class LoadBalancerTemplate:
         # Update URL used on emails to link to log files etc
         cfg.set('webserver', 'base_url', "http://" + alias)
 
+        # Performance settings sized for the stack, see UpdateTemplates.performance_profile
+        for section, options in (performance_profile or {}).items():
+            if not cfg.has_section(section):
+                cfg.add_section(section)
+            for key, value in options.items():
+                cfg.set(section, key, str(value))
+
         # Add section for custom config args
         # - intended to avoid conflict with existing or new variables from airflow or turbine
         if custom_configs:
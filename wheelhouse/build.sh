@@ -0,0 +1,54 @@
+#!/bin/bash -e
+# Resolves wheelhouse/requirements.txt once on Amazon Linux 2 and packs the wheels
+# of every resolved package, with the frozen requirements.lock, into
+# wheelhouse/wheelhouse.tar.gz. The setup scripts install from it with --no-index
+# when it is found at ${QSS3KeyPrefix}wheelhouse/wheelhouse.tar.gz.
+#
+# Usage: wheelhouse/build.sh [s3://bucket/prefix/ | directory]
+#   s3://bucket/prefix/  uploads to s3://bucket/prefix/wheelhouse/wheelhouse.tar.gz
+#   directory            copies to directory/wheelhouse/wheelhouse.tar.gz, which the
+#                        setup scripts also accept as WHEELHOUSE_URI for local tests
+HERE=$(cd "$(dirname "$0")" && pwd)
+TARGET=${1:-}
+IMAGE=${WHEELHOUSE_IMAGE:-amazonlinux:2}
+PIP_VERSION=20.2.4
+
+if [ -z "$WHEELHOUSE_IN_CONTAINER" ]; then
+    # The wheels must be built against the python and libraries of the instances
+    docker run --rm -e WHEELHOUSE_IN_CONTAINER=1 -v "$HERE":/wheelhouse \
+        "$IMAGE" /wheelhouse/build.sh
+    ls -lh "$HERE/wheelhouse.tar.gz"
+
+    case "$TARGET" in
+        "") ;;
+        s3://*) aws s3 cp "$HERE/wheelhouse.tar.gz" "${TARGET%/}/wheelhouse/wheelhouse.tar.gz" ;;
+        *) mkdir -p "$TARGET/wheelhouse" && cp "$HERE/wheelhouse.tar.gz" "$TARGET/wheelhouse/" ;;
+    esac
+    exit 0
+fi
+
+yum install -y python3 python3-pip python3-wheel python3-devel \
+    gcc libcurl-devel openssl-devel tar gzip
+export PYCURL_SSL_LIBRARY=openssl
+BUILD=$(mktemp -d)
+mkdir "$BUILD/wheels"
+
+python3 -m venv "$BUILD/resolve"
+"$BUILD/resolve/bin/pip" install "pip==$PIP_VERSION" wheel
+grep -v '^#' "$HERE/requirements.txt" | while read -r REQUIREMENT; do
+    if [ -n "$REQUIREMENT" ]; then
+        "$BUILD/resolve/bin/pip" install "$REQUIREMENT"
+    fi
+done
+"$BUILD/resolve/bin/pip" freeze --all > "$BUILD/wheels/requirements.lock"
+"$BUILD/resolve/bin/pip" wheel --no-deps -w "$BUILD/wheels" \
+    -r "$BUILD/wheels/requirements.lock"
+
+# Check the whole set installs offline in a single pass, as on the instances
+python3 -m venv "$BUILD/check"
+"$BUILD/check/bin/pip" install --no-index --find-links "$BUILD/wheels" \
+    "pip==$PIP_VERSION"
+"$BUILD/check/bin/pip" install --no-index --find-links "$BUILD/wheels" \
+    -r "$BUILD/wheels/requirements.lock"
+
+tar czf /wheelhouse/wheelhouse.tar.gz -C "$BUILD/wheels" .